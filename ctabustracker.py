@@ -18,14 +18,52 @@ __author__ = "Chris Swingler"
 __email__ = "chris@chrisswingler.com"
 __status__ = "Development"
 
+import bisect
+import collections
+import struct
+import threading
 import time
-import urllib2
-import xml.etree.ElementTree as etree
 
 # Logger setup
+# Nothing is configured here; applications that want to see this module's
+# log output should call logging.basicConfig() (or similar) themselves.
 import logging
-logging.basicConfig(level = logging.DEBUG)
 log = logging.getLogger('ctabustracker')
+log.addHandler(logging.NullHandler())
+
+# Lazily-loaded backends
+# The HTTP and XML libraries are only imported the first time they're
+# needed, so "import ctabustracker" stays cheap for short-lived processes.
+_urllib = None
+_etree = None
+
+def _get_urllib():
+    """
+    Returns the module providing urlopen(), quote() and HTTPError:
+    urllib2 on Python 2, urllib.request on Python 3.
+    """
+    global _urllib
+    if (_urllib == None):
+        try:
+            import urllib2 as urllib_module
+        except ImportError:
+            import urllib.request as urllib_module
+        _urllib = urllib_module
+    return _urllib
+
+def _get_etree():
+    """
+    Returns the ElementTree module used for parsing: the C implementation
+    (cElementTree) on Python 2, where the default one is pure Python.
+    """
+    global _etree
+    if (_etree == None):
+        try:
+            import xml.etree.cElementTree as etree
+        except ImportError:
+            import xml.etree.ElementTree as etree
+        _etree = etree
+    return _etree
 
 # Utility methods
 def convert_time(timestring):
@@ -40,6 +78,1128 @@ def convert_time(timestring):
         # and not elsewhere.
         return time.strptime(timestring, "%Y%m%d %H:%M")
 
+def to_epoch(ctatime = None):
+    """
+    Converts a time to seconds since the epoch.  ctatime can be a
+    time_struct, a CTA time stamp string, a number of seconds (returned
+    as-is), or None for the current time.
+    """
+    if (ctatime == None):
+        return time.time()
+    if (isinstance(ctatime, (int, float))):
+        return ctatime
+    if (isinstance(ctatime, str)):
+        ctatime = convert_time(ctatime)
+    return time.mktime(ctatime)
+
+def eta_epochs(predictions):
+    """
+    Returns the predicted_eta of each of predictions as seconds since the
+    epoch, in an array('d').  Building this once lets
+    estimated_times_to_arrival() be called on it over and over.
+    """
+    import array
+    return array.array('d', [prediction.predicted_eta_epoch \
+                             for prediction in predictions])
+
+def estimated_times_to_arrival(predictions, ctatime = None):
+    """
+    Returns the minutes to arrival of every prediction, against a single
+    reference time, in one pass.  This is the batch version of
+    Prediction.estimated_time_to_arrival().
+
+    predictions can be a list of Prediction (or LazyPrediction) objects,
+    or a block of predicted arrival times in epoch seconds: an
+    array('d') from eta_epochs(), or a numpy array, in which case a numpy
+    array of ints is returned.
+
+    ctatime is the reference time (see to_epoch()); the system clock is
+    used if it is None.
+    """
+    reference = to_epoch(ctatime)
+    if (hasattr(predictions, "dtype")):
+        # numpy array; astype(int) truncates toward zero, like int().
+        return ((predictions - reference) / 60).astype(int)
+    if (not hasattr(predictions, "typecode")):
+        predictions = eta_epochs(predictions)
+    return [int((eta - reference) / 60) for eta in predictions]
+
+def run_parallel(func, items, workers = 8):
+    """
+    Calls func(item) for each item in items, using up to workers threads.
+    Returns a list of the results, in the same order as items.  If any
+    call raises, the first exception is re-raised once all threads finish.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = list()
+    next_index = [0]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                index = next_index[0]
+                if (index >= len(items) or errors):
+                    return
+                next_index[0] += 1
+            try:
+                results[index] = func(items[index])
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+    threads = [threading.Thread(target = worker) \
+               for i in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if (errors):
+        raise errors[0]
+    return results
+
+# Symbol table
+# Route numbers, directions, destinations and stop names repeat thousands of
+# times per poll.  The model objects and lazy views keep one shared copy of
+# each (so equal values are also the same object, which makes comparing and
+# grouping by them cheap), and directions are normalized on the way in.
+
+# Spellings of each direction, after lowercasing and dropping spaces,
+# hyphens and a trailing "bound"
+_DIRECTION_NAMES = {"n": "North Bound", "north": "North Bound", \
+                    "s": "South Bound", "south": "South Bound", \
+                    "e": "East Bound", "east": "East Bound", \
+                    "w": "West Bound", "west": "West Bound"}
+
+def _direction_name(direction):
+    """
+    Returns the API's spelling ("North Bound", ...) of direction, which
+    can be in any case and spacing, and abbreviated ("NB", "n",
+    "northbound", ...).  Directions it doesn't know are returned stripped.
+    """
+    direction = str(direction).strip()
+    key = direction.lower().replace(" ", "").replace("-", "").replace("_", "")
+    if (key.endswith("bound")):
+        key = key[:-5]
+    elif (len(key) == 2 and key[1] == "b"):
+        key = key[0]
+    return _DIRECTION_NAMES.get(key, direction)
+
+
+class SymbolTable:
+    """
+    A bounded table of shared strings.
+
+    symbol() returns the table's copy of a value, adding it if there's
+    room; once max_size values are held, new ones are returned as plain
+    strings.  direction() does the same for normalized directions, and
+    remembers how each spelling it has seen normalizes.
+    """
+
+    def __init__(self, max_size = 32768):
+        self.max_size = max_size
+        # Lookups and setdefault() on a dict are atomic, so no lock is
+        # needed; the size limit may be overshot by a few entries.
+        self.__symbols = dict()
+        # spelling -> symbol for the normalized direction
+        self.__directions = dict()
+
+    def symbol(self, value):
+        symbol = self.__symbols.get(value)
+        if (symbol == None):
+            # Text is kept as it is: str() would fail on non-ASCII unicode
+            # on Python 2
+            if (isinstance(value, type(u""))):
+                symbol = value
+            else:
+                symbol = str(value)
+            if (len(self.__symbols) < self.max_size):
+                symbol = self.__symbols.setdefault(symbol, symbol)
+        return symbol
+
+    def direction(self, value):
+        direction = self.__directions.get(value)
+        if (direction == None):
+            direction = self.symbol(_direction_name(value))
+            if (len(self.__directions) < self.max_size):
+                self.__directions[value] = direction
+        return direction
+
+    def __len__(self):
+        return len(self.__symbols)
+
+# The table used by the model objects and lazy views
+symbols = SymbolTable()
+
+def symbol(value):
+    """
+    Returns the shared copy of value (as a string) from symbols.
+    """
+    return symbols.symbol(value)
+
+def normalize_direction(direction):
+    """
+    Returns direction as the API spells it (e.g. "eastbound", "EB" and
+    "east bound" all become "East Bound"), shared from symbols.
+    """
+    return symbols.direction(direction)
+
+
+class HTTPTransport:
+    """
+    Fetches URLs over HTTP and returns the response body.
+
+    This is the only place the module talks to the network; pass a
+    different object with the same get() method to ctabustracker to change
+    how requests are made.
+
+    Responses are requested gzip or deflate compressed, and are
+    decompressed as they're read.  Responses for the commands in
+    conditional_commands (the static ones: routes, directions, stops and
+    patterns) are kept along with their ETag/Last-Modified validators, and
+    later requests for the same URL are made conditional; when the server
+    answers 304 Not Modified, the kept copy is returned.
+
+    stats holds counters of what went over the wire:
+        requests - requests made
+        not_modified - 304 responses answered from the kept copy
+        bytes_received - response body bytes received (compressed)
+        bytes_decoded - response body bytes after decompression
+        bytes_from_cache - bytes returned from kept copies on a 304
+    """
+
+    # Commands whose responses are worth revalidating instead of refetching
+    conditional_commands = ("getroutes", "getdirections", "getstops", \
+                            "getpatterns")
+
+    # Size of the chunks read from the socket
+    chunk_size = 16384
+
+    def __init__(self, timeout = None, compress = True, conditional = True, \
+                 max_cache_entries = 2048):
+        """
+        timeout is the socket timeout in seconds (None waits forever).
+
+        compress asks the server for gzip/deflate responses, and
+        conditional turns on ETag/Last-Modified revalidation, keeping up to
+        max_cache_entries responses.
+        """
+        self.timeout = timeout
+        self.compress = compress
+        self.conditional = conditional
+        self.max_cache_entries = max_cache_entries
+        self.stats = dict.fromkeys(("requests", "not_modified", \
+                                    "bytes_received", "bytes_decoded", \
+                                    "bytes_from_cache"), 0)
+        self.__lock = threading.Lock()
+        # url -> (etag, last_modified, body)
+        self.__cache = collections.OrderedDict()
+
+    def get(self, url, timeout = None):
+        """
+        Returns the body of the response for url, as a byte string.
+        timeout, if given, overrides self.timeout for this request.
+        """
+        if (timeout == None):
+            timeout = self.timeout
+        urllib = _get_urllib()
+        request = urllib.Request(url)
+        if (self.compress):
+            request.add_header("Accept-Encoding", "gzip, deflate")
+
+        cached = None
+        if (self.conditional and self.__is_conditional(url)):
+            cached = self.__cache.get(url)
+            if (cached != None):
+                if (cached[0] != None):
+                    request.add_header("If-None-Match", cached[0])
+                if (cached[1] != None):
+                    request.add_header("If-Modified-Since", cached[1])
+
+        self.__count("requests", 1)
+        try:
+            if (timeout == None):
+                response = urllib.urlopen(request)
+            else:
+                response = urllib.urlopen(request, timeout = timeout)
+        except urllib.HTTPError as e:
+            if (e.code == 304 and cached != None):
+                self.__count("not_modified", 1)
+                self.__count("bytes_from_cache", len(cached[2]))
+                log.debug("Not modified, using kept copy of " + url)
+                self.__touch(url)
+                return cached[2]
+            raise
+
+        try:
+            body = self.__read_body(response)
+            headers = response.info()
+        finally:
+            response.close()
+
+        if (self.conditional and self.__is_conditional(url)):
+            etag = headers.get("ETag")
+            last_modified = headers.get("Last-Modified")
+            if (etag != None or last_modified != None):
+                self.__store(url, (etag, last_modified, body))
+        return body
+
+    def __is_conditional(self, url):
+        """
+        Returns True if url is for one of the conditional_commands.
+        """
+        return url.split("?", 1)[0].rstrip("/").endswith(self.conditional_commands)
+
+    def __read_body(self, response):
+        """
+        Reads a response body in chunks, decompressing it as it goes if
+        it was sent with gzip or deflate Content-Encoding.
+        """
+        import zlib
+        encoding = (response.info().get("Content-Encoding") or "").lower()
+        if (encoding == "gzip"):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif (encoding == "deflate"):
+            decompressor = zlib.decompressobj()
+        else:
+            decompressor = None
+
+        chunks = list()
+        received = 0
+        first = True
+        while True:
+            chunk = response.read(self.chunk_size)
+            if (not chunk):
+                break
+            received += len(chunk)
+            if (decompressor == None):
+                chunks.append(chunk)
+                continue
+            try:
+                chunks.append(decompressor.decompress(chunk))
+            except zlib.error:
+                # Some servers send raw deflate data without the zlib
+                # header.
+                if (not first or encoding != "deflate"):
+                    raise
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                chunks.append(decompressor.decompress(chunk))
+            first = False
+        if (decompressor != None):
+            chunks.append(decompressor.flush())
+
+        body = b"".join(chunks)
+        self.__count("bytes_received", received)
+        self.__count("bytes_decoded", len(body))
+        return body
+
+    def __touch(self, url):
+        """
+        Marks a kept response as the most recently used.
+        """
+        with self.__lock:
+            entry = self.__cache.pop(url, None)
+            if (entry != None):
+                self.__cache[url] = entry
+
+    def __store(self, url, entry):
+        """
+        Keeps a response and its validators, dropping the least recently
+        used kept response if there are more than max_cache_entries.
+        """
+        with self.__lock:
+            self.__cache.pop(url, None)
+            self.__cache[url] = entry
+            while (len(self.__cache) > self.max_cache_entries):
+                self.__cache.popitem(last = False)
+
+    def __count(self, stat, amount):
+        with self.__lock:
+            self.stats[stat] += amount
+
+
+# Request policies
+# PolicyTransport wraps another transport (normally an HTTPTransport) and
+# decides, for every request, whether to wait for the rate limiter, how
+# long the request may take, whether to retry it, and whether to answer
+# from the last good response while the API is failing.
+
+class TokenBucket:
+    """
+    A token bucket rate limiter, safe to share between threads.
+
+    Tokens are added at rate per second, up to burst.  Threads call
+    acquire(), which blocks until a token is available.  Code that can't
+    block (asyncio tasks) calls reserve(), which takes a token right away,
+    possibly going into debt, and returns how many seconds to wait before
+    using it, e.g. "await asyncio.sleep(bucket.reserve())".
+    """
+
+    def __init__(self, rate, burst = 1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.__tokens = float(burst)
+        self.__updated = time.time()
+        self.__lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token and returns the number of seconds until it may be
+        used (0 if right away).
+        """
+        with self.__lock:
+            now = time.time()
+            self.__tokens = min(self.burst, self.__tokens + \
+                                (now - self.__updated) * self.rate)
+            self.__updated = now
+            self.__tokens -= 1
+            if (self.__tokens >= 0):
+                return 0.0
+            return -self.__tokens / self.rate
+
+    def acquire(self):
+        """
+        Blocks until a token is available.  Returns the number of seconds
+        waited.
+        """
+        delay = self.reserve()
+        if (delay > 0):
+            time.sleep(delay)
+        return delay
+
+
+class RetryPolicy:
+    """
+    Retries failed idempotent requests, waiting a jittered, exponentially
+    growing delay between attempts: a random time between 0 and
+    min(max_delay, base_delay * 2 ** retry_number) ("full jitter").
+
+    Only transient failures are retried: network errors, timeouts, and
+    HTTP 429 and 5xx responses.
+    """
+
+    # Every Bus Tracker call is a read, so they're all safe to retry.
+    idempotent_commands = ("gettime", "getvehicles", "getroutes", \
+                           "getdirections", "getstops", "getpatterns", \
+                           "getpredictions", "getservicebulletins")
+
+    def __init__(self, max_attempts = 3, base_delay = 0.5, max_delay = 10.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_idempotent(self, url):
+        """
+        Returns True if the command in url is safe to retry.
+        """
+        return url.split("?", 1)[0].rstrip("/").endswith(self.idempotent_commands)
+
+    def is_transient(self, error):
+        """
+        Returns True if error is worth retrying.
+        """
+        import socket
+        urllib = _get_urllib()
+        if (isinstance(error, urllib.HTTPError)):
+            return error.code == 429 or error.code >= 500
+        return isinstance(error, (urllib.URLError, socket.error, \
+                                  socket.timeout, DeadlineExceededError))
+
+    def delay(self, retry_number):
+        """
+        Returns how long to wait before retry number retry_number (the
+        first retry is 0).
+        """
+        import random
+        return random.uniform(0, min(self.max_delay, \
+                                     self.base_delay * (2 ** retry_number)))
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to an API that keeps failing.
+
+    After failure_threshold failures in a row the breaker opens, and
+    requests are refused for reset_timeout seconds.  After that, one trial
+    request is let through ("half open"): if it works the breaker closes,
+    and if not it opens again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half open"
+
+    def __init__(self, failure_threshold = 5, reset_timeout = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.__failures = 0
+        self.__opened_at = None
+        self.__lock = threading.Lock()
+
+    def allow(self):
+        """
+        Returns True if a request may be sent now.
+        """
+        with self.__lock:
+            if (self.state == self.CLOSED):
+                return True
+            if (self.state == self.OPEN and \
+                    time.time() - self.__opened_at >= self.reset_timeout):
+                self.state = self.HALF_OPEN
+                return True
+            # Open, or half open with the trial request still out
+            return False
+
+    def release(self):
+        """
+        Gives back the trial request allow() let through when it ends up
+        not being sent, so the next request can be the trial instead.
+        """
+        with self.__lock:
+            if (self.state == self.HALF_OPEN):
+                self.state = self.OPEN
+
+    def record_success(self):
+        with self.__lock:
+            self.state = self.CLOSED
+            self.__failures = 0
+
+    def record_failure(self):
+        """
+        Counts a failure.  Returns True if this opened the breaker.
+        """
+        with self.__lock:
+            self.__failures += 1
+            if (self.state == self.HALF_OPEN or \
+                    (self.state == self.CLOSED and \
+                     self.__failures >= self.failure_threshold)):
+                self.state = self.OPEN
+                self.__opened_at = time.time()
+                return True
+            return False
+
+
+class PolicyTransport:
+    """
+    Wraps a transport with a rate limiter, per-request deadlines, retries
+    and a circuit breaker.
+
+    If max_stale_age is set, then while the breaker is open, or once
+    retries for a transient failure run out (see
+    RetryPolicy.is_transient()), the last good response for the same URL
+    (if it's no older than max_stale_age seconds) is returned instead of
+    raising.  The caller can't tell it from a fresh one, so this is off
+    by default.  Other errors, like a 404, are always raised.
+    Whatever the wrapped transport raised is raised as a RequestFailedError,
+    so callers only have TransportErrors to deal with.
+
+    metrics counts each decision made:
+        requests - calls to get()
+        attempts - requests sent to the wrapped transport
+        successes - attempts that worked
+        failures - attempts that failed
+        retries - attempts that were retries
+        throttled - requests that had to wait for the rate limiter
+        throttle_wait - total seconds spent waiting for the rate limiter
+        rejected - requests refused because the breaker was open
+        breaker_opened - times the breaker opened
+        stale_served - requests answered with a stale response
+        deadline_exceeded - requests that ran out of time
+    """
+
+    def __init__(self, transport = None, rate_limiter = None, \
+                 retry_policy = None, circuit_breaker = None, deadline = 10.0, \
+                 max_stale_age = None, max_stale_entries = 1024):
+        """
+        transport is the transport to wrap (an HTTPTransport if None).
+        Its get() must accept a timeout argument if deadline is set.
+
+        rate_limiter is a TokenBucket, which may be shared with other
+        PolicyTransports; None means no limit.  retry_policy and
+        circuit_breaker default to a RetryPolicy() and a CircuitBreaker().
+        deadline is the most time, in seconds, a request may take,
+        retries included (None for no limit).  max_stale_age is how old,
+        in seconds, a response may be to be served stale (None to never
+        serve stale responses), and max_stale_entries how many URLs'
+        responses are kept for that.
+        """
+        if (transport == None):
+            transport = HTTPTransport()
+        if (retry_policy == None):
+            retry_policy = RetryPolicy()
+        if (circuit_breaker == None):
+            circuit_breaker = CircuitBreaker()
+        self.transport = transport
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
+        self.circuit_breaker = circuit_breaker
+        self.deadline = deadline
+        self.max_stale_age = max_stale_age
+        self.max_stale_entries = max_stale_entries
+        self.metrics = dict.fromkeys(("requests", "attempts", "successes", \
+                                      "failures", "retries", "throttled", \
+                                      "throttle_wait", "rejected", \
+                                      "breaker_opened", "stale_served", \
+                                      "deadline_exceeded"), 0)
+        self.__lock = threading.Lock()
+        # url -> (time fetched, body)
+        self.__stale = collections.OrderedDict()
+
+    def get(self, url):
+        """
+        Returns the body of the response for url, as a byte string.
+        """
+        self.__count("requests")
+        started = time.time()
+        if (self.retry_policy.is_idempotent(url)):
+            attempts = self.retry_policy.max_attempts
+        else:
+            attempts = 1
+
+        attempt = 0
+        while True:
+            if (not self.circuit_breaker.allow()):
+                self.__count("rejected")
+                return self.__stale_or_raise(url, CircuitOpenError(url))
+
+            if (self.rate_limiter != None):
+                waited = self.rate_limiter.acquire()
+                if (waited > 0):
+                    self.__count("throttled")
+                    self.__count("throttle_wait", waited)
+
+            timeout = None
+            if (self.deadline != None):
+                timeout = self.deadline - (time.time() - started)
+                if (timeout <= 0):
+                    # The request isn't going out after all
+                    self.circuit_breaker.release()
+                    self.__count("deadline_exceeded")
+                    return self.__stale_or_raise(url, DeadlineExceededError(url))
+
+            self.__count("attempts")
+            if (attempt > 0):
+                self.__count("retries")
+            try:
+                if (timeout == None):
+                    body = self.transport.get(url)
+                else:
+                    body = self.transport.get(url, timeout = timeout)
+            except Exception as e:
+                self.__count("failures")
+                transient = self.retry_policy.is_transient(e)
+                if (transient):
+                    if (self.circuit_breaker.record_failure()):
+                        self.__count("breaker_opened")
+                        log.warning("Circuit breaker opened after: " + str(e))
+                elif (isinstance(e, _get_urllib().HTTPError)):
+                    # The API answered (with a 404, say), so it isn't down.
+                    self.circuit_breaker.record_success()
+                else:
+                    # Not news about the API (a bug in the transport, say)
+                    self.circuit_breaker.release()
+                attempt += 1
+                if (not transient):
+                    raise RequestFailedError(url, e)
+                if (attempt >= attempts):
+                    return self.__stale_or_raise(url, \
+                                                 RequestFailedError(url, e))
+                delay = self.retry_policy.delay(attempt - 1)
+                if (self.deadline != None and \
+                        time.time() - started + delay >= self.deadline):
+                    self.__count("deadline_exceeded")
+                    return self.__stale_or_raise(url, \
+                                                 RequestFailedError(url, e))
+                log.info("Retrying in %.2fs after: %s" % (delay, e))
+                time.sleep(delay)
+                continue
+
+            self.__count("successes")
+            self.circuit_breaker.record_success()
+            self.__keep(url, body)
+            return body
+
+    def __keep(self, url, body):
+        """
+        Keeps the last good response for url, if stale responses may be
+        served.
+        """
+        if (self.max_stale_age == None):
+            return
+        with self.__lock:
+            self.__stale.pop(url, None)
+            self.__stale[url] = (time.time(), body)
+            while (len(self.__stale) > self.max_stale_entries):
+                self.__stale.popitem(last = False)
+
+    def __stale_or_raise(self, url, error):
+        """
+        Returns the last good response for url if there is a fresh enough
+        one, and raises error otherwise.
+        """
+        if (self.max_stale_age == None):
+            raise error
+        with self.__lock:
+            kept = self.__stale.get(url)
+        if (kept != None and time.time() - kept[0] <= self.max_stale_age):
+            self.__count("stale_served")
+            log.warning("Serving stale response (%s): %s" % (error, url))
+            return kept[1]
+        raise error
+
+    def __count(self, metric, amount = 1):
+        with self.__lock:
+            self.metrics[metric] += amount
+
+
+# Parser backends
+# Every get* method parses its response through one of these.  They turn
+# the XML into plain dicts of tag -> text, which are then decoded into
+# Vehicle, Prediction, etc. objects, so every backend yields the same objects.
+
+class ElementTreeParser:
+    """
+    Parses API responses with the standard library's ElementTree.
+    """
+
+    name = "etree"
+
+    def __init__(self):
+        self.etree = _get_etree()
+
+    def fromstring(self, xml):
+        """
+        Returns the root element of an XML document.
+        """
+        return self.etree.fromstring(xml)
+
+    def select(self, root, tag):
+        """
+        Returns the children of root named tag.
+        """
+        return root.findall(tag)
+
+    def texts(self, root, tag):
+        """
+        Returns the text of each child of root named tag.
+        """
+        return [element.text for element in self.select(root, tag)]
+
+    def records(self, root, tag, nested = None):
+        """
+        Returns a list of dicts, one per child of root named tag, mapping
+        the tag of each of its children to that child's text.
+
+        Children named nested are collected into a list of dicts (built the
+        same way) under the nested key instead.
+        """
+        records = list()
+        for element in self.select(root, tag):
+            record = dict()
+            if (nested != None):
+                record[nested] = list()
+            for child in element:
+                if (child.tag == nested):
+                    record[nested].append(dict((grandchild.tag, grandchild.text) \
+                                               for grandchild in child))
+                else:
+                    record[child.tag] = child.text
+            records.append(record)
+        return records
+
+
+class LxmlParser(ElementTreeParser):
+    """
+    Parses API responses with lxml, selecting elements with compiled XPath
+    expressions.  Raises ImportError if lxml isn't installed.
+    """
+
+    name = "lxml"
+
+    def __init__(self):
+        import lxml.etree
+        self.etree = lxml.etree
+        self.__parser = lxml.etree.XMLParser(remove_comments = True, \
+                                             remove_pis = True)
+        # Compiled XPath objects aren't shared between threads.
+        self.__local = threading.local()
+
+    def fromstring(self, xml):
+        return self.etree.fromstring(xml, self.__parser)
+
+    def select(self, root, tag):
+        xpaths = getattr(self.__local, "xpaths", None)
+        if (xpaths == None):
+            xpaths = self.__local.xpaths = dict()
+        xpath = xpaths.get(tag)
+        if (xpath == None):
+            xpath = xpaths[tag] = self.etree.XPath(tag)
+        return xpath(root)
+
+
+# Parser backends by name
+PARSERS = {"etree": ElementTreeParser,
+           "lxml": LxmlParser}
+
+def get_parser(name = None):
+    """
+    Returns a parser backend by name: "lxml" or "etree".  If name is None,
+    ElementTree is used on Python 3, where its C parser is as fast as
+    lxml's for these responses.  On Python 2 lxml is used if it's installed.
+    """
+    if (name == None):
+        if (bytes is str):
+            try:
+                return LxmlParser()
+            except ImportError:
+                pass
+        return ElementTreeParser()
+    if (name not in PARSERS):
+        raise InvalidParamtersException("Unknown parser backend: " + str(name))
+    return PARSERS[name]()
+
+
+# API errors
+# The API reports errors inside a normal response:
+#   <error><msg>Invalid API access key supplied</msg></error>
+# and, when some of several ids fail, next to the results for the others:
+#   <vehicle>...</vehicle><error><vid>509</vid><msg>No data found for parameter</msg></error>
+
+class ResultList(list):
+    """
+    A list of results from a request where some of the ids asked for
+    failed.  errors is a list of APIError objects, one per failed id.
+    """
+
+    def __init__(self, results, errors):
+        list.__init__(self, results)
+        self.errors = errors
+
+def api_error(record):
+    """
+    Returns the APIError subclass instance for an <error> record, picked
+    by its message (see API_ERROR_PHRASES).
+    """
+    msg = record.get('msg') or ""
+    param = None
+    value = None
+    for tag in record:
+        if (tag != 'msg'):
+            param, value = tag, record[tag]
+            break
+
+    lowered = msg.lower()
+    error_class = APIError
+    for phrases, phrase_class in API_ERROR_PHRASES:
+        if (all(phrase in lowered for phrase in phrases)):
+            error_class = phrase_class
+            break
+    return error_class(msg, param, value)
+
+
+# Record decoding
+# These build model objects from the dicts returned by a parser backend.
+
+def _vehicle_from_record(record):
+    return Vehicle(vehicle_id = record['vid'],
+                   timestamp = record['tmstmp'],
+                   lat = record['lat'],
+                   long = record['lon'],
+                   heading = record['hdg'],
+                   pattern_id = record['pid'],
+                   pattern_distance = record['pdist'],
+                   route = record['rt'],
+                   dest = record['des'],
+                   delayed = ('dly' in record))
+
+def _stop_from_record(record):
+    return Stop(stop_id = record['stpid'],
+                stop_name = record['stpnm'],
+                lat = record['lat'],
+                long = record['lon'])
+
+def _pattern_from_record(record):
+    pat_obj = Pattern(pattern_id = record['pid'],
+                      length = record['ln'],
+                      direction = record['rtdir'])
+    for point in record['pt']:
+        pat_obj.append(_point_from_record(point))
+    return pat_obj
+
+def _point_from_record(record):
+    return Point(seq = record['seq'],
+                 ptype = record['typ'],
+                 lat = record['lat'],
+                 long = record['lon'],
+                 stop_id = record.get('stpid'),
+                 stop_name = record.get('stpnm'),
+                 pattern_distance = record.get('pdist'))
+
+def _prediction_from_record(record):
+    pred_obj = Prediction(timestamp = record['tmstmp'],
+                          prediction_type = record['typ'],
+                          stop_id = record['stpid'],
+                          stop_name = record['stpnm'],
+                          vehicle_id = record['vid'],
+                          distance_to_stop = record['dstp'],
+                          route = record['rt'],
+                          route_dir = record['rtdir'],
+                          destination = record['des'],
+                          predicted_eta = record['prdtm'])
+    if ('dly' in record):
+        pred_obj.delayed = True
+    return pred_obj
+
+def _bulletin_from_record(record):
+    # XXX The example XML doesn't always have every field, so none of
+    # them are required here.
+    bulletin_obj = Service_Bulletin(name = record.get('nm'),
+                                    subject = record.get('sbj'),
+                                    detail = record.get('dtl'),
+                                    brief = record.get('brf'),
+                                    priority = record.get('prty'))
+    for sb in record['srvc']:
+        bulletin_obj.append(route = sb.get('rt'),
+                            direction = sb.get('rtdir'),
+                            stop_num = sb.get('stpid'),
+                            stop_name = sb.get('stpnm'))
+    return bulletin_obj
+
+def _sb_service_from_record(record):
+    return SB_Service(route = record.get('rt'),
+                      direction = record.get('rtdir'),
+                      stop_num = record.get('stpid'),
+                      stop_name = record.get('stpnm'))
+
+
+# Lazy record views
+# In "lazy" mode, get* methods return these instead of model objects.  A
+# field is only decoded (int(), float(), convert_time(), ...) the first time
+# it's read, and the result is kept in a slot for later reads.
+
+def _optional(convert):
+    """
+    Wraps a converter so that missing values stay None.
+    """
+    def convert_optional(value):
+        if (value == None):
+            return None
+        return convert(value)
+    return convert_optional
+
+def _present(value):
+    """
+    Converter for flag elements like <dly>, which are true if they exist.
+    """
+    return value != None
+
+def _point_type(ptype):
+    if ptype == "W":
+        return "Waypoint"
+    elif ptype == "S":
+        return "Stop"
+    else:
+        return ptype
+
+
+class LazyRecord(object):
+    """
+    A read-only view over a single parsed record (a dict of tag -> text).
+
+    Subclasses list their fields in _fields, as attribute name ->
+    (tag, converter), and set __slots__ to the same names.
+    """
+
+    __slots__ = ("_record",)
+
+    # attribute name -> (tag, converter)
+    _fields = dict()
+
+    # Function that builds the full model object from a record
+    _build = None
+
+    def __init__(self, record):
+        self._record = record
+
+    def __getattr__(self, name):
+        try:
+            tag, convert = self._fields[name]
+        except KeyError:
+            raise AttributeError(name)
+        value = convert(self._record.get(tag))
+        object.__setattr__(self, name, value)
+        return value
+
+    def __setattr__(self, name, value):
+        if (name != "_record"):
+            raise AttributeError("LazyRecord views are read-only")
+        object.__setattr__(self, name, value)
+
+    def text(self, tag):
+        """
+        Returns the undecoded text of tag, as it came from the API.
+        """
+        return self._record.get(tag)
+
+    def materialize(self):
+        """
+        Returns the full model object (Vehicle, Prediction, etc.) for this
+        record.
+        """
+        return type(self)._build(self._record)
+
+    def __str__(self):
+        return str(self.materialize())
+
+
+class LazyVehicle(LazyRecord):
+    """
+    Lazy view with the same fields as a Vehicle.
+    """
+    _fields = {"vehicle_id": ("vid", int),
+               "timestamp": ("tmstmp", convert_time),
+               "lat": ("lat", float),
+               "long": ("lon", float),
+               "heading": ("hdg", int),
+               "pattern_id": ("pid", int),
+               "pattern_distance": ("pdist", int),
+               "route": ("rt", symbol),
+               "dest": ("des", symbol),
+               "delayed": ("dly", _present)}
+    __slots__ = tuple(_fields)
+    _build = staticmethod(_vehicle_from_record)
+
+
+class LazyStop(LazyRecord):
+    """
+    Lazy view with the same fields as a Stop.
+    """
+    _fields = {"stop_id": ("stpid", int),
+               "stop_name": ("stpnm", symbol),
+               "lat": ("lat", str),
+               "long": ("lon", str)}
+    __slots__ = tuple(_fields)
+    _build = staticmethod(_stop_from_record)
+
+
+class LazyPoint(LazyRecord):
+    """
+    Lazy view with the same fields as a Point.
+    """
+    _fields = {"seq": ("seq", int),
+               "ptype": ("typ", _point_type),
+               "lat": ("lat", float),
+               "long": ("lon", float),
+               "stop_id": ("stpid", _optional(str)),
+               "stop_name": ("stpnm", _optional(symbol)),
+               "pattern_distance": ("pdist", _optional(float))}
+    __slots__ = tuple(_fields)
+    _build = staticmethod(_point_from_record)
+
+
+class LazyPattern(LazyRecord):
+    """
+    Lazy view with the same fields as a Pattern.  points is a list of
+    LazyPoint views.
+    """
+    _fields = {"pattern_id": ("pid", int),
+               "length": ("ln", lambda length: int(float(length))),
+               "direction": ("rtdir", normalize_direction),
+               "points": ("pt", lambda points: [LazyPoint(point) for point in points])}
+    __slots__ = tuple(_fields)
+    _build = staticmethod(_pattern_from_record)
+
+
+class LazyPrediction(LazyRecord):
+    """
+    Lazy view with the same fields as a Prediction.
+    """
+    _fields = {"timestamp": ("tmstmp", convert_time),
+               "prediction_type": ("typ", str),
+               "stop_id": ("stpid", int),
+               "stop_name": ("stpnm", symbol),
+               "vehicle_id": ("vid", int),
+               "distance_to_stop": ("dstp", int),
+               "route": ("rt", symbol),
+               "route_dir": ("rtdir", normalize_direction),
+               "destination": ("des", symbol),
+               "predicted_eta": ("prdtm", convert_time),
+               "delayed": ("dly", _present)}
+    __slots__ = tuple(_fields) + ("predicted_eta_epoch", \
+                                  "mins_to_arrival_at_init")
+    _build = staticmethod(_prediction_from_record)
+
+    def __getattr__(self, name):
+        if (name == "predicted_eta_epoch"):
+            value = time.mktime(self.predicted_eta)
+        elif (name == "mins_to_arrival_at_init"):
+            value = self.estimated_time_to_arrival(self.timestamp)
+        else:
+            return LazyRecord.__getattr__(self, name)
+        object.__setattr__(self, name, value)
+        return value
+
+    def estimated_time_to_arrival(self, ctatime = None):
+        """
+        Same as Prediction.estimated_time_to_arrival().
+        """
+        eta_seconds = self.predicted_eta_epoch - to_epoch(ctatime)
+        return int(eta_seconds/60)
+
+
+class LazySBService(LazyRecord):
+    """
+    Lazy view with the same fields as an SB_Service.
+    """
+    _fields = {"route": ("rt", _optional(symbol)),
+               "direction": ("rtdir", _optional(normalize_direction)),
+               "stop_num": ("stpid", _optional(int)),
+               "stop_name": ("stpnm", symbol)}
+    __slots__ = tuple(_fields)
+    _build = staticmethod(_sb_service_from_record)
+
+
+class LazyBulletin(LazyRecord):
+    """
+    Lazy view with the same fields as a Service_Bulletin.
+    affected_services is a list of LazySBService views.
+    """
+    _fields = {"name": ("nm", str),
+               "subject": ("sbj", str),
+               "detail": ("dtl", str),
+               "brief": ("brf", str),
+               "priority": ("prty", str),
+               "affected_services": ("srvc", lambda services: \
+                       [LazySBService(service) for service in services])}
+    __slots__ = tuple(_fields)
+    _build = staticmethod(_bulletin_from_record)
+
+
+def materialize_all(results):
+    """
+    Returns results (a list from a get* method) with any LazyRecord views
+    replaced by their full objects, keeping a ResultList's errors.
+    """
+    materialized = [result.materialize() if isinstance(result, LazyRecord) \
+                    else result for result in results]
+    if (isinstance(results, ResultList)):
+        return ResultList(materialized, results.errors)
+    return materialized
+
+def require_parsed_mode(tracker, user):
+    """
+    Raises InvalidParamtersException if tracker is a ctabustracker in
+    "raw" mode, whose unparsed results user (a name, for the message)
+    can't work with.  "objects" and "lazy" trackers are fine.
+    """
+    if (getattr(tracker, "mode", None) == "raw"):
+        raise InvalidParamtersException(user + " needs a ctabustracker in " \
+                "\"objects\" or \"lazy\" mode, not \"raw\"")
+
 
 class ctabustracker:
     """
@@ -52,7 +1212,11 @@ class ctabustracker:
 
     __api_url = "http://www.ctabustracker.com/bustime/api/v1/"
 
-    def __init__(self, api_key, api_url = None):
+    # Ways get* methods can return their results (see __init__)
+    MODES = ("objects", "lazy", "raw")
+
+    def __init__(self, api_key, api_url = None, transport = None, parser = None,
+                 mode = "objects"):
         """
         Initializes the API key for the CTA bus tracker.
         This module will not work without a valid key.
@@ -62,10 +1226,32 @@ class ctabustracker:
         api_url is the base API url to access. If it is not
         specified, the default is used:
         http://www.ctabustracker.com/bustime/api/v1/
+
+        transport is the object used to make HTTP requests. If it is
+        not specified, a PolicyTransport (with a 10 second deadline,
+        retries and a circuit breaker) around an HTTPTransport is used.
+
+        parser is the name of the parser backend to use ("lxml" or
+        "etree", see get_parser()), or a parser object. If it is not
+        specified, ElementTree is used (lxml, if it's installed, on
+        Python 2).
+
+        mode sets what the get* methods return:
+            "objects" - Vehicle, Prediction, etc. objects (the default)
+            "lazy" - LazyRecord views (LazyVehicle, LazyPrediction, etc.)
+                     that only decode a field when it's read
+            "raw" - the response body, as bytes, without parsing it
         """
+        if (mode not in self.MODES):
+            raise InvalidParamtersException("Unknown mode: " + str(mode))
         self.__api_key = api_key
         if (api_url != None):
             self.__api_url = api_url
+        if (transport == None):
+            transport = PolicyTransport(HTTPTransport())
+        self.transport = transport
+        self.parser = parser
+        self.mode = mode
         return
 
     def __get_http_response(self, url):
@@ -73,13 +1259,72 @@ class ctabustracker:
         Private method that grabs the specified URL and returns it as a 
         string.
         """
-        return urllib2.urlopen(url).read()
+        return self.transport.get(url)
 
-    def __make_etree(self, xml):
+    def __get_parser(self):
         """
-        Returns an elementtree object from xml.
+        Returns the parser backend, creating it on first use.
         """
-        return etree.fromstring(xml)
+        if (self.parser == None or isinstance(self.parser, str)):
+            self.parser = get_parser(self.parser)
+        return self.parser
+
+    def __parse_records(self, xml, tag, nested = None):
+        """
+        Parses xml and returns a list of dicts, one per element named tag.
+        (see ElementTreeParser.records())  API errors in the response are
+        handled by __check_errors().
+        """
+        parser = self.__get_parser()
+        root = parser.fromstring(xml)
+        return self.__check_errors(parser, root, \
+                                   parser.records(root, tag, nested))
+
+    def __decode(self, api_result, tag, build, view, nested = None):
+        """
+        Turns the elements named tag in api_result into objects, as set
+        by mode: model objects made with build, LazyRecord views of class
+        view, or (for "raw") api_result itself, untouched.
+        """
+        if (self.mode == "raw"):
+            return api_result
+        records = self.__parse_records(api_result, tag, nested)
+        if (self.mode == "lazy"):
+            results = [view(record) for record in records]
+        else:
+            results = [build(record) for record in records]
+        if (isinstance(records, ResultList)):
+            return ResultList(results, records.errors)
+        return results
+
+    def __parse_texts(self, xml, tag):
+        """
+        Parses xml and returns the text of each element named tag.
+        """
+        parser = self.__get_parser()
+        root = parser.fromstring(xml)
+        return self.__check_errors(parser, root, parser.texts(root, tag))
+
+    def __check_errors(self, parser, root, results):
+        """
+        Looks for <error> elements alongside results, in the same parsed
+        document.  If there are errors and no results, the most severe
+        one is raised as an APIError (see api_error()), with every error
+        in its errors attribute: errors about the whole request first,
+        then errors that won't go away if asked again.  If some ids worked
+        and others didn't, results are returned as a ResultList with the
+        errors attached.
+        """
+        errors = parser.records(root, 'error')
+        if (not errors):
+            return results
+        errors = [api_error(record) for record in errors]
+        if (not results):
+            error = min(errors, key = lambda error: \
+                        (error.param != None, error.retry))
+            error.errors = errors
+            raise error
+        return ResultList(results, errors)
 
     def __convert_time(self, timestring):
         """
@@ -104,8 +1349,9 @@ class ctabustracker:
 
         url = self.__api_url + command + "?key=" + self.__api_key
         if(param_dict != None):
+            quote = _get_urllib().quote
             for dkey in param_dict:
-                url += "&" + urllib2.quote(dkey) + "=" + urllib2.quote(param_dict[dkey])
+                url += "&" + quote(dkey) + "=" + quote(param_dict[dkey])
 
         log.debug("Generated URL: "+ url)
 
@@ -121,13 +1367,19 @@ class ctabustracker:
         as according to the BusTracker system.
         """
 
-        local_time = time.localtime()
+        response = self.__get_api_response("gettime")
+        if (self.mode == "raw"):
+            return response
+        return self.__decode_time(response)
 
-        url = self.__api_url + "gettime?key=" + self.__api_key
-        response = self.__get_http_response(url)
+    def __decode_time(self, response):
+        """
+        Returns the time from a gettime response, logging a warning if
+        it's far off from the local clock.
+        """
+        local_time = time.localtime()
 
-        tree = etree.fromstring(response)
-        timestring = tree.findtext("tm")
+        timestring = self.__parse_texts(response, "tm")[0]
         cta_time = time.strptime(timestring, "%Y%m%d %H:%M:%S")
 
         log.debug("TIME CALLED:")
@@ -137,7 +1389,7 @@ class ctabustracker:
         time_diff = abs(time.mktime(local_time) - time.mktime(cta_time))
         log.debug("Time difference: " + str(time_diff))
         if ( time_diff > 5 ):
-            log.warn("Time difference between CTA and local system clock is greater than 5 seconds!") 
+            log.warning("Time difference between CTA and local system clock is greater than 5 seconds!") 
 
         return cta_time
 
@@ -161,31 +1413,8 @@ class ctabustracker:
         api_result = self.__get_api_response("getvehicles",querydict)
 
         debug_start_time = time.time()
-        root = etree.fromstring(api_result)
-        vehicles_xml = root.findall('vehicle')
-
-        vehicles = list()
-        for vehicle in vehicles_xml:
-            # Yank the delay flag out
-            try:
-                vehicle.find('dly').text
-            except AttributeError:
-                delayed = False
-            else:
-                delayed = True
-            # Create an empty vehicle object
-            v_obj = Vehicle(vehicle_id = vehicle.find('vid').text, \
-                            timestamp = vehicle.find('tmstmp').text, \
-                            lat = vehicle.find('lat').text, \
-                            long = vehicle.find('lon').text, \
-                            heading = vehicle.find('hdg').text, \
-                            pattern_id = vehicle.find('pid').text, \
-                            pattern_distance = vehicle.find('pdist').text, \
-                            route = vehicle.find('rt').text, \
-                            dest = vehicle.find('des').text, \
-                            delayed = delayed)
-            # Append it to the vehicles list
-            vehicles.append(v_obj)
+        vehicles = self.__decode(api_result, 'vehicle', \
+                                 _vehicle_from_record, LazyVehicle)
 
         log.info("XML Processing time for getvehicles_vid(): " + str(time.time() - debug_start_time))
         return vehicles
@@ -209,31 +1438,8 @@ class ctabustracker:
         api_result = self.__get_api_response("getvehicles",querydict)
 
         debug_start_time = time.time()
-        root = etree.fromstring(api_result)
-        vehicles_xml = root.findall('vehicle')
-
-        vehicles = list()
-        for vehicle in vehicles_xml:
-            # Yank the delay flag out
-            try:
-                vehicle.find('dly').text
-            except AttributeError:
-                delayed = False
-            else:
-                delayed = True
-            # Create an empty vehicle object
-            v_obj = Vehicle(vehicle_id = vehicle.find('vid').text, \
-                            timestamp = vehicle.find('tmstmp').text, \
-                            lat = vehicle.find('lat').text, \
-                            long = vehicle.find('lon').text, \
-                            heading = vehicle.find('hdg').text, \
-                            pattern_id = vehicle.find('pid').text, \
-                            pattern_distance = vehicle.find('pdist').text, \
-                            route = vehicle.find('rt').text, \
-                            dest = vehicle.find('des').text, \
-                            delayed = delayed)
-
-            vehicles.append(v_obj)
+        vehicles = self.__decode(api_result, 'vehicle', \
+                                 _vehicle_from_record, LazyVehicle)
 
         log.info("XML Processing time for getvehicles_rt(): " + str(time.time() - debug_start_time))
         return vehicles
@@ -243,13 +1449,12 @@ class ctabustracker:
         Returns a dict of available routes
         """
         api_result = self.__get_api_response("getroutes")
+        if (self.mode == "raw"):
+            return api_result
 
-        root = etree.fromstring(api_result)
-        routes_xml = root.findall('route')
         routes = dict()
-
-        for route in routes_xml:
-            routes[str(route.find('rt').text)] = str(route.find('rtnm').text)
+        for route in self.__parse_records(api_result, 'route'):
+            routes[str(route['rt'])] = str(route['rtnm'])
 
         return routes
 
@@ -261,42 +1466,28 @@ class ctabustracker:
 
         querydict = {"rt": route}
         api_result = self.__get_api_response("getdirections",querydict)
+        if (self.mode == "raw"):
+            return api_result
 
-        root = etree.fromstring(api_result)
-
-        directions = list()
-        dirs_xml = root.findall('dir')
-
-        for dir in dirs_xml:
-            directions.append(dir.text)
-
-        return directions
+        return [normalize_direction(direction) \
+                for direction in self.__parse_texts(api_result, 'dir')]
 
     def getroute_stops(self, route, direction):
         """
         Returns a list of Stop objects on a given route
-        direction must be a string specifing the direction of the bus.
+        direction must be a string specifing the direction of the bus,
+        in any case or spacing (see normalize_direction()).
 
         The returned list is unordered. Ordering is accomplished
         by constructing a pattern.
         """
         route = str(route)
+        direction = normalize_direction(direction)
 
         querydict = {"rt": route, "dir": direction}
         api_result = self.__get_api_response("getstops", querydict)
 
-        root = etree.fromstring(api_result)
-
-        stops = list()
-        stops_xml = root.findall('stop')
-
-        for stop in stops_xml:
-           s_obj = Stop(stop_id = stop.find('stpid').text, \
-                        stop_name = stop.find('stpnm').text,
-                        lat = stop.find('lat').text,
-                        long = stop.find('lon').text)
-           stops.append(s_obj)
-        return stops
+        return self.__decode(api_result, 'stop', _stop_from_record, LazyStop)
 
     def getpatterns_pid(self, *patternids):
         """
@@ -308,92 +1499,29 @@ class ctabustracker:
 
         pid_query_string = str()
         for pid in patternids:
-            pid_query_string = pid_query_string + str(pid) + ", "
-        pid_query_string.rstrip(",")
+            pid_query_string = pid_query_string + str(pid) + ","
+        pid_query_string = pid_query_string.rstrip(",")
 
         querydict = {"pid": pid_query_string}
 
         api_result = self.__get_api_response("getpatterns", querydict)
 
-        root = etree.fromstring(api_result)
-
-        patterns = list()
-        patterns_xml = root.findall('ptr')
-
-        for pattern in patterns_xml:
-            pat_obj = Pattern(pattern_id = pattern.find('pid').text, \
-                              length = pattern.find('ln').text,
-                              direction = pattern.find('rtdir').text)
-            for point in pattern.findall('pt'):
-                if (point.find('stpid') != None):
-                    stop_id = point.find('stpid').text
-                else:
-                    stop_id = None
-                if (point.find('stpnm') != None):
-                    stop_name = point.find('stpnm').text
-                else:
-                    stop_name = None
-                if (point.find('pdist') != None):
-                    pattern_distance = point.find('pdist').text
-                else:
-                    pattern_distance = None
-                    
-                point_obj = Point(seq = point.find('seq').text, \
-                                  ptype = point.find('typ').text, \
-                                  lat = point.find('lat').text, \
-                                  long = point.find('lon').text, \
-                                  stop_id = stop_id,\
-                                  stop_name = stop_name,\
-                                  pattern_distance = pattern_distance)
-                pat_obj.append(point_obj)
-            patterns.append(pat_obj)
-        return patterns
+        return self.__decode(api_result, 'ptr', \
+                             _pattern_from_record, LazyPattern, 'pt')
 
     def getpatterns_rt(self, route, direction):
         """
         Returns a single pattern given a route and direction
+        (see normalize_direction())
         """
-        # TODO: sanitize direction
         route = str(route)
+        direction = normalize_direction(direction)
         querydict = {"rt": route, "dir": direction}
 
         api_result = self.__get_api_response("getpatterns", querydict)
 
-        root = etree.fromstring(api_result)
-
-        patterns = list()
-        patterns_xml = root.findall('ptr')
-
-        for pattern in patterns_xml:
-            pat_obj = Pattern(pattern_id = pattern.find('pid').text, \
-                              length = pattern.find('ln').text,
-                              direction = pattern.find('rtdir').text)
-            for point in pattern.findall('pt'):
-                if (point.find('stpid') != None):
-                    stop_id = point.find('stpid').text
-                else:
-                    stop_id = None
-
-                if (point.find('stpnm') != None):
-                    stop_name = point.find('stpnm').text
-                else:
-                    stop_name = None
-
-                if (point.find('pdist') != None):
-                    pattern_distance = point.find('pdist').text
-                else:
-                    pattern_distance = None
-                    
-                point_obj = Point(seq = point.find('seq').text, \
-                                  ptype = point.find('typ').text, \
-                                  lat = point.find('lat').text, \
-                                  long = point.find('lon').text, \
-                                  stop_id = stop_id,\
-                                  stop_name = stop_name,\
-                                  pattern_distance = pattern_distance)
-                pat_obj.append(point_obj)
-            patterns.append(pat_obj)
-        return patterns
+        return self.__decode(api_result, 'ptr', \
+                             _pattern_from_record, LazyPattern, 'pt')
 
     def getpredictions_stop(self, *stop_ids):
         """
@@ -412,30 +1540,8 @@ class ctabustracker:
         querydict = {"stpid":stop_ids_str}
         api_result = self.__get_api_response("getpredictions", querydict)
 
-        root = etree.fromstring(api_result)
-
-        predictions = list()
-
-        predictions_xml = root.findall('prd')
-
-        predictions_list = list()
-        for prediction in predictions_xml:
-            pred_obj = Prediction(timestamp = prediction.find('tmstmp').text,
-                                  prediction_type = prediction.find('typ').text,
-                                  stop_id = prediction.find('stpid').text,
-                                  stop_name = prediction.find('stpnm').text,
-                                  vehicle_id = prediction.find('vid').text,
-                                  distance_to_stop = prediction.find('dstp').text,
-                                  route = prediction.find('rt').text,
-                                  route_dir = prediction.find('rtdir').text,
-                                  destination = prediction.find('des').text,
-                                  predicted_eta = prediction.find('prdtm').text)
-            if (prediction.find('dly') != None):
-                pred_obj.delayed = True
-
-            predictions_list.append(pred_obj)
-
-        return predictions_list
+        return self.__decode(api_result, 'prd', \
+                             _prediction_from_record, LazyPrediction)
 
     def getpredictions_vehicle(self, *vehicle_ids):
         """
@@ -453,31 +1559,9 @@ class ctabustracker:
         querydict = {"vid":vehicle_ids_str}
 
         api_result = self.__get_api_response("getpredictions", querydict)
-                                                   
-        root = etree.fromstring(api_result)
-
-        predictions = list()
-
-        predictions_xml = root.findall('prd')
-
-        predictions_list = list()
-        for prediction in predictions_xml:
-            pred_obj = Prediction(timestamp = prediction.find('tmstmp').text,
-                                  prediction_type = prediction.find('typ').text,
-                                  stop_id = prediction.find('stpid').text,
-                                  stop_name = prediction.find('stpnm').text,
-                                  vehicle_id = prediction.find('vid').text,
-                                  distance_to_stop = prediction.find('dstp').text,
-                                  route = prediction.find('rt').text,
-                                  route_dir = prediction.find('rtdir').text,
-                                  destination = prediction.find('des').text,
-                                  predicted_eta = prediction.find('prdtm').text)
-            if (prediction.find('dly') != None):
-                pred_obj.delayed = True
-
-            predictions_list.append(pred_obj)
 
-        return predictions_list
+        return self.__decode(api_result, 'prd', \
+                             _prediction_from_record, LazyPrediction)
 
     def geteta_from_prediction(self, prediction, use_cta_clock = True):
         """
@@ -491,7 +1575,7 @@ class ctabustracker:
         """
 
         if (use_cta_clock == True):
-            timenow = self.gettime()
+            timenow = self.__decode_time(self.__get_api_response("gettime"))
         else:
             timenow = time.localtime()
 
@@ -510,48 +1594,14 @@ class ctabustracker:
 
         for route in routes:
             routes_str += str(route) + ","
-        routes_str.rstrip(",")
+        routes_str = routes_str.rstrip(",")
 
         querydict = {'rt':routes_str}
 
         api_result = self.__get_api_response("getservicebulletins", querydict)
 
-        root = etree.fromstring(api_result)
-
-        bulletins_xml = root.findall('sb')
-
-        bulletins_list = list()
-
-        for bulletin in bulletins_xml:
-            bulletin_obj = Service_Bulletin(name = bulletin.find('nm').text,
-                                            subject = bulletin.find('sbj').text,
-                                            detail = bulletin.find('dtl').text,
-                                            brief = bulletin.find('brf').text,
-                                            priority = bulletin.find('prty').text)
-            for sb in bulletin.findall('srvc'):
-                route = None
-                direction = None
-                stop_num = None
-                stop_name = None
-
-
-                if (sb.find('rt') != None):
-                    route = sb.find('rt').text
-                if (sb.find('rtdir') != None):
-                    direction = sb.find('rtdir').text
-                if (sb.find('stpid') != None):
-                    stop_num = sb.find('stpid').text
-                if (sb.find('stpnm') != None):
-                    stop_name = sb.find('stpnm').text
-                    
-                bulletin_obj.append(route = route,
-                                    direction = direction,
-                                    stop_num = stop_num,
-                                    stop_name = stop_name)
-
-            bulletins_list.append(bulletin_obj)
-
-        return bulletins_list
+        return self.__decode(api_result, 'sb', \
+                             _bulletin_from_record, LazyBulletin, 'srvc')
 
     def getbulletins_stops(self, *stopids):
         """
@@ -567,48 +1617,14 @@ class ctabustracker:
 
         for stop in stopids:
             stopids_str += str(stop) + ","
-        stopids_str.rstrip(",")
+        stopids_str = stopids_str.rstrip(",")
 
-        querydict = {'rt':stopids_str}
+        querydict = {'stpid':stopids_str}
 
         api_result = self.__get_api_response("getservicebulletins", querydict)
 
-        root = etree.fromstring(api_result)
-
-        bulletins_xml = root.findall('sb')
-
-        bulletins_list = list()
-
-        for bulletin in bulletins_xml:
-            bulletin_obj = Service_Bulletin(name = bulletin.find('nm').text,
-                                            subject = bulletin.find('sbj').text,
-                                            detail = bulletin.find('dtl').text,
-                                            brief = bulletin.find('brf').text,
-                                            priority = bulletin.find('prty').text)
-            for sb in bulletin.findall('srvc'):
-                route = None
-                direction = None
-                stop_num = None
-                stop_name = None
-
-
-                if (sb.find('rt') != None):
-                    route = sb.find('rt').text
-                if (sb.find('rtdir') != None):
-                    direction = sb.find('rtdir').text
-                if (sb.find('stpid') != None):
-                    stop_num = sb.find('stpid').text
-                if (sb.find('stpnm') != None):
-                    stop_name = sb.find('stpnm').text
-                    
-                bulletin_obj.append(route = route,
-                                    direction = direction,
-                                    stop_num = stop_num,
-                                    stop_name = stop_name)
-
-            bulletins_list.append(bulletin_obj)
-
-        return bulletins_list
+        return self.__decode(api_result, 'sb', \
+                             _bulletin_from_record, LazyBulletin, 'srvc')
         
 # BusTrackerObjects
 
@@ -668,7 +1684,8 @@ class Vehicle:
         self.heading = int(heading)
         self.pattern_id = int(pattern_id)
         self.pattern_distance = int(pattern_distance)
-        self.route = str(route)
+        self.route = symbol(route)
+        self.dest = symbol(dest)
         self.delayed = bool(delayed)
 
     def __str__(self):
@@ -710,8 +1727,9 @@ class Stop:
         """
         Creates a Route object
         """
-        self.stop_id = int(stop_id)
-        self.stop_name = str(stop_name)
+        # As with Pattern, stop ids from a GTFS feed can be any string
+        self.stop_id = _gtfs_id(str(stop_id))
+        self.stop_name = symbol(stop_name)
         self.lat = str(lat)
         self.long = str(long)
 
@@ -742,25 +1760,85 @@ class Pattern:
     # Direction this pattern travels in
     direction = str()
 
+    # Stops in the order they're served (see stop_index()), or None until
+    # they're needed
+    __stop_index = None
+
     def append(self, point):
         """
         Appends a point to this pattern
         """
-        # TODO: Might want to have this sort out the points every time?
         self.points.append(point)
+        # Points can come in any order; the stop index sorts them when
+        # it's rebuilt.
+        if (self.__stop_index != None):
+            self.__stop_index = None
         return
 
+    def stop_index(self):
+        """
+        Returns (distances, stops, offsets) for the stops on this pattern,
+        in the order they're served: stops is a list of the stop Points,
+        distances a sorted list of their pattern_distance, and offsets a
+        dict of str(stop_id) -> position in both.
+
+        This is built the first time it's needed and kept until append()
+        is called (points added to self.points directly aren't noticed).
+        """
+        if (self.__stop_index == None):
+            stops = [point for point in self.points \
+                     if (point.stop_id != None and point.pattern_distance != None)]
+            stops.sort(key = lambda point: (point.pattern_distance, point.seq))
+            offsets = dict()
+            for offset, point in enumerate(stops):
+                offsets.setdefault(str(point.stop_id), offset)
+            self.__stop_index = ([point.pattern_distance for point in stops], \
+                                 stops, offsets)
+        return self.__stop_index
+
+    def next_stops(self, distance, count = 1):
+        """
+        Returns the next count stop Points at or beyond distance (in feet
+        along the pattern, like Vehicle.pattern_distance).
+        """
+        distances, stops, offsets = self.stop_index()
+        start = bisect.bisect_left(distances, distance)
+        return stops[start:start + count]
+
+    def stop_offset(self, stop_id):
+        """
+        Returns the position of stop_id among the stops on this pattern (0
+        for the first), or None if the pattern doesn't serve it.
+        """
+        return self.stop_index()[2].get(str(stop_id))
+
+    def stop_distance(self, from_stop, to_stop):
+        """
+        Returns the distance in feet from stop_id from_stop to stop_id
+        to_stop (negative if to_stop comes first), or None if the pattern
+        doesn't serve both.
+        """
+        distances, stops, offsets = self.stop_index()
+        start = offsets.get(str(from_stop))
+        end = offsets.get(str(to_stop))
+        if (start == None or end == None):
+            return None
+        return distances[end] - distances[start]
+
 
     def __init__(self, pattern_id, length, direction, points = None):
         """
         Defines a patern. points can be a list of points, or None.
         """
-        self.pattern_id = int(pattern_id)
+        # Pattern ids from the API are numbers, but ones from a GTFS feed
+        # (see read_gtfs()) can be any string.
+        self.pattern_id = _gtfs_id(str(pattern_id))
         self.length = int(float(length)) # The API spec says this an int, but returns a float.
-        self.direction = str(direction)
+        self.direction = normalize_direction(direction)
+        self.points = list()
         if (points != None):
             for point in points:
-                self.append(points)
+                self.append(point)
 
         return
 
@@ -810,9 +1888,9 @@ class Point(Stop):
         else:
             self.stop_id = None
         if (stop_name != None):
-            self.stop_name = str(stop_name)
+            self.stop_name = symbol(stop_name)
         else:
-            self.stop_id = None
+            self.stop_name = None
 
         if (pattern_distance != None):
             self.pattern_distance = float(pattern_distance)
@@ -858,6 +1936,9 @@ class Prediction:
     # predicted_eta is the time that the bus is scheduled to arrive
     predicted_eta = None
 
+    # predicted_eta_epoch is predicted_eta in seconds since the epoch
+    predicted_eta_epoch = float()
+
     # mins_to_arrival_at_init is the number of minutes that
     # the bus is scheduled to arrive at, at instantiation of this object
     # based on the time the prediction was generated by the remote API
@@ -875,28 +1956,23 @@ class Prediction:
         otherwise, matches difference against specified time.
         """
 
-        if (ctatime == None):
-            ctatime = time.localtime()
-
-        elif (type(ctatime) == str):
-            # Presuming this is a human-readable time string as 
-            # returned from the API
-            ctatime == convert_time(ctatime)
-
-        eta_seconds = time.mktime(self.predicted_eta) - time.mktime(ctatime)
+        # ctatime may also be a human-readable time string as
+        # returned from the API (see to_epoch())
+        eta_seconds = self.predicted_eta_epoch - to_epoch(ctatime)
         return int(eta_seconds/60)
 
     def __init__(self, timestamp, prediction_type, stop_id, stop_name, vehicle_id, distance_to_stop, route, route_dir, destination, predicted_eta, delayed = False):
         self.timestamp  = convert_time(timestamp)
         self.prediction_type = str(prediction_type)
         self.stop_id = int(stop_id)
-        self.stop_name = str(stop_name)
+        self.stop_name = symbol(stop_name)
         self.vehicle_id = int(vehicle_id)
         self.distance_to_stop = int(distance_to_stop)
-        self.route = str(route)
-        self.route_dir = str(route_dir)
-        self.destination = str(destination)
+        self.route = symbol(route)
+        self.route_dir = normalize_direction(route_dir)
+        self.destination = symbol(destination)
         self.predicted_eta = convert_time(predicted_eta)
+        self.predicted_eta_epoch = time.mktime(self.predicted_eta)
         self.delayed = bool(delayed)
         self.mins_to_arrival_at_init = self.estimated_time_to_arrival(self.timestamp)
         return
@@ -962,15 +2038,32 @@ class Service_Bulletin:
         self.affected_services.append(new_sb)
         return
 
-    def __init__(self, name, subject, detail, brief, priority, affected_services = []):
+    def __init__(self, name, subject, detail, brief, priority, affected_services = None):
         self.name = str(name)
         self.subject = str(subject)
         self.detail = str(detail)
         self.brief = str(brief)
         self.priority = str(priority)
+        self.affected_services = list()
+        if (affected_services != None):
+            self.affected_services.extend(affected_services)
 
         return
 
+    def content_hash(self):
+        """
+        Returns a hex digest of everything in this bulletin, including
+        the affected services.  Two bulletins with the same hash say the
+        same thing.
+        """
+        import hashlib
+        content = [self.name, self.subject, self.detail, self.brief, \
+                   self.priority]
+        for service in self.affected_services:
+            content.extend((service.route, service.direction, \
+                            service.stop_num, service.stop_name))
+        return hashlib.sha1(repr(content).encode("utf-8")).hexdigest()
+
     def __str__(self):
         return_str = "SERVICE BULLETIN: \
                 \nName: %s \
@@ -1010,12 +2103,12 @@ class SB_Service:
         log.debug("route in init: " + str(route))
 
         if (route != None):
-            self.route = str(route)
+            self.route = symbol(route)
         else:
             self.route = None
 
         if (direction != None):
-            self.direction = str(direction)
+            self.direction = normalize_direction(direction)
         else:
             self.direction = None
 
@@ -1024,7 +2117,7 @@ class SB_Service:
         else:
             self.stop_num = None
 
-        self.stop_name = str(stop_name)
+        self.stop_name = symbol(stop_name)
 
     def __str__(self):
         return "AFFECTED SERVICE:" +\
@@ -1033,6 +2126,1786 @@ class SB_Service:
                 \nStop number: %s \
                 \nStop name: %s" % (self.route, self.direction, self.stop_num, self.stop_name)
 
+# Static network catalog
+
+class RouteCatalog:
+    """
+    A catalog of the static parts of the network: routes, directions,
+    stops and patterns.
+
+    Nothing is fetched until it's asked for.  Asking for a route's stops
+    or patterns only fetches that route; preload() fetches the whole
+    network with concurrent requests (up to workers at a time), which is
+    much faster than walking getroutes -> getroute_directions ->
+    getroute_stops -> getpatterns_rt one request at a time.
+
+    Data is kept as plain tuples, and Stop and Pattern objects are only
+    built (once) per route when they're first accessed.
+    """
+
+    def __init__(self, tracker, workers = 8):
+        """
+        tracker is a ctabustracker object used for fetching, in "objects"
+        or "lazy" mode.  It can be None for a catalog filled from GTFS with
+        load_gtfs().
+        """
+        require_parsed_mode(tracker, "RouteCatalog")
+        self.tracker = tracker
+        self.workers = workers
+        self.__lock = threading.Lock()
+
+        # route -> route name
+        self.__routes = None
+        # route -> tuple of directions
+        self.__directions = dict()
+        # (route, direction) -> tuple of (stop_id, stop_name, lat, long)
+        self.__stops = dict()
+        # route -> {pattern_id: (pattern_id, length, direction, points)},
+        # points being a tuple of (seq, ptype, lat, long, stop_id,
+        # stop_name, pattern_distance)
+        self.__patterns = dict()
+        # Routes with every direction's stops and patterns fetched
+        self.__loaded = set()
+
+        # Materialized objects
+        self.__stop_objects = dict()
+        self.__pattern_objects = dict()
+        # pattern_id -> Pattern fetched on its own by pattern()
+        self.__pid_patterns = dict()
+        return
+
+    def routes(self):
+        """
+        Returns a dict of route -> route name.
+        """
+        if (self.__routes == None):
+            routes = self.tracker.getroutes()
+            with self.__lock:
+                self.__routes = routes
+        return dict(self.__routes)
+
+    def directions(self, route):
+        """
+        Returns a tuple of the directions a route runs in.
+        """
+        route = str(route)
+        if (route not in self.__directions):
+            try:
+                directions = tuple(self.tracker.getroute_directions(route))
+            except NoDataError:
+                directions = tuple()
+            with self.__lock:
+                self.__directions[route] = directions
+        return self.__directions[route]
+
+    def stops(self, route, direction):
+        """
+        Returns a list of Stop objects for a route and direction.
+        """
+        route = str(route)
+        key = (route, normalize_direction(direction))
+        if (key not in self.__stop_objects):
+            if (key not in self.__stops):
+                self.__fetch_stops(key)
+            stops = [Stop(*stop) for stop in self.__stops[key]]
+            with self.__lock:
+                self.__stop_objects.setdefault(key, stops)
+        return self.__stop_objects[key]
+
+    def stop_tuples(self, route, direction):
+        """
+        Returns the stops for a route and direction as stored, without
+        building Stop objects: (stop_id, stop_name, lat, long) tuples.
+        """
+        key = (str(route), normalize_direction(direction))
+        if (key not in self.__stops):
+            self.__fetch_stops(key)
+        return self.__stops[key]
+
+    def pattern_tuples(self, route):
+        """
+        Returns the patterns for a route as stored, without building
+        Pattern objects: (pattern_id, length, direction, points) tuples,
+        points being (seq, ptype, lat, long, stop_id, stop_name,
+        pattern_distance) tuples.
+        """
+        route = str(route)
+        self.__load_route(route)
+        return list(self.__patterns.get(route, dict()).values())
+
+    def patterns(self, route):
+        """
+        Returns a list of Pattern objects for every direction of a route.
+        """
+        route = str(route)
+        if (route not in self.__pattern_objects):
+            self.__load_route(route)
+            patterns = list()
+            for pattern_id, length, direction, points in \
+                    self.__patterns.get(route, dict()).values():
+                pattern = Pattern(pattern_id, length, direction)
+                for point in points:
+                    pattern.append(Point(*point))
+                patterns.append(pattern)
+            with self.__lock:
+                self.__pattern_objects.setdefault(route, patterns)
+        return self.__pattern_objects[route]
+
+    def pattern(self, pattern_id):
+        """
+        Returns the Pattern with the given pattern_id.  Routes that have
+        already been loaded are searched first; otherwise the pattern is
+        fetched on its own with getpatterns_pid, and kept, so asking again
+        returns the same object.
+        """
+        pattern_id = _gtfs_id(str(pattern_id))
+        if (pattern_id in self.__pid_patterns):
+            return self.__pid_patterns[pattern_id]
+        for route in list(self.__patterns):
+            if (pattern_id in self.__patterns[route]):
+                for pattern in self.patterns(route):
+                    if (pattern.pattern_id == pattern_id):
+                        return pattern
+        try:
+            patterns = materialize_all(self.tracker.getpatterns_pid(pattern_id))
+        except NoDataError:
+            return None
+        for pattern in patterns:
+            if (pattern.pattern_id == pattern_id):
+                with self.__lock:
+                    return self.__pid_patterns.setdefault(pattern_id, pattern)
+        return None
+
+    def preload(self, routes = None):
+        """
+        Fetches stops and patterns for the given routes (or every route, if
+        routes is None) concurrently.  Nothing is materialized until it's
+        accessed.
+        """
+        if (routes == None):
+            routes = self.routes().keys()
+        routes = [str(route) for route in routes \
+                  if str(route) not in self.__loaded]
+
+        debug_start_time = time.time()
+        # Round one: directions for every route.
+        run_parallel(self.directions, routes, self.workers)
+        # Round two: stops and patterns for every route/direction.
+        jobs = list()
+        for route in routes:
+            for direction in self.__directions[route]:
+                jobs.append((self.__fetch_stops, (route, direction)))
+                jobs.append((self.__fetch_patterns, (route, direction)))
+        run_parallel(lambda job: job[0](job[1]), jobs, self.workers)
+
+        with self.__lock:
+            self.__loaded.update(routes)
+        log.info("Catalog preload of %s routes took %s" \
+                 % (len(routes), time.time() - debug_start_time))
+        return
+
+    def load_gtfs(self, source):
+        """
+        Fills the catalog from a GTFS feed (see read_gtfs()) instead of the
+        API.  Routes found in the feed are marked as loaded, so asking for
+        them won't make any requests.  Returns the number of routes loaded.
+        """
+        routes = dict()
+        directions = dict()
+        stops = dict()
+        patterns = dict()
+        for kind, record in read_gtfs(source):
+            if (kind == "route"):
+                routes[record[0]] = record[1]
+            elif (kind == "pattern"):
+                route, pattern = record
+                pattern_id, length, direction, points = pattern
+                patterns.setdefault(route, dict())[pattern_id] = pattern
+                route_directions = directions.setdefault(route, list())
+                if (direction not in route_directions):
+                    route_directions.append(direction)
+                # Stops for a route/direction are the stops its patterns
+                # serve.  They're kept the way Stop keeps them: the id as a
+                # number, the position as strings.
+                seen = stops.setdefault((route, direction), dict())
+                for seq, ptype, lat, long, stop_id, stop_name, distance in points:
+                    if (stop_id != None and stop_id not in seen):
+                        seen[stop_id] = (_gtfs_id(stop_id), stop_name, \
+                                         str(lat), str(long))
+
+        with self.__lock:
+            if (self.__routes == None):
+                self.__routes = dict()
+            self.__routes.update(routes)
+            for route in routes:
+                self.__directions[route] = tuple(directions.get(route, ()))
+                self.__patterns[route] = patterns.get(route, dict())
+                for direction in self.__directions[route]:
+                    self.__stops[(route, direction)] = \
+                            tuple(stops[(route, direction)].values())
+                self.__pattern_objects.pop(route, None)
+                for pattern_id in self.__patterns[route]:
+                    self.__pid_patterns.pop(pattern_id, None)
+            self.__stop_objects = dict((key, value) for key, value in \
+                    self.__stop_objects.items() if key[0] not in routes)
+            self.__loaded.update(routes)
+        return len(routes)
+
+    def __load_route(self, route):
+        """
+        Makes sure every direction of a single route is fetched.
+        """
+        if (route not in self.__loaded):
+            self.preload([route])
+        return
+
+    def __fetch_stops(self, key):
+        """
+        Fetches and stores stops for a (route, direction) key.
+        """
+        try:
+            stops = self.tracker.getroute_stops(*key)
+        except NoDataError:
+            stops = list()
+        stops = tuple((stop.stop_id, stop.stop_name, stop.lat, stop.long) \
+                      for stop in stops)
+        with self.__lock:
+            self.__stops[key] = stops
+        return
+
+    def __fetch_patterns(self, key):
+        """
+        Fetches and stores the patterns for a (route, direction) key.
+        """
+        try:
+            fetched = self.tracker.getpatterns_rt(*key)
+        except NoDataError:
+            fetched = list()
+        patterns = dict()
+        for pattern in fetched:
+            points = tuple((point.seq, point.ptype, point.lat, point.long, \
+                            point.stop_id, point.stop_name, \
+                            point.pattern_distance) \
+                           for point in pattern.points)
+            patterns[pattern.pattern_id] = (pattern.pattern_id, \
+                    pattern.length, pattern.direction, points)
+        with self.__lock:
+            self.__patterns.setdefault(key[0], dict()).update(patterns)
+        return
+
+# Fleet-wide stop queries
+# These answer "where is each bus going next" and "what's coming to this
+# stop" for a whole list of vehicles at once, using each Pattern's stop
+# index (see Pattern.stop_index()).
+
+def _pattern_getter(patterns):
+    """
+    Returns a function that looks up a Pattern by pattern id in patterns:
+    a RouteCatalog, a dict of pattern id -> Pattern, or a list of Patterns.
+    """
+    if (isinstance(patterns, RouteCatalog)):
+        return patterns.pattern
+    if (not isinstance(patterns, dict)):
+        patterns = dict((pattern.pattern_id, pattern) for pattern in patterns)
+    return patterns.get
+
+def next_stops_for_vehicles(vehicles, patterns, count = 1):
+    """
+    Returns a dict of vehicle_id -> list of the next count stop Points of
+    each of vehicles (Vehicle or LazyVehicle objects), from their pattern
+    in patterns (see _pattern_getter()).  Vehicles whose pattern isn't
+    found get an empty list.
+    """
+    get_pattern = _pattern_getter(patterns)
+    by_pattern = dict()
+    for vehicle in vehicles:
+        by_pattern.setdefault(vehicle.pattern_id, list()).append(vehicle)
+
+    results = dict()
+    for pattern_id, group in by_pattern.items():
+        pattern = get_pattern(pattern_id)
+        if (pattern == None):
+            for vehicle in group:
+                results[vehicle.vehicle_id] = list()
+            continue
+        distances, stops, offsets = pattern.stop_index()
+        for vehicle in group:
+            start = bisect.bisect_left(distances, vehicle.pattern_distance)
+            results[vehicle.vehicle_id] = stops[start:start + count]
+    return results
+
+def vehicles_approaching_stop(vehicles, stop_id, patterns, max_distance = None):
+    """
+    Returns a list of (distance, vehicle) for each of vehicles that still
+    has stop_id ahead of it on its pattern (looked up in patterns, see
+    _pattern_getter()), nearest first.  distance is in feet along the
+    pattern; vehicles further than max_distance are left out.
+    """
+    get_pattern = _pattern_getter(patterns)
+    # pattern id -> distance of stop_id along it, or None
+    stop_distances = dict()
+    results = list()
+    for vehicle in vehicles:
+        pattern_id = vehicle.pattern_id
+        if (pattern_id not in stop_distances):
+            pattern = get_pattern(pattern_id)
+            offset = None
+            if (pattern != None):
+                offset = pattern.stop_offset(stop_id)
+            if (offset == None):
+                stop_distances[pattern_id] = None
+            else:
+                stop_distances[pattern_id] = pattern.stop_index()[0][offset]
+        stop_distance = stop_distances[pattern_id]
+        if (stop_distance == None):
+            continue
+        distance = stop_distance - vehicle.pattern_distance
+        if (distance >= 0 and (max_distance == None or distance <= max_distance)):
+            results.append((distance, vehicle))
+    results.sort(key = lambda result: result[0])
+    return results
+
+# GTFS export and import
+# The static network (routes, stops and patterns) can be written out as, and
+# read back from, a GTFS feed:
+#   routes.txt - one row per route
+#   stops.txt - one row per stop
+#   trips.txt - one row per pattern (trip_id and shape_id are the pattern id;
+#               extra direction_name and pattern_length columns hold the
+#               API's direction and the pattern's length)
+#   shapes.txt - every point of every pattern
+#   stop_times.txt - the stop points of every pattern, without times
+# This describes the network, not a schedule, so there's no calendar.txt.
+
+GTFS_AGENCY = ("CTA", "Chicago Transit Authority", \
+               "http://www.transitchicago.com", "America/Chicago")
+
+GTFS_COLUMNS = {
+    "agency.txt": ("agency_id", "agency_name", "agency_url", "agency_timezone"),
+    "routes.txt": ("route_id", "agency_id", "route_short_name", \
+                   "route_long_name", "route_type"),
+    "stops.txt": ("stop_id", "stop_name", "stop_lat", "stop_lon"),
+    "trips.txt": ("route_id", "service_id", "trip_id", "shape_id", \
+                  "direction_id", "direction_name", "pattern_length"),
+    "shapes.txt": ("shape_id", "shape_pt_lat", "shape_pt_lon", \
+                   "shape_pt_sequence", "shape_dist_traveled"),
+    "stop_times.txt": ("trip_id", "arrival_time", "departure_time", "stop_id", \
+                       "stop_sequence", "shape_dist_traveled"),
+}
+
+# route_type for buses
+GTFS_BUS = 3
+
+
+class GTFSWriter:
+    """
+    Writes routes, Stops and Patterns out as a GTFS feed, a row at a time.
+
+    target is a directory, or a path ending in .zip.  Rows go straight to
+    disk (one file per table; for a zip they're written to a temporary
+    directory and zipped on close()), so nothing is held in memory but the
+    set of stop ids already written.
+    """
+
+    def __init__(self, target):
+        import os
+        import tempfile
+        self.target = target
+        self.__zip = target.lower().endswith(".zip")
+        if (self.__zip):
+            self.__directory = tempfile.mkdtemp()
+        else:
+            self.__directory = target
+            if (not os.path.isdir(target)):
+                os.makedirs(target)
+        self.__files = dict()
+        self.__writers = dict()
+        for name, columns in GTFS_COLUMNS.items():
+            handle = _gtfs_open(os.path.join(self.__directory, name), "w")
+            self.__files[name] = handle
+            self.__writers[name] = _GTFSTableWriter(handle)
+            self.__writers[name].writerow(columns)
+        self.__writers["agency.txt"].writerow(GTFS_AGENCY)
+        self.__stop_ids = set()
+        self.__pattern_ids = set()
+        self.__directions = dict()
+
+    def write_route(self, route, name):
+        """
+        Writes a route, e.g. from the dict returned by getroutes().
+        """
+        self.__writers["routes.txt"].writerow((route, GTFS_AGENCY[0], route, \
+                                               name, GTFS_BUS))
+
+    def write_stop(self, stop):
+        """
+        Writes a Stop (or the stop of a Point), once per stop id.
+        """
+        if (stop.stop_id == None or str(stop.stop_id) in self.__stop_ids):
+            return
+        self.__stop_ids.add(str(stop.stop_id))
+        self.__writers["stops.txt"].writerow((stop.stop_id, stop.stop_name, \
+                                              stop.lat, stop.long))
+
+    def write_pattern(self, route, pattern):
+        """
+        Writes a Pattern of route, with its stops, once per pattern id.
+        """
+        if (pattern.pattern_id in self.__pattern_ids):
+            return
+        self.__pattern_ids.add(pattern.pattern_id)
+        directions = self.__directions.setdefault(route, list())
+        if (pattern.direction not in directions):
+            directions.append(pattern.direction)
+        self.__writers["trips.txt"].writerow((route, "ctabustracker", \
+                pattern.pattern_id, pattern.pattern_id, \
+                directions.index(pattern.direction) % 2, pattern.direction, \
+                pattern.length))
+        shapes = self.__writers["shapes.txt"]
+        stop_times = self.__writers["stop_times.txt"]
+        for point in pattern.points:
+            shapes.writerow((pattern.pattern_id, point.lat, point.long, \
+                             point.seq, _gtfs_optional(point.pattern_distance)))
+            if (point.stop_id != None):
+                self.write_stop(point)
+                stop_times.writerow((pattern.pattern_id, "", "", point.stop_id, \
+                                     point.seq, \
+                                     _gtfs_optional(point.pattern_distance)))
+
+    def close(self):
+        """
+        Finishes the feed.  For a zip, this is when it is written.
+        """
+        for handle in self.__files.values():
+            handle.close()
+        if (self.__zip):
+            import os
+            import shutil
+            import zipfile
+            try:
+                archive = zipfile.ZipFile(self.target, "w", zipfile.ZIP_DEFLATED)
+                try:
+                    for name in sorted(self.__files):
+                        archive.write(os.path.join(self.__directory, name), name)
+                finally:
+                    archive.close()
+            finally:
+                shutil.rmtree(self.__directory, True)
+
+
+class _GTFSTableWriter:
+    """
+    A csv writer for one GTFS table, opened with _gtfs_open().  Python 2's
+    csv module only writes byte strings, so there text is encoded first.
+    """
+
+    def __init__(self, handle):
+        import csv
+        self.__writer = csv.writer(handle)
+
+    def writerow(self, row):
+        if (bytes is str):
+            row = [value.encode("utf-8") if isinstance(value, type(u"")) \
+                   else value for value in row]
+        self.__writer.writerow(row)
+
+
+def _gtfs_open(path, mode):
+    """
+    Opens a GTFS table (UTF-8 CSV) for the csv module in mode "r" or "w":
+    as text on Python 3, and as bytes on Python 2, whose csv module only
+    handles byte strings.
+    """
+    import io
+    if (bytes is str):
+        return io.open(path, mode + "b")
+    return io.open(path, mode, newline = "", \
+                   encoding = "utf-8-sig" if mode == "r" else "utf-8")
+
+def _gtfs_optional(value):
+    if (value == None):
+        return ""
+    return value
+
+def _gtfs_id(value):
+    """
+    Returns a GTFS id as the API would have it: a number if it is one.
+    GTFS ids can be any string, so other ids are kept as they are.
+    """
+    if (value.isdigit()):
+        return int(value)
+    return value
+
+# Stand-ins for Stop, Point and Pattern over a RouteCatalog's stored tuples,
+# with the attributes GTFSWriter reads
+_GTFSStop = collections.namedtuple("_GTFSStop", "stop_id stop_name lat long")
+_GTFSPoint = collections.namedtuple("_GTFSPoint", \
+        "seq ptype lat long stop_id stop_name pattern_distance")
+_GTFSPattern = collections.namedtuple("_GTFSPattern", \
+        "pattern_id length direction points")
+
+def export_gtfs(catalog, target, routes = None):
+    """
+    Writes the routes in a RouteCatalog (all of them, if routes is None)
+    to a GTFS feed at target (see GTFSWriter).  Routes the catalog doesn't
+    have yet are preloaded first.  Rows are written straight from the
+    catalog's stored tuples, so no Stop or Pattern objects are built or
+    left behind in the catalog.
+    """
+    if (routes == None):
+        routes = sorted(catalog.routes())
+    names = catalog.routes()
+    catalog.preload(routes)
+    writer = GTFSWriter(target)
+    try:
+        for route in routes:
+            route = str(route)
+            writer.write_route(route, names.get(route, route))
+            directions = catalog.directions(route)
+            for direction in directions:
+                for stop in catalog.stop_tuples(route, direction):
+                    writer.write_stop(_GTFSStop._make(stop))
+            # In the route's direction order, so direction_id (and the
+            # order load_gtfs() finds directions in) follows it
+            patterns = sorted(catalog.pattern_tuples(route), key = \
+                    lambda pattern: (directions.index(pattern[2]) \
+                                     if pattern[2] in directions else \
+                                     len(directions), str(pattern[0])))
+            for pattern_id, length, direction, points in patterns:
+                writer.write_pattern(route, _GTFSPattern(pattern_id, length, \
+                        direction, [_GTFSPoint._make(point) for point in points]))
+    finally:
+        writer.close()
+
+def _gtfs_rows(source, name, columns):
+    """
+    Yields the rows of one GTFS table as tuples of the given columns ("" for
+    columns the table doesn't have).  source is a directory or a zip file.
+    Yields nothing if the table isn't there.
+    """
+    import csv
+    import io
+    import os
+    if (os.path.isdir(source)):
+        path = os.path.join(source, name)
+        if (not os.path.exists(path)):
+            return
+        handle = _gtfs_open(path, "r")
+    else:
+        import zipfile
+        archive = zipfile.ZipFile(source)
+        if (name not in archive.namelist()):
+            archive.close()
+            return
+        handle = archive.open(name)
+        if (bytes is not str):
+            handle = io.TextIOWrapper(handle, encoding = "utf-8-sig", \
+                                      newline = "")
+    try:
+        reader = csv.reader(handle)
+        if (bytes is str):
+            # Python 2's csv module reads byte strings
+            reader = ([cell.decode("utf-8-sig") for cell in row] \
+                      for row in reader)
+        header = [column.strip() for column in next(reader, [])]
+        indexes = [header.index(column) if column in header else None \
+                   for column in columns]
+        if (None not in indexes):
+            import operator
+            pick = operator.itemgetter(*indexes)
+            for row in reader:
+                if (row):
+                    yield pick(row)
+        else:
+            for row in reader:
+                if (row):
+                    yield tuple("" if index == None else row[index] \
+                                for index in indexes)
+    finally:
+        handle.close()
+
+def read_gtfs(source):
+    """
+    Reads routes and patterns out of a GTFS feed (a directory or a zip), as
+    written by GTFSWriter or published by the CTA.  Yields:
+        ("route", (route, route name))
+        ("pattern", (route, (pattern_id, length, direction, points)))
+    points being (seq, ptype, lat, long, stop_id, stop_name,
+    pattern_distance) tuples, the same form RouteCatalog stores.  As with
+    the API, point stop ids are strings and pattern ids are numbers (for
+    shape ids that are numbers; others are kept as strings).
+
+    Only one trip per shape is read from stop_times.txt and shapes.txt is
+    streamed a shape at a time, so memory stays proportional to the number
+    of stops and patterns, not the size of the schedule.
+    """
+    for route, short_name, long_name in _gtfs_rows(source, "routes.txt", \
+            ("route_id", "route_short_name", "route_long_name")):
+        yield ("route", (route, long_name or short_name))
+
+    stops = dict()
+    for stop_id, name, lat, long in _gtfs_rows(source, "stops.txt", \
+            ("stop_id", "stop_name", "stop_lat", "stop_lon")):
+        stops[stop_id] = (name, float(lat), float(long))
+
+    # shape_id -> (route, direction, length), from the first trip per shape
+    shapes = dict()
+    # trip_id -> shape_id, for those trips
+    trips = dict()
+    for route, trip_id, shape_id, direction_id, direction_name, length in \
+            _gtfs_rows(source, "trips.txt", ("route_id", "trip_id", \
+                       "shape_id", "direction_id", "direction_name", \
+                       "pattern_length")):
+        if (shape_id and shape_id not in shapes):
+            shapes[shape_id] = (route, \
+                    normalize_direction(direction_name or direction_id), length)
+            trips[trip_id] = shape_id
+
+    # shape_id -> {stop_sequence: (stop_id, shape_dist_traveled)}
+    shape_stops = dict()
+    for trip_id, stop_id, seq, distance in _gtfs_rows(source, \
+            "stop_times.txt", ("trip_id", "stop_id", "stop_sequence", \
+                               "shape_dist_traveled")):
+        shape_id = trips.get(trip_id)
+        if (shape_id != None):
+            shape_stops.setdefault(shape_id, dict())[int(seq)] = \
+                    (stop_id, float(distance) if distance else None)
+
+    def build(shape_id, shape_points):
+        route, direction, length = shapes.get(shape_id, (None, "", ""))
+        if (route == None):
+            return None
+        stop_points = shape_stops.get(shape_id, dict())
+        points = list()
+        for seq, lat, long, distance in shape_points:
+            stop = stop_points.pop(seq, None)
+            if (stop == None):
+                points.append((seq, "Waypoint", lat, long, None, None, distance))
+            else:
+                name = stops.get(stop[0], (None,))[0]
+                points.append((seq, "Stop", lat, long, stop[0], name, \
+                               stop[1] if stop[1] != None else distance))
+        # Stops whose sequence numbers don't line up with the shape's (as
+        # in schedule feeds) are placed by distance travelled.
+        for seq, (stop_id, distance) in stop_points.items():
+            name, lat, long = stops.get(stop_id, (None, None, None))
+            if (lat != None):
+                points.append((seq, "Stop", lat, long, stop_id, name, distance))
+        if (stop_points):
+            points.sort(key = lambda point: (point[6] == None, point[6], point[0]))
+        if (length):
+            length = int(float(length))
+        else:
+            distances = [point[6] for point in points if point[6] != None]
+            length = int(max(distances)) if distances else 0
+        return ("pattern", (route, (_gtfs_id(shape_id), length, direction, \
+                                    tuple(points))))
+
+    # shapes.txt is normally grouped by shape_id; build each pattern as soon
+    # as its shape ends.
+    current = None
+    current_points = list()
+    for shape_id, lat, long, seq, distance in _gtfs_rows(source, \
+            "shapes.txt", ("shape_id", "shape_pt_lat", "shape_pt_lon", \
+                           "shape_pt_sequence", "shape_dist_traveled")):
+        if (shape_id != current):
+            if (current != None):
+                pattern = build(current, current_points)
+                if (pattern != None):
+                    yield pattern
+            current = shape_id
+            current_points = list()
+        current_points.append((int(seq), float(lat), float(long), \
+                               float(distance) if distance else None))
+    if (current != None):
+        pattern = build(current, current_points)
+        if (pattern != None):
+            yield pattern
+
+# GTFS-Realtime feed
+# Vehicles and Predictions are encoded straight into GTFS-Realtime protocol
+# buffers (VehiclePositions and TripUpdates), without needing the protobuf
+# library.  Only the fields the Bus Tracker API can fill are written.
+
+def _pb_varint(value):
+    """
+    Encodes a non-negative integer as a protobuf varint.
+    """
+    out = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if (value):
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+def _pb_uint(field, value):
+    return _pb_varint(field << 3) + _pb_varint(int(value))
+
+def _pb_bytes(field, value):
+    if (not isinstance(value, bytes)):
+        value = str(value).encode("utf-8")
+    return _pb_varint((field << 3) | 2) + _pb_varint(len(value)) + value
+
+def _pb_float(field, value):
+    return _pb_varint((field << 3) | 5) + struct.pack("<f", float(value))
+
+# FeedHeader.incrementality
+GTFS_RT_FULL_DATASET = 0
+GTFS_RT_DIFFERENTIAL = 1
+
+
+class GTFSRealtimeFeed:
+    """
+    Builds GTFS-Realtime feeds from polled Vehicles and Predictions.
+
+    Each poll's results are handed to update_vehicles() or
+    update_predictions().  Every vehicle becomes a VehiclePosition entity
+    ("vehicle-<vehicle_id>") and every vehicle with predictions a
+    TripUpdate entity ("trip-<vehicle_id>").  Entities are encoded when
+    they change, and unchanged entities reuse their encoded bytes, so a
+    poll only costs as much as what changed.
+
+    Every update that changes something bumps version.  full_feed()
+    returns the whole feed (built once per version, however many
+    consumers ask), and differential_feed(since) returns just the entities
+    changed or deleted after version since.
+    """
+
+    def __init__(self, max_tombstones = 10000, differential_cache = 16):
+        """
+        Deleted entities are remembered (for differential feeds) up to
+        max_tombstones; consumers further behind get a full feed.  Up to
+        differential_cache differential feeds are kept for reuse.
+        """
+        self.version = 0
+        self.max_tombstones = max_tombstones
+        self.differential_cache = differential_cache
+        self.__lock = threading.Lock()
+        self.__timestamp = 0
+        self.__changed = False
+        # entity id -> (signature, encoded FeedEntity field, version)
+        self.__entities = dict()
+        # entity id -> version it was deleted in
+        self.__tombstones = collections.OrderedDict()
+        # Oldest version a differential feed can be built from
+        self.__horizon = 0
+        # vehicle_id -> route, for vehicles with a position
+        self.__vehicle_routes = dict()
+        # vehicle_id -> {stop_id: prediction tuple}
+        self.__predictions = dict()
+        self.__full = None
+        self.__differentials = collections.OrderedDict()
+        self.stats = dict.fromkeys(("encoded", "reused", "deleted", \
+                                    "full_built", "full_reused", \
+                                    "differential_built", \
+                                    "differential_reused"), 0)
+
+    def update_vehicles(self, vehicles, routes = None):
+        """
+        Updates VehiclePositions from a list of Vehicle objects.
+
+        If routes is given (the routes that were polled), vehicles
+        previously on those routes but missing from this list are deleted.
+        """
+        with self.__lock:
+            seen = set()
+            for vehicle in vehicles:
+                seen.add(vehicle.vehicle_id)
+                self.__vehicle_routes[vehicle.vehicle_id] = vehicle.route
+                timestamp = int(time.mktime(vehicle.timestamp))
+                signature = (vehicle.route, vehicle.lat, vehicle.long, \
+                             vehicle.heading, timestamp)
+                self.__put("vehicle-%s" % vehicle.vehicle_id, signature, \
+                           lambda: self.__encode_vehicle(vehicle, timestamp))
+            if (routes != None):
+                routes = set(str(route) for route in routes)
+                for vehicle_id, route in list(self.__vehicle_routes.items()):
+                    if (route in routes and vehicle_id not in seen):
+                        del self.__vehicle_routes[vehicle_id]
+                        self.__delete("vehicle-%s" % vehicle_id)
+            self.__finish()
+
+    def update_predictions(self, predictions, stop_ids = None):
+        """
+        Updates TripUpdates from a list of Prediction objects.
+
+        If stop_ids is given (the stops that were polled), predictions
+        previously kept for those stops but missing from this list are
+        dropped.
+        """
+        with self.__lock:
+            changed = set()
+            if (stop_ids != None):
+                stop_ids = set(int(stop_id) for stop_id in stop_ids)
+                for vehicle_id, stops in self.__predictions.items():
+                    for stop_id in stop_ids.intersection(stops):
+                        del stops[stop_id]
+                        changed.add(vehicle_id)
+            for prediction in predictions:
+                stops = self.__predictions.setdefault(prediction.vehicle_id, dict())
+                stops[prediction.stop_id] = (int(prediction.predicted_eta_epoch), \
+                        prediction.prediction_type, prediction.route, \
+                        int(time.mktime(prediction.timestamp)))
+                changed.add(prediction.vehicle_id)
+
+            for vehicle_id in changed:
+                stops = self.__predictions.get(vehicle_id)
+                if (not stops):
+                    self.__predictions.pop(vehicle_id, None)
+                    self.__delete("trip-%s" % vehicle_id)
+                    continue
+                signature = tuple(sorted(stops.items()))
+                self.__put("trip-%s" % vehicle_id, signature, \
+                           lambda: self.__encode_trip(vehicle_id, signature))
+            self.__finish()
+
+    def full_feed(self):
+        """
+        Returns (version, feed), feed being an encoded FULL_DATASET
+        FeedMessage.
+        """
+        with self.__lock:
+            return self.__full_feed()
+
+    def __full_feed(self):
+        if (self.__full == None or self.__full[0] != self.version):
+            body = self.__header(GTFS_RT_FULL_DATASET) + \
+                   b"".join(entity[1] for entity in self.__entities.values())
+            self.__full = (self.version, body)
+            self.stats["full_built"] += 1
+        else:
+            self.stats["full_reused"] += 1
+        return self.__full
+
+    def differential_feed(self, since):
+        """
+        Returns (version, feed), feed being an encoded DIFFERENTIAL
+        FeedMessage with the entities changed or deleted after version
+        since.  If since is too old to know what was deleted, a full feed
+        is returned instead.
+        """
+        with self.__lock:
+            if (since < self.__horizon):
+                return self.__full_feed()
+            key = (since, self.version)
+            cached = self.__differentials.get(key)
+            if (cached != None):
+                self.stats["differential_reused"] += 1
+                return (self.version, cached)
+            parts = [self.__header(GTFS_RT_DIFFERENTIAL)]
+            for signature, encoded, version in self.__entities.values():
+                if (version > since):
+                    parts.append(encoded)
+            for entity_id, version in self.__tombstones.items():
+                if (version > since):
+                    parts.append(_pb_bytes(2, _pb_bytes(1, entity_id) + \
+                                              _pb_uint(2, 1)))
+            body = b"".join(parts)
+            self.__differentials[key] = body
+            while (len(self.__differentials) > self.differential_cache):
+                self.__differentials.popitem(last = False)
+            self.stats["differential_built"] += 1
+            return (self.version, body)
+
+    def __put(self, entity_id, signature, encode):
+        """
+        Stores an entity, encoding it only if its signature changed.
+        """
+        existing = self.__entities.get(entity_id)
+        if (existing != None and existing[0] == signature):
+            self.stats["reused"] += 1
+            return
+        self.__changed = True
+        self.__tombstones.pop(entity_id, None)
+        self.__entities[entity_id] = (signature, \
+                _pb_bytes(2, _pb_bytes(1, entity_id) + encode()), \
+                self.version + 1)
+        self.stats["encoded"] += 1
+
+    def __delete(self, entity_id):
+        if (self.__entities.pop(entity_id, None) == None):
+            return
+        self.__changed = True
+        self.__tombstones.pop(entity_id, None)
+        self.__tombstones[entity_id] = self.version + 1
+        while (len(self.__tombstones) > self.max_tombstones):
+            entity_id, version = self.__tombstones.popitem(last = False)
+            self.__horizon = max(self.__horizon, version)
+        self.stats["deleted"] += 1
+
+    def __finish(self):
+        """
+        Bumps the version if the update just made changed anything.
+        """
+        if (self.__changed):
+            self.version += 1
+            self.__timestamp = int(time.time())
+            self.__changed = False
+
+    def __header(self, incrementality):
+        return _pb_bytes(1, _pb_bytes(1, "2.0") + \
+                            _pb_uint(2, incrementality) + \
+                            _pb_uint(3, self.__timestamp))
+
+    def __encode_vehicle(self, vehicle, timestamp):
+        """
+        Returns the FeedEntity.vehicle field for a Vehicle.
+        """
+        position = _pb_float(1, vehicle.lat) + _pb_float(2, vehicle.long) + \
+                   _pb_float(3, vehicle.heading)
+        descriptor = _pb_bytes(1, vehicle.vehicle_id) + \
+                     _pb_bytes(2, vehicle.vehicle_id)
+        return _pb_bytes(4, _pb_bytes(1, _pb_bytes(5, vehicle.route)) + \
+                            _pb_bytes(2, position) + \
+                            _pb_uint(5, timestamp) + \
+                            _pb_bytes(8, descriptor))
+
+    def __encode_trip(self, vehicle_id, stops):
+        """
+        Returns the FeedEntity.trip_update field for a vehicle's
+        predictions, stops being sorted (stop_id, prediction tuple) pairs.
+        """
+        updates = list()
+        for stop_id, (eta, prediction_type, route, timestamp) in \
+                sorted(stops, key = lambda stop: stop[1][0]):
+            # StopTimeUpdate.arrival, or .departure for "D" predictions
+            event = 3 if prediction_type == "D" else 2
+            updates.append(_pb_bytes(2, _pb_bytes(event, _pb_uint(2, eta)) + \
+                                        _pb_bytes(4, stop_id)))
+        route = stops[0][1][2]
+        timestamp = max(stop[1][3] for stop in stops)
+        return _pb_bytes(3, _pb_bytes(1, _pb_bytes(5, route)) + \
+                            b"".join(updates) + \
+                            _pb_bytes(3, _pb_bytes(1, vehicle_id)) + \
+                            _pb_uint(4, timestamp))
+
+# Service bulletin index
+
+class BulletinIndex:
+    """
+    A local, deduplicated cache of service bulletins.
+
+    getbulletins_route() and getbulletins_stops() hand back a fresh copy of
+    a bulletin for every route or stop it's returned for.  BulletinIndex
+    keeps one Service_Bulletin per bulletin (by name, or by content hash
+    for bulletins without one), replacing it only when its content
+    changes, and indexes it by the routes, route/directions and stops it
+    affects.  Bulletins whose affected services name neither a route nor a
+    stop id (only a stop name, say) can't be indexed that way; they're
+    found through the route or stop they were returned for, when that was
+    the only one in its request.
+
+    refresh_routes() and refresh_stops() only query the routes and stops
+    that haven't been refreshed in the last ttl seconds, 10 per request,
+    and after that, for_routes() and for_stops() are local lookups.
+    """
+
+    def __init__(self, tracker, ttl = 60, workers = 4):
+        """
+        tracker is a ctabustracker object used for fetching, in "objects"
+        or "lazy" mode (lazy bulletins are materialized as they're added).
+        """
+        require_parsed_mode(tracker, "BulletinIndex")
+        self.tracker = tracker
+        self.ttl = ttl
+        self.workers = workers
+        self.__lock = threading.Lock()
+
+        # bulletin id -> (content hash, Service_Bulletin)
+        self.__bulletins = dict()
+        # Bulletins that list no affected services, so affect everything
+        self.__systemwide = set()
+        # route -> ids, (route, direction) -> ids, stop_id -> ids
+        self.__by_route = dict()
+        self.__by_route_dir = dict()
+        self.__by_stop = dict()
+        # Bulletins with affected services but no route or stop id in any
+        self.__unkeyed = set()
+        # ("rt", route) or ("stpid", stop_id) -> (refresh time, ids, exact),
+        # exact being True if the key was queried on its own, so every id
+        # is known to be for it
+        self.__queries = dict()
+        # ("rt", route) or ("stpid", stop_id) keys the API said are invalid;
+        # these aren't queried again.
+        self.invalid = set()
+        return
+
+    def bulletin_id(self, bulletin):
+        """
+        Returns the id a bulletin is stored under: its name, or its
+        content hash if it doesn't have one.
+        """
+        if (bulletin.name in (None, "", "None")):
+            return "#" + bulletin.content_hash()
+        return bulletin.name
+
+    def refresh_routes(self, *routes, **kwargs):
+        """
+        Refreshes bulletins for routes not refreshed in the last ttl
+        seconds (or all of them, with force = True).  Returns the number
+        of API requests made.
+        """
+        return self.__refresh("rt", [str(route) for route in routes], \
+                              self.tracker.getbulletins_route, \
+                              kwargs.get("force", False))
+
+    def refresh_stops(self, *stop_ids, **kwargs):
+        """
+        Refreshes bulletins for stops not refreshed in the last ttl
+        seconds (or all of them, with force = True).  Returns the number
+        of API requests made.
+        """
+        return self.__refresh("stpid", [int(stop) for stop in stop_ids], \
+                              self.tracker.getbulletins_stops, \
+                              kwargs.get("force", False))
+
+    def for_routes(self, routes, direction = None):
+        """
+        Returns the bulletins affecting any of routes (in direction, if
+        given), including system-wide bulletins.
+        """
+        if (direction != None):
+            direction = normalize_direction(direction)
+        with self.__lock:
+            ids = set(self.__systemwide)
+            for route in routes:
+                route = str(route)
+                if (direction == None):
+                    ids.update(self.__by_route.get(route, ()))
+                else:
+                    ids.update(self.__by_route_dir.get((route, direction), ()))
+                    # Bulletins for the whole route, in either direction
+                    ids.update(self.__by_route_dir.get((route, None), ()))
+                ids.update(self.__unkeyed_for(("rt", route)))
+            return self.__lookup(ids)
+
+    def for_stops(self, stop_ids):
+        """
+        Returns the bulletins affecting any of stop_ids, including
+        system-wide bulletins.
+        """
+        with self.__lock:
+            ids = set(self.__systemwide)
+            for stop in stop_ids:
+                stop = int(stop)
+                ids.update(self.__by_stop.get(stop, ()))
+                ids.update(self.__unkeyed_for(("stpid", stop)))
+            return self.__lookup(ids)
+
+    def bulletins(self):
+        """
+        Returns every bulletin in the index.
+        """
+        with self.__lock:
+            return self.__lookup(self.__bulletins)
+
+    def __lookup(self, ids):
+        return [self.__bulletins[bulletin_id][1] for bulletin_id in sorted(ids)]
+
+    def __unkeyed_for(self, query):
+        """
+        Returns the unindexable bulletins returned for query, if it was
+        made for that key alone.
+        """
+        refreshed = self.__queries.get(query)
+        if (refreshed == None or not refreshed[2]):
+            return ()
+        return self.__unkeyed.intersection(refreshed[1])
+
+    def __refresh(self, kind, keys, fetch, force):
+        """
+        Queries the stale keys in batches of 10 and replaces what's
+        indexed for each of them.
+        """
+        now = time.time()
+        stale = list()
+        for key in keys:
+            if ((kind, key) in self.invalid):
+                continue
+            refreshed = self.__queries.get((kind, key))
+            if (force or refreshed == None or now - refreshed[0] >= self.ttl):
+                if (key not in stale):
+                    stale.append(key)
+        batches = [stale[i:i + 10] for i in range(0, len(stale), 10)]
+
+        def fetch_batch(batch):
+            try:
+                bulletins = materialize_all(fetch(*batch))
+                errors = getattr(bulletins, "errors", ())
+            except APIError as e:
+                # Every key failed; e.errors has the reason for each
+                if (e.param == None and not isinstance(e, NoDataError)):
+                    raise
+                bulletins = list()
+                errors = e.errors
+            for error in errors:
+                if (not error.retry and error.param == kind):
+                    key = error.value if kind == "rt" else int(error.value)
+                    self.invalid.add((kind, key))
+            return bulletins
+
+        results = run_parallel(fetch_batch, batches, self.workers)
+
+        with self.__lock:
+            for batch, bulletins in zip(batches, results):
+                ids = set(self.__add(bulletin) for bulletin in bulletins)
+                # A batched response doesn't say which key each bulletin
+                # came back for.  The ids are kept with every key in the
+                # batch so the bulletins stay alive (see __collect()), but
+                # lookups go through the affected-service index.
+                for key in batch:
+                    self.__queries[(kind, key)] = (now, ids, len(batch) == 1)
+            self.__collect()
+        return len(batches)
+
+    def __add(self, bulletin):
+        """
+        Adds a bulletin to the index, unless an identical one is already
+        there.  Returns its id.
+        """
+        bulletin_id = self.bulletin_id(bulletin)
+        content_hash = bulletin.content_hash()
+        existing = self.__bulletins.get(bulletin_id)
+        if (existing != None):
+            if (existing[0] == content_hash):
+                return bulletin_id
+            self.__remove(bulletin_id)
+
+        self.__bulletins[bulletin_id] = (content_hash, bulletin)
+        if (not bulletin.affected_services):
+            self.__systemwide.add(bulletin_id)
+        elif (all(service.route == None and service.stop_num == None \
+                  for service in bulletin.affected_services)):
+            self.__unkeyed.add(bulletin_id)
+        for service in bulletin.affected_services:
+            if (service.route != None):
+                self.__by_route.setdefault(service.route, set()).add(bulletin_id)
+                self.__by_route_dir.setdefault((service.route, service.direction), \
+                                               set()).add(bulletin_id)
+            if (service.stop_num != None):
+                self.__by_stop.setdefault(service.stop_num, set()).add(bulletin_id)
+        return bulletin_id
+
+    def __remove(self, bulletin_id):
+        """
+        Drops a bulletin and its index entries.
+        """
+        content_hash, bulletin = self.__bulletins.pop(bulletin_id)
+        self.__systemwide.discard(bulletin_id)
+        self.__unkeyed.discard(bulletin_id)
+        for service in bulletin.affected_services:
+            for index, key in ((self.__by_route, service.route), \
+                               (self.__by_route_dir, (service.route, service.direction)), \
+                               (self.__by_stop, service.stop_num)):
+                ids = index.get(key)
+                if (ids != None):
+                    ids.discard(bulletin_id)
+                    if (not ids):
+                        del index[key]
+        return
+
+    def __collect(self):
+        """
+        Drops bulletins that are no longer returned for any route or stop.
+        """
+        referenced = set()
+        for refreshed in self.__queries.values():
+            referenced.update(refreshed[1])
+        for bulletin_id in list(self.__bulletins):
+            if (bulletin_id not in referenced):
+                self.__remove(bulletin_id)
+        return
+
+# Prediction accuracy tracking
+
+class QuantileSketch:
+    """
+    A bounded-memory, online quantile sketch.
+
+    Values are counted into fixed-width bins, and anything outside of
+    [-max_value, max_value] is clamped to the outermost bin, so memory never
+    exceeds (2 * max_value / bin_width + 1) counters no matter how many
+    values are added.  Quantiles are accurate to within one bin.
+    """
+
+    def __init__(self, bin_width = 15, max_value = 3600):
+        self.bin_width = bin_width
+        self.max_value = max_value
+        self.count = 0
+        self.total = 0.0
+        self.__max_bin = int(max_value // bin_width)
+        self.__bins = dict()
+
+    def add(self, value):
+        """
+        Adds a single value to the sketch.
+        """
+        bin_num = int(round(float(value) / self.bin_width))
+        if (bin_num > self.__max_bin):
+            bin_num = self.__max_bin
+        elif (bin_num < -self.__max_bin):
+            bin_num = -self.__max_bin
+        self.__bins[bin_num] = self.__bins.get(bin_num, 0) + 1
+        self.count += 1
+        self.total += value
+        return
+
+    def merge(self, other):
+        """
+        Merges the counts of another QuantileSketch (with the same bin
+        width) into this one.
+        """
+        for bin_num, bin_count in other.__bins.items():
+            self.__bins[bin_num] = self.__bins.get(bin_num, 0) + bin_count
+        self.count += other.count
+        self.total += other.total
+        return
+
+    def quantile(self, q):
+        """
+        Returns the approximate value at quantile q (0 <= q <= 1), or None
+        if nothing has been added yet.
+        """
+        if (self.count == 0):
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for bin_num in sorted(self.__bins):
+            seen += self.__bins[bin_num]
+            if (seen > rank):
+                return bin_num * self.bin_width
+        return max(self.__bins) * self.bin_width
+
+    def mean(self):
+        """
+        Returns the mean of all values added, or None if empty.
+        """
+        if (self.count == 0):
+            return None
+        return self.total / self.count
+
+    def __str__(self):
+        return "Samples: %s | Mean: %s | p10: %s | p50: %s | p90: %s" \
+                % (self.count, self.mean(), self.quantile(0.1), \
+                   self.quantile(0.5), self.quantile(0.9))
+
+
+class PredictionAccuracyTracker:
+    """
+    Measures how far Prediction.predicted_eta is from when the bus actually
+    shows up.
+
+    Feed it every list of Predictions (add_predictions()) and every list of
+    Vehicles (add_vehicles()) that you poll.  An arrival is detected when a
+    vehicle's pattern_distance crosses the pattern_distance of a predicted
+    stop between two polls, so the tracker needs the Pattern for each
+    vehicle's pattern_id (see add_pattern()).
+
+    Errors (actual arrival - predicted arrival, in seconds; positive means
+    the bus was late) are kept in QuantileSketch objects per route, per stop
+    and per prediction horizon (how far ahead the prediction was made), so
+    memory stays bounded while running against the whole network.
+    """
+
+    # Upper bounds (in minutes) of the prediction horizon buckets. Anything
+    # past the last bound lands in a final open-ended bucket.
+    DEFAULT_HORIZONS = (2, 5, 10, 15, 20, 30)
+
+    def __init__(self, patterns = None, horizons = DEFAULT_HORIZONS, \
+                 bin_width = 15, max_error = 3600, expiry = 1800, \
+                 max_pending = 100000):
+        """
+        patterns is an optional list of Pattern objects to start with.
+
+        bin_width and max_error (seconds) size the QuantileSketches.
+        Predictions that haven't been matched to an arrival expiry seconds
+        after their predicted_eta are dropped, and no more than max_pending
+        predictions are held at once.
+        """
+        self.horizons = tuple(horizons)
+        self.bin_width = bin_width
+        self.max_error = max_error
+        self.expiry = expiry
+        self.max_pending = max_pending
+
+        # pattern_id -> {stop_id: pattern_distance}
+        self.__stop_distances = dict()
+        # vehicle_id -> {stop_id: {timestamp: (predicted_eta, route)}}
+        self.__pending = dict()
+        self.__pending_count = 0
+        # vehicle_id -> (pattern_id, pattern_distance, timestamp)
+        self.__last_positions = dict()
+        # Latest vehicle timestamp seen; used as "now" for expiry.
+        self.__clock = None
+
+        self.route_errors = dict()
+        self.stop_errors = dict()
+        self.horizon_errors = dict()
+        self.arrivals_detected = 0
+        self.predictions_expired = 0
+        self.predictions_dropped = 0
+
+        if (patterns != None):
+            for pattern in patterns:
+                self.add_pattern(pattern)
+        return
+
+    def add_pattern(self, pattern):
+        """
+        Registers a Pattern, so arrivals can be detected for vehicles
+        running on it.
+        """
+        distances = dict()
+        for point in pattern.points:
+            if (point.stop_id != None and point.pattern_distance != None):
+                distances[int(point.stop_id)] = point.pattern_distance
+        self.__stop_distances[pattern.pattern_id] = distances
+        return
+
+    def has_pattern(self, pattern_id):
+        """
+        Returns True if a Pattern with pattern_id has been registered.
+        """
+        return int(pattern_id) in self.__stop_distances
+
+    def horizon_bucket(self, horizon_seconds):
+        """
+        Returns the label of the horizon bucket that horizon_seconds
+        falls in, e.g. "5-10" (minutes), or "30+" for the last bucket.
+        """
+        lower = 0
+        for upper in self.horizons:
+            if (horizon_seconds < upper * 60):
+                return "%s-%s" % (lower, upper)
+            lower = upper
+        return "%s+" % lower
+
+    def add_predictions(self, predictions):
+        """
+        Logs a list of Prediction objects.  The same prediction seen on
+        more than one poll (same vehicle, stop and timestamp) is only
+        logged once.
+        """
+        for prediction in predictions:
+            if (self.__pending_count >= self.max_pending):
+                self.predictions_dropped += 1
+                continue
+            timestamp = time.mktime(prediction.timestamp)
+            stops = self.__pending.setdefault(prediction.vehicle_id, dict())
+            logged = stops.setdefault(prediction.stop_id, dict())
+            if (timestamp not in logged):
+                logged[timestamp] = (prediction.predicted_eta_epoch, \
+                                     prediction.route)
+                self.__pending_count += 1
+        return
+
+    def add_vehicles(self, vehicles):
+        """
+        Checks a list of Vehicle objects for arrivals at predicted stops,
+        and records the prediction errors for any it finds.
+
+        Returns a list of (vehicle_id, stop_id, arrival_time) tuples for
+        the arrivals detected, arrival_time being in epoch seconds.
+        """
+        arrivals = list()
+        for vehicle in vehicles:
+            now = time.mktime(vehicle.timestamp)
+            if (self.__clock == None or now > self.__clock):
+                self.__clock = now
+
+            last = self.__last_positions.get(vehicle.vehicle_id)
+            self.__last_positions[vehicle.vehicle_id] = \
+                    (vehicle.pattern_id, vehicle.pattern_distance, now)
+
+            # Need two positions on the same pattern to see a crossing.
+            if (last == None or last[0] != vehicle.pattern_id):
+                continue
+            stops = self.__pending.get(vehicle.vehicle_id)
+            distances = self.__stop_distances.get(vehicle.pattern_id)
+            if (not stops or distances == None):
+                continue
+
+            last_distance, last_time = last[1], last[2]
+            for stop_id in list(stops):
+                stop_distance = distances.get(stop_id)
+                if (stop_distance == None):
+                    continue
+                if not (last_distance < stop_distance <= vehicle.pattern_distance):
+                    continue
+
+                # Interpolate the crossing time between the two polls.
+                travelled = vehicle.pattern_distance - last_distance
+                arrival = last_time + (now - last_time) * \
+                        (stop_distance - last_distance) / float(travelled)
+
+                for timestamp, (eta, route) in stops.pop(stop_id).items():
+                    self.__record(route, stop_id, eta - timestamp, arrival - eta)
+                    self.__pending_count -= 1
+                self.arrivals_detected += 1
+                arrivals.append((vehicle.vehicle_id, stop_id, arrival))
+
+            if (not stops):
+                del self.__pending[vehicle.vehicle_id]
+
+        self.__expire()
+        return arrivals
+
+    def __record(self, route, stop_id, horizon, error):
+        """
+        Adds a single error sample to the route, stop and horizon sketches.
+        """
+        for sketches, key in ((self.route_errors, route), \
+                              (self.stop_errors, stop_id), \
+                              (self.horizon_errors, self.horizon_bucket(horizon))):
+            sketch = sketches.get(key)
+            if (sketch == None):
+                sketch = QuantileSketch(self.bin_width, self.max_error)
+                sketches[key] = sketch
+            sketch.add(error)
+        return
+
+    def __expire(self):
+        """
+        Drops pending predictions whose ETA is more than expiry seconds
+        in the past (the bus went somewhere else, or we missed it).
+        """
+        if (self.__clock == None):
+            return
+        cutoff = self.__clock - self.expiry
+        for vehicle_id in list(self.__pending):
+            stops = self.__pending[vehicle_id]
+            for stop_id in list(stops):
+                logged = stops[stop_id]
+                for timestamp in list(logged):
+                    if (logged[timestamp][0] < cutoff):
+                        del logged[timestamp]
+                        self.__pending_count -= 1
+                        self.predictions_expired += 1
+                if (not logged):
+                    del stops[stop_id]
+            if (not stops):
+                del self.__pending[vehicle_id]
+        return
+
+    def pending_count(self):
+        """
+        Returns the number of predictions still waiting for an arrival.
+        """
+        return self.__pending_count
+
+    def corrected_eta(self, prediction, quantile = 0.5, min_samples = 20):
+        """
+        Returns prediction.predicted_eta (as a time_struct) shifted by the
+        observed error at the given quantile.  The most specific
+        distribution with at least min_samples is used: the stop, then the
+        route, then the horizon.  If none qualify, the ETA is returned as-is.
+        """
+        eta = prediction.predicted_eta_epoch
+        horizon = eta - time.mktime(prediction.timestamp)
+        for sketches, key in ((self.stop_errors, prediction.stop_id), \
+                              (self.route_errors, prediction.route), \
+                              (self.horizon_errors, self.horizon_bucket(horizon))):
+            sketch = sketches.get(key)
+            if (sketch != None and sketch.count >= min_samples):
+                return time.localtime(eta + sketch.quantile(quantile))
+        return prediction.predicted_eta
+
+# Geofencing
+
+_numpy = None
+
+def _get_numpy():
+    """
+    Returns numpy if it's installed, or None.  Only used to speed things up;
+    everything works without it.
+    """
+    global _numpy
+    if (_numpy == None):
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+# Feet per degree of latitude (the API measures distances in feet)
+FEET_PER_DEGREE = 364000.0
+
+
+class Geofence:
+    """
+    A polygon to watch vehicles enter and leave, e.g. a garage or the Loop.
+
+    polygon is a list of (lat, long) vertices; it is closed automatically.
+    """
+
+    def __init__(self, fence_id, polygon):
+        self.fence_id = fence_id
+        self.polygon = [(float(lat), float(long)) for lat, long in polygon]
+        if (len(self.polygon) < 3):
+            raise InvalidParamtersException("A geofence needs 3 or more points")
+        lats = [lat for lat, long in self.polygon]
+        longs = [long for lat, long in self.polygon]
+        # (min_lat, min_long, max_lat, max_long)
+        self.bbox = (min(lats), min(longs), max(lats), max(longs))
+
+    def contains(self, lats, longs):
+        """
+        Returns a list of booleans: whether each (lats[i], longs[i]) is
+        inside the polygon (even-odd rule).
+        """
+        numpy = _get_numpy()
+        if (numpy != None):
+            y = numpy.asarray(lats, dtype = float)
+            x = numpy.asarray(longs, dtype = float)
+            inside = numpy.zeros(len(y), dtype = bool)
+            with numpy.errstate(divide = "ignore", invalid = "ignore"):
+                for (yi, xi), (yj, xj) in self.__edges():
+                    crosses = ((yi > y) != (yj > y)) & \
+                              (x < (xj - xi) * (y - yi) / (yj - yi) + xi)
+                    inside ^= crosses
+            return inside.tolist()
+
+        edges = list(self.__edges())
+        results = list()
+        for y, x in zip(lats, longs):
+            inside = False
+            for (yi, xi), (yj, xj) in edges:
+                if ((yi > y) != (yj > y)) and \
+                        (x < (xj - xi) * (y - yi) / (yj - yi) + xi):
+                    inside = not inside
+            results.append(inside)
+        return results
+
+    def __edges(self):
+        previous = self.polygon[-1]
+        for point in self.polygon:
+            yield previous, point
+            previous = point
+
+
+class Corridor:
+    """
+    A path with a width, e.g. a detour or a stretch of a route.  A vehicle
+    is inside if it is within distance feet of the path.
+
+    path is a list of (lat, long) points, e.g. from a Pattern's points.
+    """
+
+    def __init__(self, fence_id, path, distance):
+        self.fence_id = fence_id
+        self.path = [(float(lat), float(long)) for lat, long in path]
+        if (len(self.path) < 2):
+            raise InvalidParamtersException("A corridor needs 2 or more points")
+        self.distance = float(distance)
+        lats = [lat for lat, long in self.path]
+        longs = [long for lat, long in self.path]
+        # Distances are worked out on a flat projection around the path,
+        # which is plenty accurate at city scale.
+        import math
+        self.__long_scale = math.cos(math.radians(sum(lats) / len(lats)))
+        pad_lat = self.distance / FEET_PER_DEGREE
+        pad_long = pad_lat / self.__long_scale
+        self.bbox = (min(lats) - pad_lat, min(longs) - pad_long, \
+                     max(lats) + pad_lat, max(longs) + pad_long)
+
+    def __project(self, lat, long):
+        return (long * self.__long_scale * FEET_PER_DEGREE, \
+                lat * FEET_PER_DEGREE)
+
+    def contains(self, lats, longs):
+        """
+        Returns a list of booleans: whether each (lats[i], longs[i]) is
+        within distance feet of the path.
+        """
+        segments = list()
+        for (lat_a, long_a), (lat_b, long_b) in zip(self.path, self.path[1:]):
+            ax, ay = self.__project(lat_a, long_a)
+            bx, by = self.__project(lat_b, long_b)
+            segments.append((ax, ay, bx - ax, by - ay, \
+                             float((bx - ax) ** 2 + (by - ay) ** 2) or 1.0))
+        limit = self.distance ** 2
+
+        numpy = _get_numpy()
+        if (numpy != None):
+            x = numpy.asarray(longs, dtype = float) * self.__long_scale * FEET_PER_DEGREE
+            y = numpy.asarray(lats, dtype = float) * FEET_PER_DEGREE
+            nearest = numpy.full(len(x), numpy.inf)
+            for ax, ay, dx, dy, length in segments:
+                t = numpy.clip(((x - ax) * dx + (y - ay) * dy) / length, 0, 1)
+                numpy.minimum(nearest, (x - ax - t * dx) ** 2 + \
+                              (y - ay - t * dy) ** 2, out = nearest)
+            return (nearest <= limit).tolist()
+
+        results = list()
+        for lat, long in zip(lats, longs):
+            x, y = self.__project(lat, long)
+            inside = False
+            for ax, ay, dx, dy, length in segments:
+                t = min(1.0, max(0.0, ((x - ax) * dx + (y - ay) * dy) / length))
+                if ((x - ax - t * dx) ** 2 + (y - ay - t * dy) ** 2 <= limit):
+                    inside = True
+                    break
+            results.append(inside)
+        return results
+
+
+class GeofenceEvent:
+    """
+    A vehicle entering or leaving a fence.
+    """
+
+    # kind is "enter" or "exit"
+    kind = str()
+
+    # fence_id of the Geofence or Corridor
+    fence_id = None
+
+    # vehicle_id of the vehicle
+    vehicle_id = int()
+
+    # The Vehicle that triggered the event
+    vehicle = None
+
+    def __init__(self, kind, fence_id, vehicle):
+        self.kind = kind
+        self.fence_id = fence_id
+        self.vehicle_id = vehicle.vehicle_id
+        self.vehicle = vehicle
+
+    def __str__(self):
+        return "Vehicle %s %s %s" % (self.vehicle_id, \
+                {"enter": "entered", "exit": "left"}[self.kind], self.fence_id)
+
+
+class GeofenceMonitor:
+    """
+    Watches a set of Geofence and Corridor objects, and reports vehicles
+    entering and leaving them.
+
+    check() tests each fence once against all of its candidate vehicles
+    in the batch.  With numpy installed, candidates are found with one
+    vectorized bounding box test per fence, and the fence test is
+    vectorized too.  Without it, fences are compiled into a grid of
+    cell_size degree cells, each listing the fences whose bounding box
+    overlaps it, so vehicles far from every fence cost one dict lookup.
+    """
+
+    def __init__(self, fences, cell_size = 0.01):
+        self.cell_size = float(cell_size)
+        self.fences = dict()
+        # (row, column) -> list of fence ids
+        self.__grid = dict()
+        # vehicle_id -> frozenset of fence ids it was inside last time
+        self.__state = dict()
+        for fence in fences:
+            self.add(fence)
+
+    def add(self, fence):
+        """
+        Adds a Geofence or Corridor to the index.
+        """
+        if (fence.fence_id in self.fences):
+            raise InvalidParamtersException("Duplicate fence id: " + \
+                                            str(fence.fence_id))
+        self.fences[fence.fence_id] = fence
+        min_lat, min_long, max_lat, max_long = fence.bbox
+        min_row, min_col = self.__cell(min_lat, min_long)
+        max_row, max_col = self.__cell(max_lat, max_long)
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                self.__grid.setdefault((row, col), list()).append(fence.fence_id)
+
+    def __cell(self, lat, long):
+        return (int(lat // self.cell_size), int(long // self.cell_size))
+
+    def inside(self, vehicles):
+        """
+        Returns a list with, for each vehicle, the set of fence ids it is
+        inside.
+        """
+        numpy = _get_numpy()
+        if (numpy != None):
+            return self.__inside_numpy(numpy, vehicles)
+
+        # Group vehicles by candidate fence, using the grid and bbox.
+        candidates = dict()
+        for index, vehicle in enumerate(vehicles):
+            for fence_id in self.__grid.get(self.__cell(vehicle.lat, vehicle.long), ()):
+                min_lat, min_long, max_lat, max_long = self.fences[fence_id].bbox
+                if (min_lat <= vehicle.lat <= max_lat and \
+                        min_long <= vehicle.long <= max_long):
+                    candidates.setdefault(fence_id, list()).append(index)
+
+        inside = [set() for vehicle in vehicles]
+        for fence_id, indexes in candidates.items():
+            results = self.fences[fence_id].contains( \
+                    [vehicles[index].lat for index in indexes], \
+                    [vehicles[index].long for index in indexes])
+            for index, result in zip(indexes, results):
+                if (result):
+                    inside[index].add(fence_id)
+        return inside
+
+    def __inside_numpy(self, numpy, vehicles):
+        """
+        inside(), with the candidate search done as one bounding box test
+        per fence over arrays of every vehicle's position.
+        """
+        lats = numpy.fromiter((vehicle.lat for vehicle in vehicles), float, \
+                              len(vehicles))
+        longs = numpy.fromiter((vehicle.long for vehicle in vehicles), float, \
+                               len(vehicles))
+        inside = [set() for vehicle in vehicles]
+        for fence_id, fence in self.fences.items():
+            min_lat, min_long, max_lat, max_long = fence.bbox
+            indexes = numpy.nonzero((lats >= min_lat) & (lats <= max_lat) & \
+                                    (longs >= min_long) & (longs <= max_long))[0]
+            if (len(indexes) == 0):
+                continue
+            results = fence.contains(lats[indexes], longs[indexes])
+            for index, result in zip(indexes.tolist(), results):
+                if (result):
+                    inside[index].add(fence_id)
+        return inside
+
+    def check(self, vehicles):
+        """
+        Checks a batch of vehicles (e.g. from getvehicles_rt()) against
+        every fence, and returns a list of GeofenceEvent objects for the
+        vehicles that entered or left a fence since the last check.
+
+        The first time a vehicle is seen, it "enters" every fence it is
+        inside.  Vehicles missing from a batch keep their last state.
+        """
+        events = list()
+        for vehicle, fence_ids in zip(vehicles, self.inside(vehicles)):
+            previous = self.__state.get(vehicle.vehicle_id, frozenset())
+            for fence_id in fence_ids - previous:
+                events.append(GeofenceEvent("enter", fence_id, vehicle))
+            for fence_id in previous - fence_ids:
+                events.append(GeofenceEvent("exit", fence_id, vehicle))
+            self.__state[vehicle.vehicle_id] = frozenset(fence_ids)
+        return events
+
+    def vehicles_in(self, fence_id):
+        """
+        Returns the ids of the vehicles inside fence_id as of the last
+        check().
+        """
+        return [vehicle_id for vehicle_id, fence_ids in self.__state.items() \
+                if fence_id in fence_ids]
+
+    def forget(self, vehicle_id):
+        """
+        Drops the state kept for a vehicle (e.g. one that went out of
+        service), without generating exit events.
+        """
+        self.__state.pop(vehicle_id, None)
+
 # EXCEPTION DEFINITIONS
 
 class Error(Exception):
@@ -1048,7 +3921,103 @@ class ImproperNumberOfItemsException(Error):
         self.itemListLen = numOfItems
 
     def __str__(self):
-        return "Improper Number of Items: 0 < items <= 10 are allowed. " + self.itemListLen + " specified."
+        return "Improper Number of Items: 0 < items <= 10 are allowed. " + str(self.itemListLen) + " specified."
+
+class TransportError(Error):
+    """
+    Base class for errors raised by PolicyTransport.
+
+    Attributes:
+        url - URL of the request that failed.
+    """
+
+    def __init__(self, url):
+        self.url = url
+
+class CircuitOpenError(TransportError):
+    """
+    Exception raised when a request is refused because the API has been
+    failing (see CircuitBreaker).
+    """
+
+    def __str__(self):
+        return "Circuit breaker open, request not sent: " + self.url
+
+class DeadlineExceededError(TransportError):
+    """
+    Exception raised when a request runs out of time, retries included.
+    """
+
+    def __str__(self):
+        return "Deadline exceeded: " + self.url
+
+class RequestFailedError(TransportError):
+    """
+    Exception raised when a request fails for good: retries have run out
+    or the error isn't worth retrying.
+
+    Attributes:
+        url - URL of the request that failed.
+        error - The exception the wrapped transport raised last.
+    """
+
+    def __init__(self, url, error):
+        TransportError.__init__(self, url)
+        self.error = error
+
+    def __str__(self):
+        return "Request failed (%s): %s" % (self.error, self.url)
+
+class APIError(Error):
+    """
+    Exception for an error reported by the Bus Tracker API.
+
+    Attributes:
+        msg - The API's error message.
+        param - The parameter the error is about ("vid", "stpid", "rt",
+                ...), or None if it applies to the whole request.
+        value - The value of param that failed, or None.
+        errors - When raised, the list of every error in the response.
+        retry - False if asking again with the same parameters won't work.
+    """
+
+    retry = True
+
+    def __init__(self, msg, param = None, value = None):
+        self.msg = msg
+        self.param = param
+        self.value = value
+        self.errors = [self]
+
+    def __str__(self):
+        if (self.param != None):
+            return "%s (%s=%s)" % (self.msg, self.param, self.value)
+        return str(self.msg)
+
+class InvalidKeyError(APIError):
+    """
+    Exception raised when the API key is invalid.
+    """
+    retry = False
+
+class TransactionLimitError(APIError):
+    """
+    Exception raised when the API key's daily transaction limit is used up.
+    """
+    retry = False
+
+class InvalidParameterError(APIError):
+    """
+    Exception raised for an invalid route, stop, vehicle or pattern id, or
+    other bad parameter.
+    """
+    retry = False
+
+class NoDataError(APIError):
+    """
+    Exception raised when there's nothing to return, e.g. a vehicle that
+    isn't running, or a stop with no arrivals scheduled.
+    """
 
 class InvalidParamtersException(Error):
     """
@@ -1063,3 +4032,16 @@ class InvalidParamtersException(Error):
 
     def __str__(self):
         return self.msg
+
+# The API's error messages, as (phrases, APIError subclass): a message
+# (in lower case) containing all of the phrases is raised as that class.
+# The first match wins; messages matching nothing are raised as APIError.
+API_ERROR_PHRASES = ((("api access key",), InvalidKeyError),
+                     (("transaction limit",), TransactionLimitError),
+                     (("maximum number of", "exceeded"), InvalidParameterError),
+                     (("no data found",), NoDataError),
+                     (("no service scheduled",), NoDataError),
+                     (("no arrival times",), NoDataError),
+                     (("invalid api command",), InvalidParameterError),
+                     (("must be specified",), InvalidParameterError),
+                     (("invalid", "parameter"), InvalidParameterError))
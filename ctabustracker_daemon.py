@@ -0,0 +1,429 @@
+"""
+ctabustracker_daemon.py
+
+A long-running poller for the CTA Bus Tracker API.  Given a JSON config
+of routes and stops, it polls vehicles and predictions every interval
+seconds, in batches of 10, through a rate-limited PolicyTransport, and
+hands each poll's results to sinks: JSON lines files, a GTFS-Realtime
+snapshot file, a SQLite database, or stdout.
+
+Each sink writes from its own thread, fed through a bounded queue.  If a
+sink falls behind and its queue fills up, polls for it are dropped (and
+counted) instead of waiting, so slow storage never delays polling.
+
+    python ctabustracker_daemon.py config.json
+
+An example config:
+
+    {
+        "api_key": "...",
+        "routes": ["22", "36", "151"],
+        "stops": [1066, 14487],
+        "interval": 30,
+        "rate": 2,
+        "sinks": [
+            {"type": "jsonl", "path": "polls.jsonl"},
+            {"type": "sqlite", "path": "polls.db"},
+            {"type": "gtfsrt", "path": "feed.pb"},
+            {"type": "stdout"}
+        ]
+    }
+"""
+
+__author__ = "Chris Swingler"
+__email__ = "chris@chrisswingler.com"
+__status__ = "Development"
+
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import ctabustracker
+from ctabustracker import log
+
+# Fields written out for each kind of record, in column order
+FIELDS = {"vehicles": ("vehicle_id", "timestamp", "lat", "long", "heading", \
+                       "pattern_id", "pattern_distance", "route", "dest", \
+                       "delayed"),
+          "predictions": ("timestamp", "prediction_type", "stop_id", \
+                          "stop_name", "vehicle_id", "distance_to_stop", \
+                          "route", "route_dir", "destination", \
+                          "predicted_eta", "delayed")}
+
+# Config keys and their defaults
+DEFAULT_CONFIG = {"api_url": None,
+                  "routes": [],
+                  "stops": [],
+                  # Seconds between the start of each poll
+                  "interval": 30.0,
+                  # Requests per second allowed to the API, and burst size
+                  "rate": 2.0,
+                  "burst": 5,
+                  # Threads making requests during a poll
+                  "workers": 4,
+                  # Polls each sink may fall behind by before dropping
+                  "queue_size": 100,
+                  "sinks": [{"type": "stdout"}]}
+
+
+def record_values(kind, record):
+    """
+    Returns the FIELDS values of a Vehicle or Prediction, with time stamps
+    as seconds since the epoch.
+    """
+    values = list()
+    for field in FIELDS[kind]:
+        value = getattr(record, field, None)
+        if (isinstance(value, time.struct_time)):
+            value = int(time.mktime(value))
+        values.append(value)
+    return values
+
+
+# Sinks
+# A sink has write(kind, records, polled, ids), called with each poll's
+# results: kind is "vehicles" or "predictions", records the Vehicle or
+# Prediction objects, polled the time of the poll and ids the routes or
+# stops that were polled successfully.  close() is called at shutdown.
+
+class JSONLinesSink:
+    """
+    Writes one JSON object per record to a file (appending) or stream, with
+    "type" ("vehicle" or "prediction") and "polled" keys added.
+    """
+
+    def __init__(self, path = None, stream = None):
+        self.path = path
+        self.stream = stream
+
+    def write(self, kind, records, polled, ids):
+        if (self.stream == None):
+            self.stream = open(self.path, "a")
+        record_type = kind.rstrip("s")
+        for record in records:
+            line = dict(zip(FIELDS[kind], record_values(kind, record)))
+            line["type"] = record_type
+            line["polled"] = int(polled)
+            self.stream.write(json.dumps(line, sort_keys = True) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        if (self.path != None and self.stream != None):
+            self.stream.close()
+
+
+class SQLiteSink:
+    """
+    Appends records to "vehicles" and "predictions" tables in a SQLite
+    database, with a "polled" column added.  The tables are created if
+    they don't exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__connection = None
+
+    def write(self, kind, records, polled, ids):
+        # sqlite3 connections belong to the thread that made them, so this
+        # is opened by the writer thread, not in __init__.
+        if (self.__connection == None):
+            import sqlite3
+            self.__connection = sqlite3.connect(self.path)
+            for table in FIELDS:
+                self.__connection.execute("CREATE TABLE IF NOT EXISTS %s " \
+                        "(polled INTEGER, %s)" % (table, ", ".join(FIELDS[table])))
+        placeholders = ", ".join("?" * (len(FIELDS[kind]) + 1))
+        self.__connection.executemany( \
+                "INSERT INTO %s VALUES (%s)" % (kind, placeholders), \
+                [[int(polled)] + record_values(kind, record) \
+                 for record in records])
+        self.__connection.commit()
+
+    def close(self):
+        if (self.__connection != None):
+            self.__connection.close()
+
+
+class GTFSRealtimeSink:
+    """
+    Keeps a GTFSRealtimeFeed up to date and rewrites path with the full
+    feed after every poll.  The file is replaced in one step, so readers
+    never see half of it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.feed = ctabustracker.GTFSRealtimeFeed()
+
+    def write(self, kind, records, polled, ids):
+        if (kind == "vehicles"):
+            self.feed.update_vehicles(records, routes = ids)
+        else:
+            self.feed.update_predictions(records, stop_ids = ids)
+        version, body = self.feed.full_feed()
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as temp_file:
+            temp_file.write(body)
+        getattr(os, "replace", os.rename)(temp_path, self.path)
+
+    def close(self):
+        pass
+
+
+def make_sink(config):
+    """
+    Returns the sink for a config entry: a dict with "type" ("jsonl",
+    "sqlite", "gtfsrt" or "stdout") and, except for stdout, "path".
+    """
+    sink_type = config.get("type")
+    if (sink_type == "stdout"):
+        return JSONLinesSink(stream = sys.stdout)
+    if ("path" not in config):
+        raise ctabustracker.InvalidParamtersException( \
+                "Sink needs a path: " + str(config))
+    if (sink_type == "jsonl"):
+        return JSONLinesSink(config["path"])
+    if (sink_type == "sqlite"):
+        return SQLiteSink(config["path"])
+    if (sink_type == "gtfsrt"):
+        return GTFSRealtimeSink(config["path"])
+    raise ctabustracker.InvalidParamtersException( \
+            "Unknown sink type: " + str(sink_type))
+
+
+class BackgroundSink:
+    """
+    Runs a sink's writes on a thread of its own, fed by a queue holding up
+    to queue_size polls.  submit() never blocks: when the queue is full,
+    the poll is dropped for this sink.
+
+    stats counts polls written, dropped (queue full) and failed (the sink
+    raised).
+    """
+
+    def __init__(self, sink, queue_size = 100):
+        self.sink = sink
+        self.stats = dict.fromkeys(("written", "dropped", "failed"), 0)
+        self.__queue = queue.Queue(queue_size)
+        self.__thread = threading.Thread(target = self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def submit(self, kind, records, polled, ids):
+        try:
+            self.__queue.put_nowait((kind, records, polled, ids))
+        except queue.Full:
+            self.stats["dropped"] += 1
+            log.warning("%s is behind, dropped a poll" % \
+                        self.sink.__class__.__name__)
+
+    def close(self, timeout = None):
+        """
+        Writes out what's queued, then closes the sink.
+        """
+        self.__queue.put(None)
+        self.__thread.join(timeout)
+
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            if (item == None):
+                break
+            try:
+                self.sink.write(*item)
+                self.stats["written"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                log.error("%s failed: %s" % (self.sink.__class__.__name__, e))
+        try:
+            self.sink.close()
+        except Exception as e:
+            log.error("%s failed to close: %s" % (self.sink.__class__.__name__, e))
+
+
+class PollingDaemon:
+    """
+    Polls vehicles on routes and predictions for stops every interval
+    seconds, and submits the results to sinks (BackgroundSinks).
+
+    Routes and stops the API rejects as invalid (InvalidParameterError)
+    are dropped from later polls and kept in invalid.  A batch that fails
+    for any other reason (a transport error, or a response that can't be
+    parsed or decoded) is logged, counted in failed_batches and skipped
+    until the next poll; an invalid API key stops the daemon.
+
+    stats counts polls, vehicles, predictions and failed_batches.
+    """
+
+    def __init__(self, tracker, routes = (), stops = (), sinks = (), \
+                 interval = 30.0, workers = 4):
+        """
+        tracker is a ctabustracker object, in "objects" or "lazy" mode.
+        """
+        ctabustracker.require_parsed_mode(tracker, "PollingDaemon")
+        self.tracker = tracker
+        self.routes = [str(route) for route in routes]
+        self.stops = [int(stop) for stop in stops]
+        self.sinks = list(sinks)
+        self.interval = interval
+        self.workers = workers
+        self.invalid = set()
+        self.stats = dict.fromkeys(("polls", "vehicles", "predictions", \
+                                    "failed_batches"), 0)
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+
+    def poll(self):
+        """
+        Polls once and submits the results to the sinks.  Returns
+        (vehicles, predictions).
+        """
+        polled = time.time()
+        vehicles, routes = self.__fetch(self.tracker.getvehicles_rt, "rt", \
+                                        self.routes)
+        predictions, stops = self.__fetch(self.tracker.getpredictions_stop, \
+                                          "stpid", self.stops)
+        self.stats["polls"] += 1
+        self.stats["vehicles"] += len(vehicles)
+        self.stats["predictions"] += len(predictions)
+        for sink in self.sinks:
+            if (routes):
+                sink.submit("vehicles", vehicles, polled, routes)
+            if (stops):
+                sink.submit("predictions", predictions, polled, stops)
+        return (vehicles, predictions)
+
+    def run(self, polls = None):
+        """
+        Polls every interval seconds until stop() is called (or polls
+        polls have been made), then closes the sinks.
+        """
+        try:
+            count = 0
+            while (not self.__stop.is_set()):
+                started = time.time()
+                try:
+                    self.poll()
+                except ctabustracker.InvalidKeyError:
+                    raise
+                except Exception as e:
+                    # One bad poll mustn't stop the daemon
+                    log.warning("Poll failed: %s: %s" % (type(e).__name__, e))
+                count += 1
+                if (polls != None and count >= polls):
+                    break
+                self.__stop.wait(max(0.0, self.interval - (time.time() - started)))
+        finally:
+            for sink in self.sinks:
+                sink.close()
+
+    def stop(self):
+        self.__stop.set()
+
+    def __fetch(self, fetch, param, ids):
+        """
+        Calls fetch on ids, 10 at a time.  Returns (results, ids that were
+        polled successfully).
+        """
+        ids = [key for key in ids if (param, key) not in self.invalid]
+        batches = [ids[i:i + 10] for i in range(0, len(ids), 10)]
+
+        def fetch_batch(batch):
+            try:
+                results = fetch(*batch)
+                errors = getattr(results, "errors", ())
+            except ctabustracker.APIError as e:
+                # Every id failed; e.errors has the reason for each
+                if (e.param == None and \
+                        not isinstance(e, ctabustracker.NoDataError)):
+                    raise
+                results = list()
+                errors = e.errors
+            except Exception as e:
+                # Transport failures (including urllib and socket errors
+                # from a transport that isn't wrapped in a PolicyTransport)
+                # and responses that couldn't be parsed or decoded
+                log.warning("Batch failed: %s: %s" % (type(e).__name__, e))
+                with self.__lock:
+                    self.stats["failed_batches"] += 1
+                return (list(), list())
+            for error in errors:
+                if (not error.retry and error.param == param):
+                    key = error.value if param == "rt" else int(error.value)
+                    log.warning("Dropping invalid %s %s" % (param, key))
+                    with self.__lock:
+                        self.invalid.add((param, key))
+            return (results, batch)
+
+        results = list()
+        polled = list()
+        for batch_results, batch in ctabustracker.run_parallel(fetch_batch, \
+                batches, self.workers):
+            results.extend(batch_results)
+            polled.extend(batch)
+        return (results, polled)
+
+
+def load_config(path):
+    """
+    Reads a JSON config file, filling in DEFAULT_CONFIG for missing keys.
+    """
+    with open(path) as config_file:
+        config = json.load(config_file)
+    if (not isinstance(config, dict) or "api_key" not in config):
+        raise ctabustracker.InvalidParamtersException( \
+                "Config must be an object with an api_key")
+    for key in DEFAULT_CONFIG:
+        config.setdefault(key, DEFAULT_CONFIG[key])
+    return config
+
+
+def build_daemon(config):
+    """
+    Returns a PollingDaemon set up as config says.
+    """
+    transport = ctabustracker.PolicyTransport(ctabustracker.HTTPTransport(), \
+            rate_limiter = ctabustracker.TokenBucket(config["rate"], \
+                                                     config["burst"]))
+    tracker = ctabustracker.ctabustracker(config["api_key"], config["api_url"], \
+                                          transport = transport)
+    sinks = [BackgroundSink(make_sink(sink), config["queue_size"]) \
+             for sink in config["sinks"]]
+    return PollingDaemon(tracker, config["routes"], config["stops"], sinks, \
+                         config["interval"], config["workers"])
+
+
+def main(argv = None):
+    import argparse
+    import logging
+    import signal
+    parser = argparse.ArgumentParser(description = \
+            "Poll the CTA Bus Tracker API and write the results to sinks")
+    parser.add_argument("config", help = "JSON config file")
+    parser.add_argument("--polls", type = int, \
+                        help = "stop after this many polls")
+    parser.add_argument("--verbose", "-v", action = "store_true")
+    args = parser.parse_args(argv)
+
+    # Log to stderr, so a stdout sink's output stays clean
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING)
+    daemon = build_daemon(load_config(args.config))
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    try:
+        daemon.run(args.polls)
+    except KeyboardInterrupt:
+        pass
+    except ctabustracker.InvalidKeyError as e:
+        log.error(str(e))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,689 @@
+"""
+ctabustracker_mock.py
+
+A stand-in for the CTA Bus Tracker API, for load testing ctabustracker
+(and anything built on it) without touching the real service.
+
+MockNetwork makes up a small, self-consistent bus network: routes, their
+directions, stops and patterns, and a fleet of buses moving along the
+patterns in real time.  MockServer serves it over HTTP with the same
+commands and XML as the real API (gettime, getvehicles, getroutes,
+getdirections, getstops, getpatterns, getpredictions and
+getservicebulletins), with configurable latency and error rate.
+run_load() drives a ctabustracker client against a server and reports
+throughput and latency percentiles.
+
+From the command line:
+
+    python ctabustracker_mock.py serve --port 8080 --routes 40
+    python ctabustracker_mock.py load --requests 5000 --workers 16
+
+"load" starts its own server unless --url is given.
+"""
+
+__author__ = "Chris Swingler"
+__email__ = "chris@chrisswingler.com"
+__status__ = "Development"
+
+import random
+import threading
+import time
+import zlib
+
+import ctabustracker
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+from xml.sax.saxutils import escape
+
+# Direction pairs, by route: odd routes run north/south, even ones east/west
+DIRECTIONS = (("North Bound", "South Bound"), ("East Bound", "West Bound"))
+
+# Headings (degrees) for each direction
+HEADINGS = {"North Bound": 0, "South Bound": 180, "East Bound": 90, \
+            "West Bound": 270}
+
+# Feet between stops; a waypoint sits halfway between each pair
+STOP_SPACING = 1320
+
+# Degrees of latitude/longitude per foot, close enough for Chicago
+DEGREES_PER_FOOT = 1 / 364000.0
+
+# Predictions are only made this many seconds ahead
+PREDICTION_HORIZON = 1800
+
+# Error messages, worded like the real API's
+NO_DATA = "No data found for parameter"
+INVALID_KEY = "Invalid API access key supplied"
+
+
+def _time_string(timestamp, seconds = False):
+    if (seconds):
+        return time.strftime("%Y%m%d %H:%M:%S", time.localtime(timestamp))
+    return time.strftime("%Y%m%d %H:%M", time.localtime(timestamp))
+
+def _element(tag, value):
+    return "<%s>%s</%s>" % (tag, escape(str(value)), tag)
+
+def _response(body):
+    return ('<?xml version="1.0"?>\n<bustime-response>' + "".join(body) + \
+            "</bustime-response>").encode("utf-8")
+
+def _error(msg, param = None, value = None):
+    if (param == None):
+        return "<error>" + _element("msg", msg) + "</error>"
+    return "<error>" + _element("msg", msg) + _element(param, value) + \
+           "</error>"
+
+
+class MockNetwork:
+    """
+    A made-up bus network.  Routes are numbered "1" to str(routes), each
+    runs in two directions with stops_per_route stops in each, and
+    buses_per_route buses are spread over both directions.  Buses move at
+    speed feet per second and go back to the start of their pattern when
+    they reach the end, so vehicles, patterns and predictions always agree
+    with each other.
+
+    The same seed always makes the same network.
+    """
+
+    def __init__(self, routes = 20, buses_per_route = 10, stops_per_route = 30, \
+                 speed = 15.0, seed = 0):
+        self.speed = speed
+        rand = random.Random(seed)
+        # route -> name
+        self.routes = dict()
+        # route -> (direction, direction)
+        self.directions = dict()
+        # pattern id -> (pid, route, direction, [(seq, type, lat, lon,
+        # stop_id, stop_name, pdist)], length)
+        self.patterns = dict()
+        # (route, direction) -> pattern id
+        self.route_patterns = dict()
+        # stop_id -> (stop_id, name, lat, lon, pid, pdist)
+        self.stops = dict()
+        # vehicle_id -> (vehicle_id, pid, starting pdist)
+        self.vehicles = dict()
+        # route -> [vehicle_id]
+        self.route_vehicles = dict()
+        # pid -> [vehicle_id]
+        self.pattern_vehicles = dict()
+        # bulletin name -> (name, subject, detail, priority, [route],
+        # [stop_id])
+        self.bulletins = dict()
+        self.epoch = time.time()
+
+        for number in range(1, routes + 1):
+            route = str(number)
+            self.routes[route] = "Synthetic Route %d" % number
+            self.directions[route] = DIRECTIONS[number % 2 == 0]
+            self.route_vehicles[route] = list()
+            for index, direction in enumerate(self.directions[route]):
+                self.__add_pattern(number, index, direction, stops_per_route)
+            for bus in range(buses_per_route):
+                pid = self.route_patterns[(route, self.directions[route][bus % 2])]
+                vehicle_id = str(1000 + (number - 1) * buses_per_route + bus)
+                self.vehicles[vehicle_id] = (vehicle_id, pid, \
+                        rand.uniform(0, self.patterns[pid][4]))
+                self.route_vehicles[route].append(vehicle_id)
+                self.pattern_vehicles[pid].append(vehicle_id)
+            if (number % 5 == 0):
+                first_stop = self.patterns[number * 10][3][0][4]
+                name = "Reroute - #%d %s" % (number, self.routes[route])
+                self.bulletins[name] = (name, "Temporary Reroute", \
+                        "Buses are rerouted around construction.", "Medium", \
+                        [route], [first_stop])
+
+    def __add_pattern(self, number, index, direction, stops):
+        """
+        Lays out one direction of a route as a straight line, with its
+        stops and a waypoint between each.
+        """
+        route = str(number)
+        pid = number * 10 + index
+        if (number % 2 == 0):
+            start = (41.75 + number * 0.004, -87.80)
+            step = (0.0, DEGREES_PER_FOOT)
+        else:
+            start = (41.70, -87.75 + number * 0.004)
+            step = (DEGREES_PER_FOOT, 0.0)
+        length = (stops - 1) * STOP_SPACING
+        points = list()
+        for seq in range(2 * stops - 1):
+            pdist = seq * STOP_SPACING // 2
+            # The second direction runs the same line backwards
+            along = pdist if index == 0 else length - pdist
+            lat = round(start[0] + step[0] * along, 6)
+            lon = round(start[1] + step[1] * along, 6)
+            if (seq % 2 == 0):
+                stop_id = number * 1000 + index * 500 + seq // 2
+                name = "Route %d Stop %d" % (number, seq // 2 + 1)
+                points.append((seq + 1, "S", lat, lon, stop_id, name, pdist))
+                self.stops[stop_id] = (stop_id, name, lat, lon, pid, pdist)
+            else:
+                points.append((seq + 1, "W", lat, lon, None, None, pdist))
+        self.patterns[pid] = (pid, route, direction, points, length)
+        self.route_patterns[(route, direction)] = pid
+        self.pattern_vehicles[pid] = list()
+
+    def vehicle_position(self, vehicle_id, now):
+        """
+        Returns (pid, pdist, lat, lon) for a vehicle at time now.
+        """
+        vehicle_id, pid, start = self.vehicles[vehicle_id]
+        points, length = self.patterns[pid][3], self.patterns[pid][4]
+        pdist = (start + self.speed * (now - self.epoch)) % length
+        spacing = STOP_SPACING // 2
+        index = min(int(pdist // spacing), len(points) - 2)
+        fraction = (pdist - points[index][6]) / float(spacing)
+        lat = points[index][2] + (points[index + 1][2] - points[index][2]) * fraction
+        lon = points[index][3] + (points[index + 1][3] - points[index][3]) * fraction
+        return (pid, pdist, lat, lon)
+
+    def vehicle_xml(self, vehicle_id, now):
+        pid, pdist, lat, lon = self.vehicle_position(vehicle_id, now)
+        route, direction, points = self.patterns[pid][1:4]
+        return "<vehicle>" + _element("vid", vehicle_id) + \
+               _element("tmstmp", _time_string(now)) + \
+               _element("lat", "%.6f" % lat) + _element("lon", "%.6f" % lon) + \
+               _element("hdg", HEADINGS[direction]) + _element("pid", pid) + \
+               _element("pdist", int(pdist)) + _element("rt", route) + \
+               _element("des", points[-1][5]) + "</vehicle>"
+
+    def predictions(self, vehicle_ids, stop_ids, now):
+        """
+        Returns (eta, stop_id, vehicle_id, distance) for each vehicle in
+        vehicle_ids arriving at each stop in stop_ids within the
+        prediction horizon, soonest first.
+        """
+        results = list()
+        for vehicle_id in vehicle_ids:
+            pid, pdist = self.vehicle_position(vehicle_id, now)[:2]
+            for stop_id in stop_ids:
+                stop_pid, stop_pdist = self.stops[stop_id][4:6]
+                if (stop_pid != pid or stop_pdist <= pdist):
+                    continue
+                eta = now + (stop_pdist - pdist) / self.speed
+                if (eta - now <= PREDICTION_HORIZON):
+                    results.append((eta, stop_id, vehicle_id, stop_pdist - pdist))
+        results.sort()
+        return results
+
+    def prediction_xml(self, prediction, now):
+        eta, stop_id, vehicle_id, distance = prediction
+        pid = self.vehicles[vehicle_id][1]
+        route, direction, points = self.patterns[pid][1:4]
+        return "<prd>" + _element("tmstmp", _time_string(now)) + \
+               _element("typ", "A") + _element("stpid", stop_id) + \
+               _element("stpnm", self.stops[stop_id][1]) + \
+               _element("vid", vehicle_id) + _element("dstp", int(distance)) + \
+               _element("rt", route) + _element("rtdir", direction) + \
+               _element("des", points[-1][5]) + \
+               _element("prdtm", _time_string(eta)) + "</prd>"
+
+    def pattern_xml(self, pid):
+        pid, route, direction, points, length = self.patterns[pid]
+        body = ["<ptr>", _element("pid", pid), _element("ln", "%.1f" % length), \
+                _element("rtdir", direction)]
+        for seq, ptype, lat, lon, stop_id, stop_name, pdist in points:
+            body.append("<pt>" + _element("seq", seq) + _element("lat", lat) + \
+                        _element("lon", lon) + _element("typ", ptype))
+            if (stop_id != None):
+                body.append(_element("stpid", stop_id) + \
+                            _element("stpnm", stop_name))
+            body.append(_element("pdist", "%.1f" % pdist) + "</pt>")
+        body.append("</ptr>")
+        return "".join(body)
+
+    def bulletin_xml(self, bulletin):
+        name, subject, detail, priority, routes, stop_ids = bulletin
+        body = ["<sb>", _element("nm", name), _element("sbj", subject), \
+                _element("dtl", detail), _element("brf", subject), \
+                _element("prty", priority)]
+        for route in routes:
+            body.append("<srvc>" + _element("rt", route) + "</srvc>")
+        for stop_id in stop_ids:
+            body.append("<srvc>" + _element("stpid", stop_id) + \
+                        _element("stpnm", self.stops[stop_id][1]) + "</srvc>")
+        body.append("</sb>")
+        return "".join(body)
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves a MockNetwork over HTTP, answering the Bus Tracker API commands
+    under /bustime/api/v1/.  Each request gets its own thread.
+
+    Every response is delayed by latency seconds plus up to jitter more,
+    and a fraction error_rate of requests fail with 503 Service
+    Unavailable.  Requests must carry key.  Responses are gzipped if the
+    client asks for it, and the static commands (getroutes, getdirections,
+    getstops, getpatterns) send ETags and answer 304 Not Modified.
+
+    stats counts requests, errors (the injected 503s), not_modified and
+    bytes_sent.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # The default backlog of 5 makes connections wait for a SYN retry
+    # (a second or more) as soon as more than a few clients connect at once
+    request_queue_size = 128
+
+    def __init__(self, address = ("127.0.0.1", 0), network = None, \
+                 key = "mock", latency = 0.0, jitter = 0.0, error_rate = 0.0, \
+                 seed = None):
+        HTTPServer.__init__(self, address, MockRequestHandler)
+        if (network == None):
+            network = MockNetwork()
+        self.network = network
+        self.key = key
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.stats = dict.fromkeys(("requests", "errors", "not_modified", \
+                                    "bytes_sent"), 0)
+        self.lock = threading.Lock()
+
+    @property
+    def api_url(self):
+        """
+        The api_url to give a ctabustracker client for this server.
+        """
+        return "http://%s:%d/bustime/api/v1/" % self.server_address[:2]
+
+    def start(self):
+        """
+        Starts serving on a background thread, and returns it.
+        """
+        thread = threading.Thread(target = self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def count(self, stat, amount = 1):
+        with self.lock:
+            self.stats[stat] += amount
+
+    def respond(self, command, params):
+        """
+        Returns the XML response for a command, as bytes.
+        """
+        if (params.get("key") != self.key):
+            return _response([_error(INVALID_KEY)])
+        handler = getattr(self, "_command_" + command, None)
+        if (handler == None):
+            return _response([_error("Invalid API command")])
+        return handler(params, time.time())
+
+    def _command_gettime(self, params, now):
+        return _response([_element("tm", _time_string(now, True))])
+
+    def _command_getroutes(self, params, now):
+        network = self.network
+        return _response(["<route>" + _element("rt", route) + \
+                          _element("rtnm", network.routes[route]) + "</route>" \
+                          for route in sorted(network.routes, key = int)])
+
+    def _command_getdirections(self, params, now):
+        route = params.get("rt")
+        if (route not in self.network.directions):
+            return _response([_error(NO_DATA, "rt", route)])
+        return _response([_element("dir", direction) \
+                          for direction in self.network.directions[route]])
+
+    def _command_getstops(self, params, now):
+        network = self.network
+        pid = network.route_patterns.get((params.get("rt"), params.get("dir")))
+        if (pid == None):
+            return _response([_error(NO_DATA, "rt", params.get("rt"))])
+        body = list()
+        for point in network.patterns[pid][3]:
+            if (point[4] != None):
+                body.append("<stop>" + _element("stpid", point[4]) + \
+                            _element("stpnm", point[5]) + \
+                            _element("lat", point[2]) + \
+                            _element("lon", point[3]) + "</stop>")
+        return _response(body)
+
+    def _command_getpatterns(self, params, now):
+        network = self.network
+        if ("pid" in params):
+            body = list()
+            for pid in _ids(params["pid"]):
+                if (pid.isdigit() and int(pid) in network.patterns):
+                    body.append(network.pattern_xml(int(pid)))
+                else:
+                    body.append(_error(NO_DATA, "pid", pid))
+            return _response(body)
+        pid = network.route_patterns.get((params.get("rt"), params.get("dir")))
+        if (pid == None):
+            return _response([_error(NO_DATA, "rt", params.get("rt"))])
+        return _response([network.pattern_xml(pid)])
+
+    def _command_getvehicles(self, params, now):
+        network = self.network
+        body = list()
+        if ("vid" in params):
+            for vehicle_id in _ids(params["vid"]):
+                if (vehicle_id in network.vehicles):
+                    body.append(network.vehicle_xml(vehicle_id, now))
+                else:
+                    body.append(_error(NO_DATA, "vid", vehicle_id))
+        else:
+            for route in _ids(params.get("rt", "")):
+                if (route not in network.route_vehicles):
+                    body.append(_error(NO_DATA, "rt", route))
+                    continue
+                for vehicle_id in network.route_vehicles[route]:
+                    body.append(network.vehicle_xml(vehicle_id, now))
+        return _response(body)
+
+    def _command_getpredictions(self, params, now):
+        network = self.network
+        body = [_element("tm", _time_string(now, True))]
+        predictions = list()
+        if ("vid" in params):
+            for vehicle_id in _ids(params["vid"]):
+                if (vehicle_id not in network.vehicles):
+                    body.append(_error(NO_DATA, "vid", vehicle_id))
+                    continue
+                pid = network.vehicles[vehicle_id][1]
+                stop_ids = [point[4] for point in network.patterns[pid][3] \
+                            if point[4] != None]
+                predictions.extend(network.predictions([vehicle_id], \
+                                                       stop_ids, now))
+        else:
+            for stop_id in _ids(params.get("stpid", "")):
+                if (not stop_id.isdigit() or int(stop_id) not in network.stops):
+                    body.append(_error(NO_DATA, "stpid", stop_id))
+                    continue
+                pid = network.stops[int(stop_id)][4]
+                predictions.extend(network.predictions( \
+                        network.pattern_vehicles[pid], [int(stop_id)], now))
+        predictions.sort()
+        body.extend(network.prediction_xml(prediction, now) \
+                    for prediction in predictions)
+        return _response(body)
+
+    def _command_getservicebulletins(self, params, now):
+        network = self.network
+        routes = set(_ids(params.get("rt", "")))
+        stop_ids = set(int(stop_id) for stop_id in \
+                       _ids(params.get("stpid", "")) if stop_id.isdigit())
+        body = list()
+        for name in sorted(network.bulletins):
+            bulletin = network.bulletins[name]
+            if (routes.intersection(bulletin[4]) or \
+                stop_ids.intersection(bulletin[5])):
+                body.append(network.bulletin_xml(bulletin))
+        return _response(body)
+
+
+def _ids(value):
+    return [item for item in value.split(",") if item]
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles one request to a MockServer.
+    """
+
+    # Lets clients keep their connection open
+    protocol_version = "HTTP/1.1"
+
+    static_commands = ("getroutes", "getdirections", "getstops", "getpatterns")
+
+    def do_GET(self):
+        server = self.server
+        server.count("requests")
+        url = urlparse(self.path)
+        command = url.path.rstrip("/").rsplit("/", 1)[-1]
+        params = dict((name, values[-1]) for name, values in \
+                      parse_qs(url.query).items())
+
+        delay = server.latency
+        if (server.jitter):
+            delay += server.random.uniform(0, server.jitter)
+        if (delay > 0):
+            time.sleep(delay)
+
+        if (server.error_rate and server.random.random() < server.error_rate):
+            server.count("errors")
+            self.__send(503, b"Service Unavailable", "text/plain")
+            return
+
+        body = server.respond(command, params)
+        headers = dict()
+        if (command in self.static_commands):
+            etag = '"%08x"' % (zlib.crc32(body) & 0xffffffff)
+            headers["ETag"] = etag
+            if (self.headers.get("If-None-Match") == etag):
+                server.count("not_modified")
+                self.__send(304, b"", None, headers)
+                return
+        if ("gzip" in (self.headers.get("Accept-Encoding") or "")):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers["Content-Encoding"] = "gzip"
+        self.__send(200, body, "text/xml; charset=utf-8", headers)
+
+    def __send(self, status, body, content_type, headers = None):
+        self.send_response(status)
+        if (content_type != None):
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if (headers != None):
+            for name in headers:
+                self.send_header(name, headers[name])
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count("bytes_sent", len(body))
+
+    def log_message(self, format, *args):
+        ctabustracker.log.debug("mock server: " + format % args)
+
+
+# Load testing
+
+def percentile(values, fraction):
+    """
+    Returns the value at fraction (0 to 1) of the way through values,
+    which must be sorted (nearest rank).
+    """
+    if (not values):
+        return None
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+def discover(tracker, routes = 10):
+    """
+    Looks up the routes, and the directions and stops of the first few, as
+    targets for run_load().  Returns (routes, {route: [direction]},
+    [stop_id]).  tracker must not be in "raw" mode.
+    """
+    ctabustracker.require_parsed_mode(tracker, "discover()")
+    all_routes = sorted(tracker.getroutes())
+    directions = dict()
+    stop_ids = list()
+    for route in all_routes[:routes]:
+        directions[route] = list(tracker.getroute_directions(route))
+        for direction in directions[route]:
+            stop_ids.extend(stop.stop_id for stop in \
+                            tracker.getroute_stops(route, direction))
+    return (all_routes, directions, stop_ids)
+
+
+def run_load(tracker, requests = 1000, workers = 8, seed = None, \
+             targets = None):
+    """
+    Makes requests calls through tracker (a ctabustracker client), from
+    workers threads at once, and returns a report dict.
+
+    The calls are a mix of getvehicles_rt, getpredictions_stop,
+    getpatterns_rt, getbulletins_route and gettime, for the routes and
+    stops in targets (see discover(), which is used if targets isn't
+    given).
+
+    The report has requests, elapsed (seconds), throughput (requests per
+    second), errors (counts by exception class name), and latency: for
+    "all" and each call, a dict of count, p50, p95, p99 and max in seconds.
+    """
+    rand = random.Random(seed)
+    if (targets == None):
+        targets = discover(tracker)
+    routes, directions, stop_ids = targets
+
+    def sample(items, count):
+        return rand.sample(items, min(count, len(items)))
+
+    calls = (("getvehicles_rt", 4, \
+              lambda: tracker.getvehicles_rt(*sample(routes, 10))), \
+             ("getpredictions_stop", 4, \
+              lambda: tracker.getpredictions_stop(*sample(stop_ids, 10))), \
+             ("getpatterns_rt", 1, lambda: tracker.getpatterns_rt( \
+                  *rand.choice([(route, direction) for route in directions \
+                                for direction in directions[route]]))), \
+             ("getbulletins_route", 1, \
+              lambda: tracker.getbulletins_route(*sample(routes, 10))), \
+             ("gettime", 1, tracker.gettime))
+    schedule = list()
+    for name, weight, call in calls:
+        schedule.extend([(name, call)] * weight)
+    schedule = [rand.choice(schedule) for i in range(requests)]
+
+    def timed(entry):
+        name, call = entry
+        start = time.time()
+        try:
+            call()
+            error = None
+        except Exception as e:
+            error = e.__class__.__name__
+        return (name, time.time() - start, error)
+
+    start = time.time()
+    results = ctabustracker.run_parallel(timed, schedule, workers)
+    elapsed = time.time() - start
+
+    errors = dict()
+    latencies = {"all": list()}
+    for name, latency, error in results:
+        latencies["all"].append(latency)
+        latencies.setdefault(name, list()).append(latency)
+        if (error != None):
+            errors[error] = errors.get(error, 0) + 1
+    report = {"requests": requests, "elapsed": elapsed, \
+              "throughput": requests / elapsed if elapsed else 0.0, \
+              "errors": errors, "latency": dict()}
+    for name, values in latencies.items():
+        values.sort()
+        report["latency"][name] = {"count": len(values), \
+                                   "p50": percentile(values, 0.50), \
+                                   "p95": percentile(values, 0.95), \
+                                   "p99": percentile(values, 0.99), \
+                                   "max": values[-1] if values else None}
+    return report
+
+
+def format_report(report):
+    """
+    Returns a load test report as printable text.
+    """
+    lines = ["%d requests in %.2fs: %.1f requests/s" % \
+             (report["requests"], report["elapsed"], report["throughput"])]
+    for name in sorted(report["errors"]):
+        lines.append("  %s: %d" % (name, report["errors"][name]))
+    lines.append("%-22s %7s %9s %9s %9s %9s" % \
+                 ("latency (ms)", "count", "p50", "p95", "p99", "max"))
+    for name in sorted(report["latency"], key = lambda name: name != "all"):
+        stats = report["latency"][name]
+        lines.append("%-22s %7d %9.1f %9.1f %9.1f %9.1f" % \
+                     (name, stats["count"], stats["p50"] * 1000, \
+                      stats["p95"] * 1000, stats["p99"] * 1000, \
+                      stats["max"] * 1000))
+    return "\n".join(lines)
+
+
+def main(argv = None):
+    import argparse
+    parser = argparse.ArgumentParser(description = \
+            "Mock CTA Bus Tracker API server and load test driver")
+    commands = parser.add_subparsers(dest = "command")
+    serve = commands.add_parser("serve", help = "run the mock server")
+    load = commands.add_parser("load", help = "run a load test")
+    for command in (serve, load):
+        command.add_argument("--host", default = "127.0.0.1")
+        command.add_argument("--port", type = int, default = 0)
+        command.add_argument("--key", default = "mock")
+        command.add_argument("--routes", type = int, default = 20)
+        command.add_argument("--buses", type = int, default = 10, \
+                             help = "buses per route")
+        command.add_argument("--stops", type = int, default = 30, \
+                             help = "stops per route direction")
+        command.add_argument("--latency", type = float, default = 0.0, \
+                             help = "seconds added to every response")
+        command.add_argument("--jitter", type = float, default = 0.0, \
+                             help = "up to this many more seconds, at random")
+        command.add_argument("--error-rate", type = float, default = 0.0, \
+                             help = "fraction of requests answered with 503")
+        command.add_argument("--seed", type = int, default = 0)
+    load.add_argument("--url", help = "api_url to test instead of a mock server")
+    load.add_argument("--requests", type = int, default = 1000)
+    load.add_argument("--workers", type = int, default = 8)
+    load.add_argument("--parser", help = "parser backend (lxml or etree)")
+    load.add_argument("--mode", default = "objects", \
+                      choices = ctabustracker.ctabustracker.MODES)
+    args = parser.parse_args(argv)
+    if (args.command == None):
+        parser.error("a command (serve or load) is required")
+
+    server = None
+    url = getattr(args, "url", None)
+    if (url == None):
+        network = MockNetwork(args.routes, args.buses, args.stops, \
+                              seed = args.seed)
+        server = MockServer((args.host, args.port), network, args.key, \
+                            args.latency, args.jitter, args.error_rate, \
+                            args.seed)
+        url = server.api_url
+    if (args.command == "serve"):
+        print("Serving mock Bus Tracker API at " + url)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if (server != None):
+        server.start()
+    tracker = ctabustracker.ctabustracker(args.key, url, parser = args.parser, \
+                                          mode = args.mode)
+    targets = None
+    if (args.mode == "raw"):
+        targets = discover(ctabustracker.ctabustracker(args.key, url, \
+                                                       parser = args.parser))
+    report = run_load(tracker, args.requests, args.workers, args.seed, targets)
+    print(format_report(report))
+    if (hasattr(tracker.transport, "metrics")):
+        print("transport: " + ", ".join("%s=%s" % (name, value) for name, value \
+                                        in sorted(tracker.transport.metrics.items())))
+    if (server != None):
+        print("server: " + ", ".join("%s=%s" % (name, value) for name, value \
+                                     in sorted(server.stats.items())))
+        server.shutdown()
+    return 0
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
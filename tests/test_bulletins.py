@@ -0,0 +1,118 @@
+"""
+Tests for BulletinIndex: deduplication, the affected-service indexes, and
+which bulletins a batched query associates with each key.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ctabustracker
+
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+
+
+def bulletin(name, *services):
+    """
+    Returns the XML for a bulletin; each service is a dict of tag -> text.
+    """
+    body = "<sb><nm>%s</nm><sbj>%s</sbj><dtl>Detail</dtl><brf></brf>" \
+           "<prty>Low</prty>" % (name, name)
+    for service in services:
+        body += "<srvc>" + "".join("<%s>%s</%s>" % (tag, service[tag], tag) \
+                                   for tag in sorted(service)) + "</srvc>"
+    return body + "</sb>"
+
+
+class BulletinTransport:
+    """
+    Answers getservicebulletins with the bulletins listed for each route or
+    stop asked for, like the API does for a batch: all of them, in one
+    list, without saying which key each came back for.
+    """
+
+    def __init__(self, bulletins):
+        # route or stop id -> list of bulletin XML
+        self.bulletins = bulletins
+        self.requests = 0
+
+    def get(self, url):
+        self.requests += 1
+        query = parse_qs(urlparse(url).query)
+        keys = (query.get("rt") or query.get("stpid"))[0].split(",")
+        body = "".join(sb for key in keys for sb in self.bulletins.get(key, ()))
+        return ("<?xml version=\"1.0\"?><bustime-response>%s" \
+                "</bustime-response>" % body).encode("utf-8")
+
+
+def index_for(bulletins, ttl = 60):
+    transport = BulletinTransport(bulletins)
+    tracker = ctabustracker.ctabustracker("key", transport = transport)
+    return (ctabustracker.BulletinIndex(tracker, ttl = ttl), transport)
+
+
+def names(bulletins):
+    return [bulletin.name for bulletin in bulletins]
+
+
+class BulletinIndexTest(unittest.TestCase):
+
+    def test_batched_query_only_indexes_affected_routes(self):
+        index, transport = index_for({"1": [bulletin("A", {"rt": "1"})]})
+        self.assertEqual(index.refresh_routes("1", "2"), 1)
+        self.assertEqual(names(index.for_routes(["1"])), ["A"])
+        self.assertEqual(names(index.for_routes(["2"])), [])
+
+    def test_directions_and_stops(self):
+        index, transport = index_for({"1": [bulletin("A", \
+                {"rt": "1", "rtdir": "Northbound"}, {"stpid": "100"})]})
+        index.refresh_routes("1")
+        self.assertEqual(names(index.for_routes(["1"], "North Bound")), ["A"])
+        self.assertEqual(names(index.for_routes(["1"], "South Bound")), [])
+        self.assertEqual(names(index.for_stops([100])), ["A"])
+        self.assertEqual(names(index.for_stops([101])), [])
+
+    def test_systemwide_bulletins_affect_everything(self):
+        index, transport = index_for({"1": [bulletin("All")]})
+        index.refresh_routes("1")
+        self.assertEqual(names(index.for_routes(["2"])), ["All"])
+        self.assertEqual(names(index.for_stops([100])), ["All"])
+
+    def test_unkeyed_bulletin_only_for_a_query_of_its_own(self):
+        unkeyed = bulletin("Name only", {"stpnm": "Main and 1st"})
+        index, transport = index_for({"1": [unkeyed]})
+        index.refresh_routes("1")
+        self.assertEqual(names(index.for_routes(["1"])), ["Name only"])
+
+        index, transport = index_for({"1": [unkeyed]})
+        index.refresh_routes("1", "2")
+        self.assertEqual(names(index.for_routes(["2"])), [])
+
+    def test_duplicates_are_kept_once(self):
+        shared = bulletin("A", {"rt": "1"}, {"rt": "2"})
+        index, transport = index_for({"1": [shared], "2": [shared]})
+        index.refresh_routes("1")
+        index.refresh_routes("2")
+        self.assertEqual(len(index.bulletins()), 1)
+        self.assertTrue(index.for_routes(["1"])[0] is index.for_routes(["2"])[0])
+
+    def test_refresh_only_stale_keys(self):
+        bulletins = {"1": [bulletin("A", {"rt": "1"})]}
+        index, transport = index_for(bulletins)
+        index.refresh_routes("1")
+        self.assertEqual(index.refresh_routes("1"), 0)
+        self.assertEqual(transport.requests, 1)
+
+        # A bulletin that's no longer returned is dropped
+        del bulletins["1"]
+        self.assertEqual(index.refresh_routes("1", force = True), 1)
+        self.assertEqual(index.bulletins(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+"""
+Tests for PollingDaemon: bad responses are counted and skipped, and only
+an invalid API key stops it.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ctabustracker
+import ctabustracker_daemon
+
+try:
+    import lxml.etree
+    HAVE_LXML = True
+except ImportError:
+    HAVE_LXML = False
+
+RESPONSES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "responses")
+
+
+def recorded(name):
+    with open(os.path.join(RESPONSES, name), "rb") as response:
+        return response.read()
+
+
+class FixedTransport:
+    """
+    Answers every request with the same body, or raises error if set.
+    """
+
+    def __init__(self, body = None, error = None):
+        self.body = body
+        self.error = error
+
+    def get(self, url):
+        if (self.error != None):
+            raise self.error
+        return self.body
+
+
+def daemon_for(transport, parser = None):
+    tracker = ctabustracker.ctabustracker("key", transport = transport, \
+                                          parser = parser)
+    return ctabustracker_daemon.PollingDaemon(tracker, routes = ["54B"], \
+                                              stops = [15935], interval = 0)
+
+
+class PollingDaemonTest(unittest.TestCase):
+
+    def test_unparseable_responses_are_counted_and_skipped(self):
+        parsers = ["etree"] + (["lxml"] if HAVE_LXML else [])
+        for parser in parsers:
+            daemon = daemon_for(FixedTransport(b"<html><body>Bad gateway"), \
+                                parser)
+            daemon.run(polls = 2)
+            self.assertEqual(daemon.stats["polls"], 2)
+            # One routes batch and one stops batch per poll
+            self.assertEqual(daemon.stats["failed_batches"], 4)
+
+    def test_undecodable_fields_are_counted_and_skipped(self):
+        vehicles = recorded("vehicles.xml")
+        for body in (vehicles.replace(b"<vid>1866</vid>", b"<vid>abc</vid>"), \
+                     vehicles.replace(b"20101219 19:25", b"yesterday")):
+            daemon = daemon_for(FixedTransport(body))
+            daemon.run(polls = 2)
+            self.assertEqual(daemon.stats["polls"], 2)
+            # The stops batches find no predictions, which is fine
+            self.assertEqual(daemon.stats["failed_batches"], 2)
+
+    def test_transport_errors_are_counted_and_skipped(self):
+        daemon = daemon_for(FixedTransport(error = IOError("Connection reset")))
+        daemon.run(polls = 2)
+        self.assertEqual(daemon.stats["failed_batches"], 4)
+
+    def test_request_wide_errors_skip_the_poll(self):
+        body = b"<bustime-response><error><msg>Transaction limit for " \
+               b"current day has been exceeded.</msg></error></bustime-response>"
+        daemon = daemon_for(FixedTransport(body))
+        daemon.run(polls = 2)
+        self.assertEqual(daemon.stats["polls"], 0)
+
+    def test_invalid_key_stops_the_daemon(self):
+        daemon = daemon_for(FixedTransport(recorded("error.xml")))
+        self.assertRaises(ctabustracker.InvalidKeyError, daemon.run, 2)
+
+    def test_good_responses_are_polled(self):
+        daemon = daemon_for(FixedTransport(recorded("vehicles.xml")))
+        vehicles, predictions = daemon.poll()
+        self.assertEqual([vehicle.vehicle_id for vehicle in vehicles], \
+                         [1866, 6451])
+        self.assertEqual(daemon.stats["failed_batches"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
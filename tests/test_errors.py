@@ -0,0 +1,100 @@
+"""
+Tests for API error handling: which error is raised when every id in a
+request fails, and that callers see the errors for all of them.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ctabustracker
+import ctabustracker_daemon
+
+RESPONSES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "responses")
+
+
+class FixedTransport:
+    """
+    Answers every request with the same recorded response.
+    """
+
+    def __init__(self, name):
+        with open(os.path.join(RESPONSES, name), "rb") as response:
+            self.body = response.read()
+
+    def get(self, url):
+        return self.body
+
+
+def tracker_for(name):
+    return ctabustracker.ctabustracker("key", transport = FixedTransport(name))
+
+
+class APIErrorClassTest(unittest.TestCase):
+
+    # Messages the API sends, and the class each should be raised as
+    MESSAGES = [("Invalid API access key supplied", "InvalidKeyError"),
+                ("No API access key supplied", "InvalidKeyError"),
+                ("Transaction limit for current day has been exceeded.", \
+                 "TransactionLimitError"),
+                ("Maximum number of vid identifiers exceeded", \
+                 "InvalidParameterError"),
+                ("Maximum number of rt identifiers exceeded", \
+                 "InvalidParameterError"),
+                ("Maximum number of stpid identifiers exceeded", \
+                 "InvalidParameterError"),
+                ("No data found for parameter", "NoDataError"),
+                ("No service scheduled", "NoDataError"),
+                ("No arrival times", "NoDataError"),
+                ("Invalid API command", "InvalidParameterError"),
+                ("Invalid RT parameter", "InvalidParameterError"),
+                ("Invalid stpid parameter", "InvalidParameterError"),
+                ("Either rt or vid parameter must be specified", \
+                 "InvalidParameterError"),
+                ("Internal server error", "APIError")]
+
+    def test_messages(self):
+        for msg, expected in self.MESSAGES:
+            error = ctabustracker.api_error({"msg": msg})
+            self.assertEqual(type(error).__name__, expected, msg)
+
+    def test_param_and_value(self):
+        error = ctabustracker.api_error({"vid": "509", \
+                                         "msg": "No data found for parameter"})
+        self.assertEqual((error.param, error.value, error.retry), \
+                         ("vid", "509", True))
+
+
+class AllFailedTest(unittest.TestCase):
+    """
+    Route 1 has no data and route 999 doesn't exist, in the same response.
+    """
+
+    def test_most_severe_error_is_raised_with_all_errors(self):
+        tracker = tracker_for("errors_mixed.xml")
+        try:
+            tracker.getbulletins_route("1", "999")
+        except ctabustracker.APIError as e:
+            error = e
+        self.assertTrue(isinstance(error, ctabustracker.InvalidParameterError))
+        self.assertEqual(error.value, "999")
+        self.assertEqual([type(each).__name__ for each in error.errors], \
+                         ["NoDataError", "InvalidParameterError"])
+
+    def test_bulletin_index_drops_invalid_routes(self):
+        index = ctabustracker.BulletinIndex(tracker_for("errors_mixed.xml"))
+        index.refresh_routes("1", "999")
+        self.assertEqual(index.invalid, set([("rt", "999")]))
+
+    def test_daemon_drops_invalid_routes(self):
+        daemon = ctabustracker_daemon.PollingDaemon( \
+                tracker_for("errors_mixed.xml"), routes = ["1", "999"])
+        daemon.poll()
+        self.assertEqual(daemon.invalid, set([("rt", "999")]))
+        self.assertEqual(daemon.stats["failed_batches"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
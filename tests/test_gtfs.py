@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for GTFS export and import: a catalog exported with export_gtfs()
+and read back with load_gtfs() holds the same data, and feeds with ids
+that aren't numbers load.
+"""
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ctabustracker
+import ctabustracker_mock
+
+
+class GTFSRoundTripTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        network = ctabustracker_mock.MockNetwork(routes = 3, \
+                buses_per_route = 2, stops_per_route = 6)
+        cls.server = ctabustracker_mock.MockServer(network = network)
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        tracker = ctabustracker.ctabustracker("mock", self.server.api_url, \
+                transport = ctabustracker.HTTPTransport())
+        self.catalog = ctabustracker.RouteCatalog(tracker)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def assertSameCatalog(self, first, second):
+        self.assertEqual(first.routes(), second.routes())
+        for route in first.routes():
+            self.assertEqual(first.directions(route), second.directions(route))
+            self.assertEqual(sorted(first.pattern_tuples(route)), \
+                             sorted(second.pattern_tuples(route)))
+            for direction in first.directions(route):
+                self.assertEqual(sorted(first.stop_tuples(route, direction)), \
+                                 sorted(second.stop_tuples(route, direction)))
+
+    def test_round_trip(self):
+        for name in ("feed", "feed.zip"):
+            target = os.path.join(self.directory, name)
+            ctabustracker.export_gtfs(self.catalog, target)
+            loaded = ctabustracker.RouteCatalog(None)
+            self.assertEqual(loaded.load_gtfs(target), 3)
+            self.assertSameCatalog(self.catalog, loaded)
+            # Numeric shape ids come back as pattern ids, like the API's
+            for pattern in loaded.pattern_tuples("1"):
+                self.assertTrue(isinstance(pattern[0], int))
+
+    def test_loaded_objects_match_the_api(self):
+        target = os.path.join(self.directory, "feed.zip")
+        ctabustracker.export_gtfs(self.catalog, target)
+        loaded = ctabustracker.RouteCatalog(None)
+        loaded.load_gtfs(target)
+        by_id = lambda pattern: pattern.pattern_id
+        for first, second in zip(sorted(self.catalog.patterns("1"), key = by_id), \
+                                 sorted(loaded.patterns("1"), key = by_id)):
+            self.assertEqual(str(first), str(second))
+            self.assertEqual([point.stop_id for point in first.points], \
+                             [point.stop_id for point in second.points])
+
+
+class GTFSStringIdTest(unittest.TestCase):
+
+    # A hand-written feed whose ids aren't numbers
+    FEED = {"routes.txt": u"route_id,route_short_name,route_long_name\n"
+                          u"X9,X9,Express\n",
+            "stops.txt": u"stop_id,stop_name,stop_lat,stop_lon\n"
+                         u"S-1,Plaza Señor,41.0,-87.0\n"
+                         u"S-2,Main,41.1,-87.0\n",
+            "trips.txt": u"route_id,service_id,trip_id,shape_id,direction_id\n"
+                         u"X9,daily,t1,shape-a,0\n",
+            "stop_times.txt": u"trip_id,arrival_time,departure_time,stop_id,"
+                              u"stop_sequence,shape_dist_traveled\n"
+                              u"t1,,,S-1,1,0\n"
+                              u"t1,,,S-2,2,500\n",
+            "shapes.txt": u"shape_id,shape_pt_lat,shape_pt_lon,"
+                          u"shape_pt_sequence,shape_dist_traveled\n"
+                          u"shape-a,41.0,-87.0,1,0\n"
+                          u"shape-a,41.1,-87.0,2,500\n"}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name, text in self.FEED.items():
+            with io.open(os.path.join(self.directory, name), "w", \
+                         encoding = "utf-8") as table:
+                table.write(text)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def test_string_ids(self):
+        catalog = ctabustracker.RouteCatalog(None)
+        self.assertEqual(catalog.load_gtfs(self.directory), 1)
+        patterns = catalog.pattern_tuples("X9")
+        self.assertEqual([pattern[0] for pattern in patterns], ["shape-a"])
+        self.assertEqual([point[4] for point in patterns[0][3]], ["S-1", "S-2"])
+        stops = catalog.stop_tuples("X9", catalog.directions("X9")[0])
+        self.assertEqual(sorted(stops)[0][:2], ("S-1", u"Plaza Señor"))
+        pattern = catalog.pattern("shape-a")
+        self.assertEqual(pattern.pattern_id, "shape-a")
+        self.assertEqual([point.stop_id for point in pattern.next_stops(0, 2)], \
+                         ["S-1", "S-2"])
+        stop = catalog.stops("X9", catalog.directions("X9")[0])[0]
+        self.assertTrue(stop.stop_id in ("S-1", "S-2"))
+
+    def test_string_ids_round_trip(self):
+        catalog = ctabustracker.RouteCatalog(None)
+        catalog.load_gtfs(self.directory)
+        target = os.path.join(self.directory, "copy.zip")
+        ctabustracker.export_gtfs(catalog, target)
+        copy = ctabustracker.RouteCatalog(None)
+        copy.load_gtfs(target)
+        self.assertEqual(copy.pattern_tuples("X9"), catalog.pattern_tuples("X9"))
+
+
+if __name__ == "__main__":
+    unittest.main()
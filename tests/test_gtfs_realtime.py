@@ -0,0 +1,161 @@
+"""
+Tests for GTFSRealtimeFeed: the protocol buffer encoding, reuse of
+unchanged entities, and deletions in differential feeds.
+"""
+
+import copy
+import os
+import struct
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ctabustracker
+from test_parsers import RecordedTransport
+
+
+def decode(data, messages = ()):
+    """
+    Decodes a protocol buffer into {field number: [values]}.  Length
+    delimited fields are bytes, except fields whose path (a tuple of field
+    numbers from the top) is in messages, which are decoded too.
+    """
+    return _decode(bytearray(data), set(messages), ())
+
+def _decode(data, messages, path):
+    fields = dict()
+    position = 0
+    while (position < len(data)):
+        key, position = _varint(data, position)
+        field, wire_type = key >> 3, key & 7
+        if (wire_type == 0):
+            value, position = _varint(data, position)
+        elif (wire_type == 5):
+            value = struct.unpack("<f", bytes(data[position:position + 4]))[0]
+            position += 4
+        elif (wire_type == 2):
+            length, position = _varint(data, position)
+            value = data[position:position + length]
+            position += length
+            if (path + (field,) in messages):
+                value = _decode(value, messages, path + (field,))
+            else:
+                value = bytes(value)
+        else:
+            raise ValueError("Unexpected wire type %d" % wire_type)
+        fields.setdefault(field, list()).append(value)
+    return fields
+
+def _varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if (not byte & 0x80):
+            return (value, position)
+
+
+# FeedMessage paths to decode: header, entity, entity.vehicle and its
+# trip, position and descriptor, entity.trip_update and its trip, stop
+# time updates, arrivals and vehicle descriptor
+MESSAGES = ((1,), (2,), (2, 4), (2, 4, 1), (2, 4, 2), (2, 4, 8), \
+            (2, 3), (2, 3, 1), (2, 3, 2), (2, 3, 2, 2), (2, 3, 3))
+
+
+def entities(feed):
+    """
+    Returns (incrementality, {entity id: entity}) for an encoded feed.
+    """
+    message = decode(feed, MESSAGES)
+    return (message[1][0][2][0], \
+            dict((entity[1][0].decode("utf-8"), entity) \
+                 for entity in message.get(2, ())))
+
+
+class GTFSRealtimeFeedTest(unittest.TestCase):
+
+    def setUp(self):
+        tracker = ctabustracker.ctabustracker("key", \
+                                              transport = RecordedTransport())
+        self.vehicles = tracker.getvehicles_rt("54B")
+        self.predictions = tracker.getpredictions_stop(15935)
+        self.feed = ctabustracker.GTFSRealtimeFeed()
+
+    def test_vehicle_position_encoding(self):
+        self.feed.update_vehicles(self.vehicles)
+        version, feed = self.feed.full_feed()
+        incrementality, found = entities(feed)
+        self.assertEqual(incrementality, ctabustracker.GTFS_RT_FULL_DATASET)
+        self.assertEqual(sorted(found), ["vehicle-1866", "vehicle-6451"])
+
+        vehicle = found["vehicle-1866"][4][0]
+        self.assertEqual(vehicle[1][0][5], [b"54B"])
+        self.assertAlmostEqual(vehicle[2][0][1][0], 41.754318, 4)
+        self.assertAlmostEqual(vehicle[2][0][2][0], -87.733882, 4)
+        self.assertEqual(vehicle[2][0][3], [358.0])
+        self.assertEqual(vehicle[5], \
+                         [int(time.mktime(self.vehicles[0].timestamp))])
+        self.assertEqual(vehicle[8][0][1], [b"1866"])
+
+    def test_trip_update_encoding(self):
+        self.feed.update_predictions(self.predictions)
+        version, feed = self.feed.full_feed()
+        incrementality, found = entities(feed)
+        self.assertEqual(sorted(found), ["trip-1866", "trip-6451"])
+
+        trip = found["trip-1866"][3][0]
+        self.assertEqual(trip[1][0][5], [b"54B"])
+        self.assertEqual(trip[3][0][1], [b"1866"])
+        update = trip[2][0]
+        self.assertEqual(update[4], [b"15935"])
+        self.assertEqual(update[2][0][2], \
+                         [int(self.predictions[0].predicted_eta_epoch)])
+
+    def test_unchanged_updates_reuse_entities(self):
+        self.feed.update_vehicles(self.vehicles)
+        first = self.feed.full_feed()
+        self.feed.update_vehicles(self.vehicles)
+        self.assertEqual(self.feed.version, 1)
+        self.assertEqual(self.feed.stats["reused"], 2)
+        self.assertTrue(self.feed.full_feed() is first)
+
+    def test_differential_has_changes_and_deletions(self):
+        self.feed.update_vehicles(self.vehicles, routes = ["54B", "79"])
+        since = self.feed.version
+
+        moved = copy.copy(self.vehicles[0])
+        moved.lat += 0.01
+        # 6451 is no longer on either polled route
+        self.feed.update_vehicles([moved], routes = ["54B", "79"])
+        version, feed = self.feed.differential_feed(since)
+        self.assertEqual(version, since + 1)
+        incrementality, found = entities(feed)
+        self.assertEqual(incrementality, ctabustracker.GTFS_RT_DIFFERENTIAL)
+        self.assertEqual(sorted(found), ["vehicle-1866", "vehicle-6451"])
+        self.assertEqual(found["vehicle-6451"][2], [1])
+        self.assertFalse(2 in found["vehicle-1866"])
+
+        version, feed = self.feed.full_feed()
+        self.assertEqual(sorted(entities(feed)[1]), ["vehicle-1866"])
+
+        # Nothing changed after the latest version
+        incrementality, found = entities(self.feed.differential_feed(version)[1])
+        self.assertEqual(found, dict())
+
+    def test_forgotten_tombstones_give_a_full_feed(self):
+        feed = ctabustracker.GTFSRealtimeFeed(max_tombstones = 1)
+        feed.update_vehicles(self.vehicles, routes = ["54B", "79"])
+        feed.update_vehicles([], routes = ["54B", "79"])
+        incrementality, found = entities(feed.differential_feed(0)[1])
+        self.assertEqual(incrementality, ctabustracker.GTFS_RT_FULL_DATASET)
+        self.assertEqual(found, dict())
+
+
+if __name__ == "__main__":
+    unittest.main()
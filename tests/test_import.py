@@ -0,0 +1,48 @@
+"""
+Import budget: importing ctabustracker must not pull in the HTTP, XML,
+compression or optional libraries, which are only loaded when needed.
+"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that are only imported the first time they're used
+LAZY_MODULES = ["urllib.request", "urllib2", "httplib", "http.client",
+                "xml.etree", "xml.etree.ElementTree", "zlib", "csv",
+                "zipfile", "numpy", "lxml", "lxml.etree"]
+
+SCRIPT = """
+import sys
+import %s
+for name in %r:
+    if (name in sys.modules):
+        print(name)
+"""
+
+
+def imported_after(module):
+    """
+    Returns the LAZY_MODULES that are in sys.modules after importing
+    module in a fresh interpreter.
+    """
+    script = SCRIPT % (module, LAZY_MODULES)
+    output = subprocess.check_output([sys.executable, "-c", script], \
+                                     cwd = ROOT)
+    return output.decode("ascii").split()
+
+
+class ImportBudgetTest(unittest.TestCase):
+
+    def test_library_imports_nothing_heavy(self):
+        self.assertEqual(imported_after("ctabustracker"), [])
+
+    def test_daemon_imports_nothing_heavy(self):
+        self.assertEqual(imported_after("ctabustracker_daemon"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
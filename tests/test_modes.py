@@ -0,0 +1,66 @@
+"""
+Tests that the helpers taking a ctabustracker work with "lazy" clients,
+and refuse "raw" ones.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ctabustracker
+import ctabustracker_daemon
+from test_parsers import RecordedTransport
+
+
+def tracker_for(mode):
+    return ctabustracker.ctabustracker("key", transport = RecordedTransport(), \
+                                       mode = mode)
+
+
+class ModesTest(unittest.TestCase):
+
+    def test_bulletin_index_materializes_lazy_bulletins(self):
+        index = ctabustracker.BulletinIndex(tracker_for("lazy"))
+        index.refresh_routes("21")
+        bulletins = index.for_routes(["21"])
+        self.assertTrue(bulletins)
+        for bulletin in bulletins:
+            self.assertTrue(isinstance(bulletin, ctabustracker.Service_Bulletin))
+
+    def test_daemon_polls_lazy_tracker(self):
+        daemon = ctabustracker_daemon.PollingDaemon(tracker_for("lazy"), \
+                                                    routes = ["54B"])
+        vehicles, predictions = daemon.poll()
+        self.assertEqual([vehicle.vehicle_id for vehicle in vehicles], \
+                         [1866, 6451])
+
+    def test_catalog_pattern_from_lazy_tracker(self):
+        catalog = ctabustracker.RouteCatalog(tracker_for("lazy"))
+        pattern = catalog.pattern(3934)
+        self.assertTrue(isinstance(pattern, ctabustracker.Pattern))
+        self.assertTrue(catalog.pattern(3934) is pattern)
+        vehicles = tracker_for("lazy").getvehicles_rt("54B")
+        next_stops = ctabustracker.next_stops_for_vehicles(vehicles[:1], \
+                                                           catalog)
+        self.assertEqual(list(next_stops), [1866])
+
+    def test_raw_tracker_is_refused(self):
+        tracker = tracker_for("raw")
+        for user in (ctabustracker.RouteCatalog, ctabustracker.BulletinIndex, \
+                     ctabustracker_daemon.PollingDaemon):
+            self.assertRaises(ctabustracker.InvalidParamtersException, \
+                              user, tracker)
+
+    def test_materialize_all_keeps_errors(self):
+        results = ctabustracker.ResultList( \
+                tracker_for("lazy").getvehicles_rt("54B"), ["error"])
+        materialized = ctabustracker.materialize_all(results)
+        self.assertTrue(isinstance(materialized[0], ctabustracker.Vehicle))
+        self.assertEqual(materialized.errors, ["error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
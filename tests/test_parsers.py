@@ -0,0 +1,151 @@
+"""
+Conformance tests for the parser backends: every get* method must decode
+the recorded responses in tests/responses/ into the same objects with
+ElementTreeParser and LxmlParser.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ctabustracker
+
+RESPONSES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "responses")
+
+# API command -> recorded response
+COMMANDS = {"gettime": "time.xml",
+            "getvehicles": "vehicles.xml",
+            "getroutes": "routes.xml",
+            "getdirections": "dirs.xml",
+            "getstops": "stops.xml",
+            "getpatterns": "patterns.xml",
+            "getpredictions": "predictions.xml",
+            "getservicebulletins": "bulletins.xml"}
+
+try:
+    import lxml.etree
+    HAVE_LXML = True
+except ImportError:
+    HAVE_LXML = False
+
+
+class RecordedTransport:
+    """
+    Answers every request with the recorded response for its command, or
+    with the file named in overrides.
+    """
+
+    def __init__(self, overrides = None):
+        self.overrides = overrides or dict()
+
+    def get(self, url):
+        command = url.split("?", 1)[0].rstrip("/").rsplit("/", 1)[-1]
+        name = self.overrides.get(command, COMMANDS[command])
+        with open(os.path.join(RESPONSES, name), "rb") as response:
+            return response.read()
+
+
+def dump(value):
+    """
+    Turns decoded results into plain, comparable values.
+    """
+    if (isinstance(value, ctabustracker.ResultList)):
+        return ("ResultList", [dump(item) for item in value], \
+                [dump(error) for error in value.errors])
+    if (isinstance(value, (list, tuple))):
+        return [dump(item) for item in value]
+    if (isinstance(value, dict)):
+        return dict((key, dump(value[key])) for key in value)
+    if (isinstance(value, ctabustracker.APIError)):
+        return (type(value).__name__, value.msg, value.param, value.value)
+    if (hasattr(value, "__dict__")):
+        return (type(value).__name__, \
+                dict((key, dump(item)) for key, item in vars(value).items()))
+    return value
+
+
+def decode_all(parser, overrides = None):
+    """
+    Runs every get* method against the recorded responses.
+    """
+    tracker = ctabustracker.ctabustracker("key", \
+            transport = RecordedTransport(overrides), parser = parser)
+    return dump([tracker.gettime(),
+                 tracker.getvehicles_vid(1866),
+                 tracker.getvehicles_rt("54B"),
+                 tracker.getroutes(),
+                 tracker.getroute_directions("54B"),
+                 tracker.getroute_stops("54B", "North Bound"),
+                 tracker.getpatterns_pid(3934),
+                 tracker.getpatterns_rt("54B", "North Bound"),
+                 tracker.getpredictions_stop(15935),
+                 tracker.getpredictions_vehicle(1866),
+                 tracker.getbulletins_route("21"),
+                 tracker.getbulletins_stops(15935)])
+
+
+class ParserConformanceTest(unittest.TestCase):
+
+    def test_etree_decodes_recorded_responses(self):
+        results = decode_all("etree")
+        vehicles = results[2]
+        self.assertEqual(len(vehicles), 2)
+        self.assertEqual(vehicles[0][1]["vehicle_id"], 1866)
+        self.assertEqual(vehicles[0][1]["dest"], "Cermak/Kenton")
+        self.assertTrue(vehicles[0][1]["delayed"])
+        self.assertEqual(results[4], ["North Bound", "South Bound"])
+        points = results[6][0][1]["points"]
+        self.assertEqual([point[1]["ptype"] for point in points], \
+                         ["Stop", "Waypoint", "Stop"])
+
+    @unittest.skipUnless(HAVE_LXML, "lxml isn't installed")
+    def test_backends_match(self):
+        self.assertEqual(decode_all("etree"), decode_all("lxml"))
+
+    @unittest.skipUnless(HAVE_LXML, "lxml isn't installed")
+    def test_backends_match_on_partial_errors(self):
+        overrides = {"getvehicles": "vehicles_partial.xml"}
+        results = dict()
+        for parser in ("etree", "lxml"):
+            tracker = ctabustracker.ctabustracker("key", \
+                    transport = RecordedTransport(overrides), parser = parser)
+            results[parser] = dump(tracker.getvehicles_vid(1866, 509))
+        self.assertEqual(results["etree"][0], "ResultList")
+        self.assertEqual(results["etree"][2], \
+                [("NoDataError", "No data found for parameter", "vid", "509")])
+        self.assertEqual(results["etree"], results["lxml"])
+
+    def test_lazy_views_materialize(self):
+        objects = ctabustracker.ctabustracker("key", \
+                transport = RecordedTransport(), mode = "objects")
+        lazy = ctabustracker.ctabustracker("key", \
+                transport = RecordedTransport(), mode = "lazy")
+        pattern = lazy.getpatterns_pid(3934)[0]
+        bulletin = lazy.getbulletins_route("21")[0]
+        self.assertEqual(dump([pattern.materialize(), bulletin.materialize()]), \
+                         dump([objects.getpatterns_pid(3934)[0], \
+                               objects.getbulletins_route("21")[0]]))
+        # Nested views materialize (and print) on their own too
+        for view in pattern.points + bulletin.affected_services:
+            self.assertEqual(str(view), str(view.materialize()))
+
+    def test_default_backend(self):
+        parser = ctabustracker.get_parser()
+        if (bytes is str and HAVE_LXML):
+            self.assertEqual(parser.name, "lxml")
+        else:
+            self.assertEqual(parser.name, "etree")
+
+    def test_error_response_raises(self):
+        parsers = ["etree"] + (["lxml"] if HAVE_LXML else [])
+        for parser in parsers:
+            tracker = ctabustracker.ctabustracker("key", \
+                    transport = RecordedTransport({"getroutes": "error.xml"}), \
+                    parser = parser)
+            self.assertRaises(ctabustracker.InvalidKeyError, tracker.getroutes)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+"""
+Tests for Pattern's stop index and the next-stop helpers built on it.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ctabustracker
+from test_parsers import RecordedTransport
+
+
+def make_pattern():
+    """
+    Returns a pattern with stops 1, 2 and 3 at 0, 1000 and 2500 feet and a
+    waypoint between, with the points appended out of order.
+    """
+    Point = ctabustracker.Point
+    return ctabustracker.Pattern(10, 2500, "North Bound", [
+            Point(3, "S", 41.2, -87.6, 3, "Third", 2500.0),
+            Point(1, "S", 41.0, -87.6, 1, "First", 0.0),
+            Point(2, "W", 41.05, -87.6, None, None, 500.0),
+            Point(4, "S", 41.1, -87.6, 2, "Second", 1000.0)])
+
+
+class Vehicle:
+    def __init__(self, vehicle_id, pattern_id, pattern_distance):
+        self.vehicle_id = vehicle_id
+        self.pattern_id = pattern_id
+        self.pattern_distance = pattern_distance
+
+
+def stop_ids(points):
+    return [point.stop_id for point in points]
+
+
+class PatternStopIndexTest(unittest.TestCase):
+
+    def test_stops_in_distance_order(self):
+        distances, stops, offsets = make_pattern().stop_index()
+        self.assertEqual(distances, [0.0, 1000.0, 2500.0])
+        self.assertEqual(stop_ids(stops), ["1", "2", "3"])
+        self.assertEqual(offsets, {"1": 0, "2": 1, "3": 2})
+
+    def test_next_stops(self):
+        pattern = make_pattern()
+        self.assertEqual(stop_ids(pattern.next_stops(0)), ["1"])
+        self.assertEqual(stop_ids(pattern.next_stops(1)), ["2"])
+        self.assertEqual(stop_ids(pattern.next_stops(1000, 5)), ["2", "3"])
+        self.assertEqual(pattern.next_stops(2501), [])
+
+    def test_stop_offset_and_distance(self):
+        pattern = make_pattern()
+        self.assertEqual(pattern.stop_offset(3), 2)
+        self.assertEqual(pattern.stop_offset("9"), None)
+        self.assertEqual(pattern.stop_distance(1, 3), 2500.0)
+        self.assertEqual(pattern.stop_distance(3, 2), -1500.0)
+        self.assertEqual(pattern.stop_distance(1, 9), None)
+
+    def test_index_is_kept_until_append(self):
+        pattern = make_pattern()
+        index = pattern.stop_index()
+        self.assertTrue(pattern.stop_index() is index)
+        pattern.append(ctabustracker.Point(5, "S", 41.3, -87.6, 4, "Fourth", \
+                                           3000.0))
+        self.assertFalse(pattern.stop_index() is index)
+        self.assertEqual(stop_ids(pattern.next_stops(2600)), ["4"])
+
+
+class NextStopsForVehiclesTest(unittest.TestCase):
+
+    def test_patterns_as_list_or_dict(self):
+        pattern = make_pattern()
+        vehicles = [Vehicle(1, 10, 0), Vehicle(2, 10, 1200), Vehicle(3, 99, 0)]
+        for patterns in ([pattern], {10: pattern}):
+            next_stops = ctabustracker.next_stops_for_vehicles(vehicles, \
+                                                               patterns, 2)
+            self.assertEqual(stop_ids(next_stops[1]), ["1", "2"])
+            self.assertEqual(stop_ids(next_stops[2]), ["3"])
+            self.assertEqual(next_stops[3], [])
+
+    def test_vehicles_approaching_stop(self):
+        vehicles = [Vehicle(1, 10, 0), Vehicle(2, 10, 2000), \
+                    Vehicle(3, 10, 2600), Vehicle(4, 99, 0)]
+        approaching = ctabustracker.vehicles_approaching_stop(vehicles, 3, \
+                [make_pattern()])
+        self.assertEqual([(distance, vehicle.vehicle_id) \
+                          for distance, vehicle in approaching], \
+                         [(500.0, 2), (2500.0, 1)])
+        approaching = ctabustracker.vehicles_approaching_stop(vehicles, 3, \
+                [make_pattern()], max_distance = 1000)
+        self.assertEqual([vehicle.vehicle_id for distance, vehicle in approaching], \
+                         [2])
+
+    def test_catalog_patterns_are_fetched_once(self):
+        transport = RecordedTransport()
+        requests = list()
+        get = transport.get
+        transport.get = lambda url: requests.append(url) or get(url)
+        catalog = ctabustracker.RouteCatalog(ctabustracker.ctabustracker( \
+                "key", transport = transport))
+        vehicles = [Vehicle(1866, 3934, 0)]
+        first = ctabustracker.next_stops_for_vehicles(vehicles, catalog)
+        second = ctabustracker.next_stops_for_vehicles(vehicles, catalog)
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(stop_ids(first[1866]), stop_ids(second[1866]))
+        self.assertTrue(catalog.pattern(3934) is catalog.pattern("3934"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+"""
+Tests for PolicyTransport and its parts: TokenBucket, RetryPolicy,
+CircuitBreaker, and stale responses.
+"""
+
+import os
+import socket
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ctabustracker
+
+URL = "http://localhost/bustime/api/v1/getvehicles?rt=54B"
+
+
+def http_error(code):
+    urllib = ctabustracker._get_urllib()
+    return urllib.HTTPError(URL, code, "HTTP %d" % code, {}, None)
+
+
+class ScriptedTransport:
+    """
+    Answers requests from a script: each item is a body to return, or an
+    exception to raise.  The last item repeats.
+    """
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.requests = 0
+
+    def get(self, url, timeout = None):
+        self.requests += 1
+        item = self.script[0]
+        if (len(self.script) > 1):
+            self.script.pop(0)
+        if (isinstance(item, Exception)):
+            raise item
+        return item
+
+
+def policy(transport, **kwargs):
+    kwargs.setdefault("retry_policy", ctabustracker.RetryPolicy( \
+            max_attempts = 2, base_delay = 0.0, max_delay = 0.0))
+    return ctabustracker.PolicyTransport(transport, **kwargs)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = ctabustracker.TokenBucket(rate = 10, burst = 3)
+        self.assertEqual([bucket.reserve() for i in range(3)], [0.0] * 3)
+        self.assertAlmostEqual(bucket.reserve(), 0.1, delta = 0.02)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, delta = 0.02)
+
+    def test_acquire_waits(self):
+        bucket = ctabustracker.TokenBucket(rate = 50)
+        self.assertEqual(bucket.acquire(), 0.0)
+        started = time.time()
+        waited = bucket.acquire()
+        self.assertTrue(waited > 0)
+        self.assertTrue(time.time() - started >= waited * 0.9)
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_is_transient(self):
+        urllib = ctabustracker._get_urllib()
+        retry_policy = ctabustracker.RetryPolicy()
+        for error, transient in ((http_error(503), True), \
+                                 (http_error(429), True), \
+                                 (http_error(404), False), \
+                                 (urllib.URLError("refused"), True), \
+                                 (socket.timeout(), True), \
+                                 (ValueError("bad"), False)):
+            self.assertEqual(retry_policy.is_transient(error), transient, error)
+
+    def test_delay_is_capped_full_jitter(self):
+        retry_policy = ctabustracker.RetryPolicy(base_delay = 0.5, \
+                                                 max_delay = 4.0)
+        for retry_number in range(10):
+            cap = min(4.0, 0.5 * 2 ** retry_number)
+            for i in range(20):
+                self.assertTrue(0 <= retry_policy.delay(retry_number) <= cap)
+
+    def test_is_idempotent(self):
+        retry_policy = ctabustracker.RetryPolicy()
+        self.assertTrue(retry_policy.is_idempotent(URL))
+        self.assertFalse(retry_policy.is_idempotent( \
+                "http://localhost/bustime/api/v1/setsomething"))
+
+    def test_transient_failure_is_retried(self):
+        scripted = ScriptedTransport(http_error(503), b"ok")
+        transport = policy(scripted)
+        self.assertEqual(transport.get(URL), b"ok")
+        self.assertEqual(scripted.requests, 2)
+        self.assertEqual(transport.metrics["retries"], 1)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def open_breaker(self):
+        breaker = ctabustracker.CircuitBreaker(failure_threshold = 1, \
+                                               reset_timeout = 0)
+        breaker.record_failure()
+        return breaker
+
+    def test_one_trial_request_when_half_open(self):
+        breaker = self.open_breaker()
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_trial_result_closes_or_reopens(self):
+        breaker = self.open_breaker()
+        breaker.allow()
+        self.assertTrue(breaker.record_failure())
+        self.assertEqual(breaker.state, breaker.OPEN)
+        breaker.allow()
+        breaker.record_success()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_trial_not_sent_is_given_back(self):
+        # The rate limiter wait outlasts the deadline, so the trial
+        # request never goes out; the next request must get to be the trial.
+        breaker = self.open_breaker()
+        bucket = ctabustracker.TokenBucket(rate = 10)
+        bucket.reserve()
+        scripted = ScriptedTransport(b"ok")
+        transport = policy(scripted, circuit_breaker = breaker, \
+                           rate_limiter = bucket, deadline = 0.01)
+        self.assertRaises(ctabustracker.DeadlineExceededError, \
+                          transport.get, URL)
+        self.assertEqual(scripted.requests, 0)
+        self.assertTrue(breaker.allow())
+
+    def test_open_breaker_refuses_requests(self):
+        breaker = ctabustracker.CircuitBreaker(failure_threshold = 1, \
+                                               reset_timeout = 60)
+        scripted = ScriptedTransport(http_error(503))
+        transport = policy(scripted, circuit_breaker = breaker, \
+                           retry_policy = ctabustracker.RetryPolicy(1))
+        self.assertRaises(ctabustracker.RequestFailedError, transport.get, URL)
+        self.assertRaises(ctabustracker.CircuitOpenError, transport.get, URL)
+        self.assertEqual(scripted.requests, 1)
+        self.assertEqual(transport.metrics["rejected"], 1)
+
+
+class StaleTest(unittest.TestCase):
+
+    def test_stale_responses_are_off_by_default(self):
+        transport = policy(ScriptedTransport(b"fresh", http_error(503)))
+        self.assertEqual(transport.get(URL), b"fresh")
+        self.assertRaises(ctabustracker.RequestFailedError, transport.get, URL)
+        self.assertEqual(transport.metrics["stale_served"], 0)
+
+    def test_stale_response_served_when_enabled(self):
+        transport = policy(ScriptedTransport(b"fresh", http_error(503)), \
+                           max_stale_age = 60)
+        self.assertEqual(transport.get(URL), b"fresh")
+        self.assertEqual(transport.get(URL), b"fresh")
+        self.assertEqual(transport.metrics["stale_served"], 1)
+
+    def test_no_stale_response_for_non_transient_errors(self):
+        transport = policy(ScriptedTransport(b"fresh", http_error(404)), \
+                           max_stale_age = 60)
+        transport.get(URL)
+        self.assertRaises(ctabustracker.RequestFailedError, transport.get, URL)
+        self.assertEqual(transport.metrics["stale_served"], 0)
+
+
+class BreakerSignalTest(unittest.TestCase):
+
+    def failing_breaker(self):
+        breaker = ctabustracker.CircuitBreaker(failure_threshold = 2)
+        breaker.record_failure()
+        return breaker
+
+    def test_http_error_is_an_answer(self):
+        breaker = self.failing_breaker()
+        transport = policy(ScriptedTransport(http_error(404)), \
+                           circuit_breaker = breaker)
+        self.assertRaises(ctabustracker.RequestFailedError, transport.get, URL)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_other_errors_are_not_an_answer(self):
+        breaker = self.failing_breaker()
+        transport = policy(ScriptedTransport(TypeError("no timeout argument")), \
+                           circuit_breaker = breaker)
+        self.assertRaises(ctabustracker.RequestFailedError, transport.get, URL)
+        # The earlier failure still counts
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+
+if __name__ == "__main__":
+    unittest.main()